@@ -0,0 +1,127 @@
+"""
+Compare exact vector search with the HNSW (ANN) index on synthetic tables.
+
+For every size, a table of random unit vectors grouped in clusters, like the
+embeddings of similar texts, is loaded into IRIS and indexed. The same queries
+then run as a full scan (%IGNOREINDEX) and through the index, and the report
+gives the latency of both and the recall@k of the index against the exact
+results. The statement is the one the search classes run, see
+vector_index.search_statement, and the index column says whether its query
+plan names the HNSW index.
+
+Runs against a local IRIS container, e.g. docker compose up iris. Loading a
+million rows takes a while; --keep leaves the tables for the next runs.
+
+Usage: python benchmark_ann_index.py [--rows 100000,1000000] [--dim 384] [--k 10]
+                                     [--m 16] [--ef-construction 200] [--keep] [--plan]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError
+
+from engine_class import get_engine, iris_dsn
+from vector_index import create_hnsw_index, hnsw_index_name, query_plan, search_statement
+
+
+def vector_string(vector):
+    return '[' + ','.join(f'{x:.6f}' for x in vector) + ']'
+
+
+def synthetic_vectors(rng, centers, n, noise=0.3):
+    labels = rng.integers(len(centers), size=n)
+    vectors = centers[labels] + noise * rng.standard_normal((n, centers.shape[1])) / np.sqrt(centers.shape[1])
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load_table(engine, table, rows, centers, rng, batch):
+    dim = centers.shape[1]
+    with engine.connect() as conn:
+        with conn.begin():
+            if inspect(engine).has_table(table):
+                conn.execute(text(f"DROP TABLE {table}"))
+            conn.execute(text(f"CREATE TABLE {table} (id INT PRIMARY KEY, description_vector VECTOR(DOUBLE, {dim}))"))
+    sql = text(f"INSERT INTO {table} (id, description_vector) VALUES (:id, TO_VECTOR(:description_vector))")
+    for start in range(0, rows, batch):
+        vectors = synthetic_vectors(rng, centers, min(batch, rows - start))
+        with engine.connect() as conn:
+            with conn.begin():
+                conn.execute(sql, [{'id': start + i, 'description_vector': vector_string(vector)}
+                                   for i, vector in enumerate(vectors)])
+        print(f"\r{table}: {start + len(vectors)}/{rows} rows", end='', flush=True)
+    print()
+
+
+def search(engine, table, query, k, exact):
+    # The statement CloseSearch.search_by_vector and ImageSearch.search_by_vector run
+    sql = text(search_statement(table, ["id"], exact=exact))
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        ids = [row[0] for row in conn.execute(sql, {'number': k, 'search_vector': query})]
+    return ids, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', default='100000,1000000')
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--clusters', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--m', type=int, default=16)
+    parser.add_argument('--ef-construction', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=2000)
+    parser.add_argument('--keep', action='store_true', help="Reuse the tables of a previous run")
+    parser.add_argument('--plan', action='store_true', help="Print the query plan of the indexed search")
+    parser.add_argument('--hostname', default=os.getenv('IRIS_HOSTNAME', 'localhost'))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    engine = get_engine(iris_dsn(hostname=args.hostname))
+    rng = np.random.default_rng(args.seed)
+    centers = rng.standard_normal((args.clusters, args.dim))
+    queries = [vector_string(vector) for vector in synthetic_vectors(rng, centers, args.queries)]
+
+    results = []
+    for rows in [int(n) for n in args.rows.split(',') if n]:
+        table = f"ann_bench_{rows}"
+        if not (args.keep and inspect(engine).has_table(table)):
+            load_table(engine, table, rows, centers, np.random.default_rng(args.seed + rows), args.batch)
+        start = time.perf_counter()
+        create_hnsw_index(engine, table, m=args.m, ef_construction=args.ef_construction, rebuild=not args.keep)
+        build = time.perf_counter() - start
+        try:
+            plan = query_plan(engine, search_statement(table, ["id"]), {'number': args.k, 'search_vector': queries[0]})
+            uses_index = 'yes' if hnsw_index_name(table).lower() in plan.lower() else 'NO'
+        except DBAPIError as exc:
+            plan, uses_index = f"EXPLAIN failed: {exc}", '?'
+        if args.plan:
+            print(plan)
+
+        exact_times, ann_times, recalls = [], [], []
+        for query in queries:
+            exact_ids, seconds = search(engine, table, query, args.k, exact=True)
+            exact_times.append(seconds)
+            ann_ids, seconds = search(engine, table, query, args.k, exact=False)
+            ann_times.append(seconds)
+            recalls.append(len(set(exact_ids) & set(ann_ids)) / len(exact_ids))
+        results.append((rows, build, exact_times, ann_times, recalls, uses_index))
+
+        if not args.keep:
+            with engine.connect() as conn:
+                with conn.begin():
+                    conn.execute(text(f"DROP TABLE {table}"))
+
+    print(f"\n{'rows':>9} {'build (s)':>9} {'exact p50':>10} {'exact p95':>10} {'ann p50':>8} {'ann p95':>8} {'speedup':>8} {f'recall@{args.k}':>10} {'index':>6}")
+    for rows, build, exact_times, ann_times, recalls, uses_index in results:
+        exact_p50, exact_p95 = np.percentile(exact_times, [50, 95]) * 1000
+        ann_p50, ann_p95 = np.percentile(ann_times, [50, 95]) * 1000
+        print(f"{rows:>9} {build:>9.1f} {exact_p50:>8.1f}ms {exact_p95:>8.1f}ms {ann_p50:>6.1f}ms {ann_p95:>6.1f}ms "
+              f"{exact_p50 / ann_p50:>7.1f}x {np.mean(recalls):>10.3f} {uses_index:>6}")
+
+
+if __name__ == "__main__":
+    main()
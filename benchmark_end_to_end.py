@@ -0,0 +1,281 @@
+"""
+End to end latency benchmark of the query scripts.
+
+Drives python_script.search_landmarks with a fixed set of descriptions and
+python_image_script.search_image with the images of data/test_images and
+pau_tests. The LLM answers and the osmnx geocoding are replaced by
+deterministic local stand-ins, and with --local-iris the vector tables are kept
+in memory too, so the numbers only move when the code does. The encoders are
+the real ones. The maps are drawn in a temporary folder, removed at the end,
+and the image results are not cached unless --image-cache, in that folder too.
+
+Reports p50/p95/p99 per stage and end to end, and the peak memory, and saves
+them as JSON. With --baseline, the p95 of every stage is compared with a
+previous run and the script fails when one got slower than --tolerance.
+
+Usage: python benchmark_end_to_end.py [--local-iris] [--repeat N] [--llm-ms MS] [--image-cache]
+                                      [--output FILE] [--baseline FILE] [--tolerance 0.2]
+"""
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+from functools import partial
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+QUERIES = [
+    "A gothic cathedral with tall towers and stained glass",
+    "Roman ruins near the sea",
+    "A modern museum of contemporary art",
+    "A medieval castle on top of a hill",
+    "A famous bridge over a wide river",
+    "An ancient temple in the mountains",
+    "A large park with gardens and fountains",
+    "A royal palace with baroque architecture",
+    "A sunny beach city with warm weather",
+    "A historic old town with narrow streets",
+]
+
+IMAGE_PATTERNS = ['data/test_images/*', 'pau_tests/*.jp*g']
+
+# Stage timings of the current run, in seconds
+stages = defaultdict(float)
+
+
+@contextlib.contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] += time.perf_counter() - start
+
+
+def timed_class(cls, prefix):
+    class Timed(cls):
+        def __init__(self, *args, **kwargs):
+            with stage(f'{prefix}.load'):
+                super().__init__(*args, **kwargs)
+
+        def search_similars(self, *args, **kwargs):
+            with stage(f'{prefix}.search'):
+                return super().search_similars(*args, **kwargs)
+
+    Timed.__name__ = cls.__name__
+    return Timed
+
+
+def with_result_cache(cls, file):
+    # The image results are cached in a file of the run, or not at all, never in the one of the users
+    class Cached(cls):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **{**kwargs, 'result_cache_file': file})
+
+    Cached.__name__ = cls.__name__
+    return Cached
+
+
+def timed_function(func, name):
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def llm_stand_in(llm_ms):
+    def query(self, query_text, use_cache=True, filters=None):
+        with stage('llm'):
+            time.sleep(llm_ms / 1000)
+            return f"Stand-in answer about {filters or 'everything'}: {query_text[:80]}"
+    return query
+
+
+def osmnx_stand_in():
+    # Geocodes every place to the same square, drawn like the real GeoDataFrame
+    class Area:
+        def plot(self, ax=None, facecolor="black"):
+            ax.fill([0, 1, 1, 0], [0, 0, 1, 1], facecolor=facecolor)
+            return ax
+
+    module = types.ModuleType('osmnx')
+    module.geocode_to_gdf = lambda query: Area()
+    return module
+
+
+def local_searches():
+    """
+    CloseSearch and ImageSearch keeping their tables in memory, for runs without IRIS.
+    """
+    from sql_class import CloseSearch
+    from images_class import ImageSearch
+    tables = {}
+
+    class LocalCloseSearch(CloseSearch):
+        def connect_to_database(self):
+            self.engine = None
+
+        def create_monuments_table(self):
+            self.embeddings = self.name in tables and not self.clear
+
+        def insert_data_into_database(self):
+            tables[self.name] = self.vectors if self.vectors is not None else np.array(self.data["description_vector"].tolist())
+
+        def search_by_vector(self, search_vector, filters=None, number=10, columns=None, include_vector=False, **kwargs):
+            from filter_class import as_filter
+            frame = self.data.copy()
+            vectors = tables[self.name]
+            frame["score"] = vectors @ np.asarray(search_vector)
+            if include_vector:
+                frame["description_vector"] = list(vectors)
+            filters = as_filter(filters)
+            if filters is not None:
+                frame = frame[filters.mask(frame)]
+            columns = list(self.columns) if columns is None else list(columns)
+            columns += ["description_vector"] if include_vector else []
+            return frame.sort_values("score", ascending=False).head(number)[columns + ["score"]].reset_index(drop=True)
+
+    class LocalImageSearch(ImageSearch):
+        def connect_to_database(self):
+            self.engine = None
+
+        def create_images_table(self):
+            self.embeddings = self.name in tables and not self.recalculate
+
+        def insert_data_into_database(self):
+            vectors = np.array([embedding.tolist()[0] for embedding in self.image_embeddings])
+            tables[self.name] = (list(self.paths), vectors / np.linalg.norm(vectors, axis=1, keepdims=True))
+
+        def read_table_version(self):
+            return None
+
+        def search_by_vector(self, search_vector, filters=None, number=10, **kwargs):
+            import pandas as pd
+            paths, vectors = tables[self.name]
+            scores = vectors @ (np.asarray(search_vector) / np.linalg.norm(search_vector))
+            order = np.argsort(-scores)[:number]
+            return pd.DataFrame({"monument_name": [self.clean_image_name(paths[i]) for i in order], "score": scores[order]})
+
+    return LocalCloseSearch, LocalImageSearch
+
+
+def percentiles(values):
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(values), 'p50': p50, 'p95': p95, 'p99': p99, 'mean': float(np.mean(values))}
+
+
+def run(name, func, arg, results):
+    stages.clear()
+    start = time.perf_counter()
+    # The scripts print their answer for Electron
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(arg)
+    results[f'{name}.total'].append(time.perf_counter() - start)
+    for stage_name, seconds in stages.items():
+        results[f'{name}.{stage_name}'].append(seconds)
+
+
+def compare(summary, baseline, tolerance):
+    regressions = []
+    for name, stats in summary['latency'].items():
+        before = baseline['latency'].get(name)
+        if before and stats['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95'] * 1000:.1f} ms -> {stats['p95'] * 1000:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--local-iris', action='store_true', help="Keep the vector tables in memory instead of IRIS")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1, help="Runs of each script not measured")
+    parser.add_argument('--llm-ms', type=float, default=0.0, help="Latency of the stand-in LLM")
+    parser.add_argument('--no-images', action='store_true')
+    parser.add_argument('--image-cache', action='store_true',
+                        help="Cache the image results during the run, so the repeats are cache hits")
+    parser.add_argument('--output', default=os.path.join(ROOT, 'benchmark_end_to_end.json'))
+    parser.add_argument('--baseline', default='')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    images = sorted(path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(ROOT, pattern)))
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else ''
+
+    # The scripts open their files relative to electron_app, like when Electron runs them
+    os.chdir(os.path.join(ROOT, 'electron_app'))
+    sys.path.insert(0, ROOT)
+    sys.modules['osmnx'] = osmnx_stand_in()
+    import gpt_class
+    gpt_class.MonumentsSearch.query = llm_stand_in(args.llm_ms)
+    import python_script
+    import python_image_script
+
+    close_search, image_search = local_searches() if args.local_iris else (python_script.CloseSearch, python_image_script.ImageSearch)
+    # The base maps of the stand-in geometry and the maps of the requests go to a folder of the run,
+    # never to data/base_maps, and every run draws the same base maps
+    scratch = tempfile.TemporaryDirectory(prefix='benchmark_end_to_end_')
+    from map_class import MapRenderer, unique_map_path
+    for script in (python_script, python_image_script):
+        script.map_renderer = MapRenderer(directory=os.path.join(scratch.name, 'base_maps'))
+        script.unique_map_path = partial(unique_map_path, os.path.join(scratch.name, 'maps'))
+        script.draw_map = timed_function(script.draw_map, 'map')
+    python_script.CloseSearch = timed_class(close_search, 'close_search')
+    image_cache = os.path.join(scratch.name, 'image_result_cache.sqlite') if args.image_cache else None
+    python_image_script.ImageSearch = timed_class(with_result_cache(image_search, image_cache), 'image_search')
+    if args.local_iris:
+        # No neighbors table without IRIS, the other similar cities come from the image search
+        python_image_script.city_neighbors = types.SimpleNamespace(similar=lambda item, number=None: [])
+
+    workloads = [('text', python_script.search_landmarks, QUERIES)]
+    if not args.no_images:
+        workloads.append(('image', python_image_script.search_image, images))
+
+    results = defaultdict(list)
+    for name, func, inputs in workloads:
+        for arg in inputs[:1] * args.warmup:
+            run(name, func, arg, defaultdict(list))
+        for _ in range(args.repeat):
+            for arg in inputs:
+                run(name, func, arg, results)
+    scratch.cleanup()
+
+    summary = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'queries': len(QUERIES),
+        'images': len(images),
+        # ru_maxrss is in kB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'latency': {name: percentiles(values) for name, values in sorted(results.items())},
+    }
+    with open(output, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"{'stage':<28} {'n':>4} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for name, stats in summary['latency'].items():
+        print(f"{name:<28} {stats['count']:>4} {stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}")
+    print(f"peak RSS: {summary['peak_rss_mb']:.0f} MB, results saved to {output}")
+
+    if baseline:
+        with open(baseline, 'r') as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Check that every html_to_text backend gives the same output as the original
+BeautifulSoup implementation, and measure how many pages per second each one
+extracts.
+
+The pages are rebuilt from the texts in data/city_texts: each Wikipedia text is
+split into paragraphs and decorated with references, so the extracted text has
+to match the saved file exactly. Raw pages saved from the Wikipedia API can be
+added with --html-dir.
+
+Usage: python benchmark_html_to_text.py [--texts-dir DIR] [--html-dir DIR] [--repeat N]
+"""
+import argparse
+import glob
+import html
+import os
+import re
+import sys
+import time
+
+from html_text import html_to_text, available_backends
+from text_corpus import open_corpus
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+
+def legacy_html_to_text(html_content):
+    # The implementation CreateDataCities used before the backends were added
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_content, 'html.parser')
+    text = ''
+    for section in soup.find_all(['h2', 'p']):
+        if section.name == 'h2':
+            text += '\n\n' + section.get_text() + '\n\n'
+        else:
+            text += section.get_text() + ' '
+    text = re.sub(r'\[.*?\]', '', text)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = text.strip()
+    text = text.replace('ⓘ', '')
+    return text
+
+
+def wiki_text(content):
+    """
+    Get the Wikipedia part of a text written by CreateDataCities.save_texts.
+    """
+    content = content.split('\n', 1)[1]
+    return content.rsplit('\n\nWeather information about', 1)[0]
+
+
+def text_to_html(text):
+    """
+    Build a Wikipedia-like page whose extracted text is the given text.
+    """
+    # Runs of spaces in the saved text are where the listen symbol was removed
+    text = re.sub(r' (?= )', ' ⓘ', text)
+    sentences = re.split(r'(?<=\.) ', text)
+    paragraphs = [' '.join(sentences[i:i + 4]) for i in range(0, len(sentences), 4)]
+    body = ''
+    for i, paragraph in enumerate(paragraphs):
+        # A reference next to a stray bracket of the text would be removed together with it
+        reference = '' if '[' in paragraph else f'<sup class="reference"><a href="#cite_note-{i}">[{i}]</a></sup>'
+        body += f'<p>{html.escape(paragraph)}{reference}\n</p>'
+    return f'<div class="mw-parser-output"><table class="infobox"><tr><td>Infobox</td></tr></table>{body}</div>'
+
+
+def synthetic_pages():
+    # Headers, nested markup, comments and the listen symbol, which the rebuilt pages lack
+    return [
+        '<div><h2><span class="mw-headline">History</span><span>[edit]</span></h2>'
+        '<p>The <b>old town</b> ⓘ was founded<sup>[1]</sup> in   the\n<i>12th</i> century.</p>'
+        '<!-- comment --><p>Second <a href="#">paragraph</a>.<sup>[note 2]</sup></p>'
+        '<h2>Geography</h2><ul><li>not a paragraph</li></ul><p>Rivers &amp; hills.</p></div>',
+        '<p>Only one paragraph</p>',
+        '<div><table><tr><td>no text sections</td></tr></table></div>',
+    ]
+
+
+def check_equivalence(pages, expected, backends):
+    failures = 0
+    for backend in backends:
+        for name, (page, exp) in zip(expected.keys(), zip(pages, expected.values())):
+            got = html_to_text(page, backend=backend)
+            legacy = legacy_html_to_text(page)
+            if got != legacy or (exp is not None and got != exp):
+                failures += 1
+                print(f"MISMATCH [{backend}] {name}")
+    return failures
+
+
+def benchmark(pages, backends, repeat):
+    results = {}
+    for backend in ['legacy'] + backends:
+        extract = legacy_html_to_text if backend == 'legacy' else (lambda p, b=backend: html_to_text(p, backend=b))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for page in pages:
+                extract(page)
+        elapsed = time.perf_counter() - start
+        results[backend] = len(pages) * repeat / elapsed
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--texts-dir', default='./data/city_texts')
+    parser.add_argument('--html-dir', default='')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    expected = {}
+    pages = []
+    for text_id, content in open_corpus(args.texts_dir).items():
+        text = wiki_text(content)
+        pages.append(text_to_html(text))
+        expected[text_id] = text
+    for i, page in enumerate(synthetic_pages()):
+        pages.append(page)
+        expected[f'synthetic_{i}'] = None
+    if args.html_dir:
+        for path in sorted(glob.glob(os.path.join(args.html_dir, '*.html'))):
+            with open(path, 'r', encoding='utf-8') as f:
+                pages.append(f.read())
+            expected[os.path.basename(path)] = None
+
+    backends = available_backends()
+    failures = check_equivalence(pages, expected, backends)
+    print(f"Equivalence: {len(pages)} pages x {len(backends)} backends, {failures} mismatches")
+
+    print(f"{'backend':<12} {'pages/s':>10} {'speedup':>8}")
+    results = benchmark(pages, backends, args.repeat)
+    for backend, rate in results.items():
+        print(f"{backend:<12} {rate:>10.1f} {rate / results['legacy']:>7.2f}x")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
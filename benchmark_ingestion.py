@@ -0,0 +1,451 @@
+"""
+Measure the ingestion throughput of the city and landmark builders against
+local stand-ins of the remote APIs.
+
+Every API (Wikipedia, Nominatim, open-elevation, the meteostat bulk files,
+Flickr and the image hosts) gets its own stub HTTP server on localhost, with a
+configurable latency, error rate and rate limit (429 with Retry-After once the
+requests per second go over it). The stubs answer with recorded fixtures: the
+texts of data/city_texts and data/texts, the coordinates of data/data.csv and
+the images of data/downloaded_images, picked by a hash of the name asked for,
+so every run returns the same data.
+
+The builders run through ingestion_pipeline over synthetic lists made by
+repeating the names of data/city_names.inp and data/landmark_names.inp, and
+the report gives the entities per second of every stage, plus the requests,
+errors and 429s every stub served. With --sweep the network stages run again
+with each number of workers, to check that more concurrency actually helps.
+
+Errors are not retried by the builders: an error in a stage that does not
+catch it (e.g. the elevation lookup) stops that run, which is reported too.
+
+Usage: python benchmark_ingestion.py [--entities 1000,10000] [--sweep 1,8,32]
+                                     [--latency wikipedia=80,nominatim=150] [--errors elevation=0.01]
+                                     [--rate-limit nominatim=1] [--workers wiki=16,...] [--save-dir DIR]
+"""
+import argparse
+import contextlib
+import glob
+import gzip
+import io
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+from meteostat.interface.base import Base
+
+from benchmark_html_to_text import text_to_html, wiki_text
+from ingestion_pipeline import IngestionPipeline, add_city_stages, add_landmark_stages, parse_workers
+from text_corpus import open_corpus
+
+# Milliseconds per request
+DEFAULT_LATENCY = {
+    'wikipedia': 50,
+    'nominatim': 50,
+    'elevation': 50,
+    'meteostat': 30,
+    'flickr': 50,
+    'images': 20,
+}
+
+NETWORK_STAGES = ('wiki', 'coordinates', 'weather', 'images')
+
+
+def name_hash(name):
+    return zlib.crc32(name.encode('utf-8'))
+
+
+class Fixtures:
+    def __init__(self, data_dir='./data', max_images=50):
+        """
+        The recorded answers the stubs pick from.
+        """
+        self.city_pages = [text_to_html(wiki_text(content)) for _, content in open_corpus(f"{data_dir}/city_texts").items()]
+        self.extracts = [content for _, content in open_corpus(f"{data_dir}/texts").items()]
+        data = pd.read_csv(f"{data_dir}/data.csv")
+        self.places = list(zip(data['latitude'], data['longitude']))
+        self.images = []
+        for path in sorted(glob.glob(f"{data_dir}/downloaded_images/*.jpg"))[:max_images]:
+            with open(path, 'rb') as f:
+                self.images.append(f.read())
+        if not (self.city_pages and self.extracts and self.places and self.images):
+            raise FileNotFoundError(f"Missing fixtures in {data_dir}.")
+
+    def page(self, title):
+        return self.city_pages[name_hash(title) % len(self.city_pages)]
+
+    def extract(self, title):
+        return self.extracts[name_hash(title) % len(self.extracts)]
+
+    def coordinates(self, query):
+        """
+        A recorded place moved by up to 0.05 degrees, so every name gets its own point.
+        """
+        h = name_hash(query)
+        latitude, longitude = self.places[h % len(self.places)]
+        latitude += ((h >> 8) % 1000 / 1000 - 0.5) / 10
+        longitude += ((h >> 18) % 1000 / 1000 - 0.5) / 10
+        # The precision Nominatim answers with
+        return float(f"{latitude:.7f}"), float(f"{longitude:.7f}")
+
+    @staticmethod
+    def elevation(latitude, longitude):
+        return name_hash(f"{latitude:.5f},{longitude:.5f}") % 600
+
+
+class StubServer:
+    def __init__(self, name, answer, latency_ms=0.0, error_rate=0.0, rate_limit=0.0, jitter=0.5, seed=0):
+        """
+        A threaded HTTP server answering like one of the remote APIs.
+
+        Parameters
+        ----------
+        name : str
+            The API, used in the report.
+
+        answer : callable
+            Takes the parsed URL and its query and returns (status, content type, body).
+
+        latency_ms : float
+            The mean time before answering, varying by +-jitter of it.
+
+        error_rate : float
+            The fraction of requests answered with a 500.
+
+        rate_limit : float
+            The requests per second allowed, 0 for no limit.
+        """
+        self.name = name
+        self.answer = answer
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.tokens = rate_limit
+        self.refilled = time.monotonic()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 256
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, name=f'stub-{name}', daemon=True)
+
+    def allow(self):
+        # Token bucket holding one second of requests
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.refilled) * self.rate_limit)
+            self.refilled = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def handle(self, request):
+        with self.lock:
+            delay = self.latency * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+            failed = self.random.random() < self.error_rate
+        time.sleep(delay)
+
+        if not self.allow():
+            status, content_type, body, headers = 429, 'text/plain', b'Too Many Requests', {'Retry-After': '1'}
+        elif failed:
+            status, content_type, body, headers = 500, 'text/plain', b'Internal Server Error', {}
+        else:
+            url = urlparse(request.path)
+            try:
+                status, content_type, body = self.answer(url, {k: v[0] for k, v in parse_qs(url.query).items()})
+            except Exception as exc:
+                status, content_type, body = 500, 'text/plain', f"Stub error: {exc}".encode('utf-8')
+            headers = {}
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode('utf-8')
+
+        with self.lock:
+            self.counts[status] += 1
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+
+def wikipedia_answer(fixtures, images_url):
+    def answer(url, query):
+        if query.get('list') == 'search':
+            return 200, 'application/json', {'query': {'search': [{'title': query['srsearch'].split(',')[0]}]}}
+        if query.get('action') == 'parse':
+            title = query['page']
+            return 200, 'application/json', {'parse': {'title': title, 'text': {'*': fixtures.page(title)}}}
+        title = query['titles']
+        page = {'pageid': name_hash(title), 'title': title}
+        if query.get('prop') == 'extracts':
+            page['extract'] = fixtures.extract(title)
+        elif query.get('prop') == 'pageimages':
+            page['thumbnail'] = {'source': f"{images_url}/images/{name_hash(title) % len(fixtures.images)}.jpg"}
+        return 200, 'application/json', {'query': {'pages': {str(page['pageid']): page}}}
+    return answer
+
+
+def nominatim_answer(fixtures):
+    def answer(url, query):
+        latitude, longitude = fixtures.coordinates(query['q'])
+        return 200, 'application/json', [{
+            'place_id': name_hash(query['q']),
+            'lat': f"{latitude:.7f}",
+            'lon': f"{longitude:.7f}",
+            'display_name': query['q'],
+        }]
+    return answer
+
+
+def elevation_answer(fixtures):
+    def answer(url, query):
+        latitude, longitude = (float(x) for x in query['locations'].split(','))
+        return 200, 'application/json', {'results': [{'latitude': latitude, 'longitude': longitude,
+                                                      'elevation': fixtures.elevation(latitude, longitude)}]}
+    return answer
+
+
+def gzip_csv(rows):
+    buffer = io.StringIO()
+    pd.DataFrame(rows).to_csv(buffer, header=False, index=False)
+    return gzip.compress(buffer.getvalue().encode('utf-8'))
+
+
+def meteostat_answer(fixtures, places):
+    """
+    The bulk files: one station on every place, with two years of monthly data.
+    """
+    today = pd.Timestamp.now().normalize()
+    stations = gzip_csv([{
+        'id': f"S{i:05d}", 'name': f"Station {i}", 'country': 'XX', 'region': '', 'wmo': '', 'icao': '',
+        'latitude': latitude, 'longitude': longitude, 'elevation': fixtures.elevation(latitude, longitude),
+        'timezone': 'UTC', 'hourly_start': '', 'hourly_end': '', 'daily_start': '', 'daily_end': '',
+        'monthly_start': (today - pd.DateOffset(years=2)).date(), 'monthly_end': today.date(),
+    } for i, (latitude, longitude) in enumerate(places)])
+    months = pd.date_range(today - pd.DateOffset(years=2), today, freq='MS')
+
+    def monthly(station):
+        rng = random.Random(station)
+        rows = []
+        for month in months:
+            tavg = 12 + 10 * math.cos((month.month - 7) * math.pi / 6) + rng.uniform(-2, 2)
+            rows.append({'year': month.year, 'month': month.month, 'tavg': round(tavg, 1),
+                         'tmin': round(tavg - 5, 1), 'tmax': round(tavg + 5, 1), 'prcp': round(rng.uniform(0, 120), 1),
+                         'wspd': round(rng.uniform(5, 25), 1), 'pres': 1013.0, 'tsun': ''})
+        return gzip_csv(rows)
+
+    def answer(url, query):
+        path = url.path.strip('/')
+        if path == 'stations/slim.csv.gz':
+            return 200, 'application/gzip', stations
+        if path.startswith('monthly/') and not path.endswith('.map.csv.gz'):
+            return 200, 'application/gzip', monthly(path.removeprefix('monthly/').removesuffix('.csv.gz'))
+        return 404, 'text/plain', b'Not Found'
+    return answer
+
+
+def flickr_answer(fixtures, images_url):
+    def answer(url, query):
+        page, per_page = int(query.get('page', 1)), int(query.get('per_page', 100))
+        h = name_hash(query['text'])
+        photos = [{'id': str(page * per_page + k), 'title': query['text'],
+                   'url_l': f"{images_url}/images/{(h + k) % len(fixtures.images)}.jpg"}
+                  for k in range(per_page)]
+        return 200, 'application/json', {'photos': {'page': page, 'perpage': per_page, 'photo': photos}, 'stat': 'ok'}
+    return answer
+
+
+def images_answer(fixtures):
+    def answer(url, query):
+        index = int(os.path.basename(url.path).split('.')[0])
+        return 200, 'image/jpeg', fixtures.images[index % len(fixtures.images)]
+    return answer
+
+
+def synthetic_names(path, n):
+    """
+    The first n names of the list, repeated with a number once it runs out.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    names = []
+    for i in range(n):
+        first, *rest = [part.strip() for part in lines[i % len(lines)].split(',')]
+        copy = i // len(lines)
+        names.append(', '.join([f"{first} {copy}" if copy else first] + rest))
+    return names
+
+
+def point_builders(stubs, *builders):
+    for builder in builders:
+        if builder is None:
+            continue
+        builder.URL = f"{stubs['wikipedia'].url}/w/api.php"
+        builder.NOMINATIM_DOMAIN = stubs['nominatim'].url.removeprefix('http://')
+        builder.NOMINATIM_SCHEME = 'http'
+        # The stub limits the requests itself with --rate-limit
+        builder.NOMINATIM_RATE = None
+        builder.ELEVATION_URL = f"{stubs['elevation'].url}/api/v1/lookup"
+        builder.FLICKR_URL = f"{stubs['flickr'].url}/services/rest/"
+
+
+def run_pipeline(cities_file, landmarks_file, save_dir, stubs, workers, images_from):
+    # A fresh cache, so every run downloads its weather files
+    Base.cache_dir = tempfile.mkdtemp(prefix='meteostat-')
+    pipeline = IngestionPipeline()
+    cities = add_city_stages(pipeline, cities_file, save_dir, workers=workers) if cities_file else None
+    landmarks = (add_landmark_stages(pipeline, landmarks_file, save_dir, images_from=images_from, workers=workers)
+                 if landmarks_file else None)
+    point_builders(stubs, cities, landmarks)
+
+    for stub in stubs.values():
+        stub.reset()
+    error = None
+    # The builders print a line per entity
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            pipeline.run()
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+    shutil.rmtree(Base.cache_dir, ignore_errors=True)
+    return pipeline, error
+
+
+def report(pipeline, stubs, error):
+    pipeline.seconds = pipeline.seconds or time.perf_counter() - pipeline.start
+    pipeline.report()
+    if error:
+        print(f"FAILED after {pipeline.seconds:.2f} s: {error}")
+    print(f"\n{'api':<10} {'requests':>8} {'ok':>6} {'errors':>6} {'429':>6}")
+    for name, stub in stubs.items():
+        counts = stub.counts
+        total = sum(counts.values())
+        errors = sum(count for status, count in counts.items() if status >= 500)
+        print(f"{name:<10} {total:>8} {counts[200]:>6} {errors:>6} {counts[429]:>6}")
+
+
+def parse_settings(value):
+    settings = {}
+    for pair in filter(None, value.split(',')):
+        name, number = pair.split('=')
+        if name.strip() not in DEFAULT_LATENCY:
+            raise ValueError(f"Unknown API {name}. Choose from {list(DEFAULT_LATENCY)}.")
+        settings[name.strip()] = float(number)
+    return settings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entities', default='1000', help="Comma separated sizes of the synthetic lists")
+    parser.add_argument('--cities', action='store_true', help="Only build the cities (both by default)")
+    parser.add_argument('--landmarks', action='store_true', help="Only build the landmarks (both by default)")
+    parser.add_argument('--images-from', default='flickr', choices=['flickr', 'wiki'])
+    parser.add_argument('--latency', default='', help="Comma separated api=ms, e.g. wikipedia=80,nominatim=150")
+    parser.add_argument('--jitter', type=float, default=0.5, help="Latency variation, as a fraction of it")
+    parser.add_argument('--errors', default='', help="Comma separated api=fraction of 500 answers")
+    parser.add_argument('--rate-limit', default='', help="Comma separated api=requests per second")
+    parser.add_argument('--workers', default='', help="Comma separated stage=threads, e.g. wiki=16,images=4")
+    parser.add_argument('--sweep', default='', help="Comma separated threads for all the network stages")
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('--save-dir', default='', help="Keep the built datasets here instead of a temporary folder")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    latency = {**DEFAULT_LATENCY, **parse_settings(args.latency)}
+    errors, rate_limit = parse_settings(args.errors), parse_settings(args.rate_limit)
+    sizes = [int(n) for n in args.entities.split(',') if n]
+    both = not args.cities and not args.landmarks
+    fixtures = Fixtures(args.data_dir)
+    work_dir = tempfile.mkdtemp(prefix='ingestion-')
+
+    lists = {}
+    for n in sizes:
+        lists[n] = (synthetic_names(f"{args.data_dir}/city_names.inp", n) if args.cities or both else [],
+                    synthetic_names(f"{args.data_dir}/landmark_names.inp", n) if args.landmarks or both else [])
+    city_places = {fixtures.coordinates(city) for cities, _ in lists.values() for city in cities}
+
+    def stub(name, answer):
+        return StubServer(name, answer, latency[name], errors.get(name, 0.0), rate_limit.get(name, 0.0),
+                          args.jitter, args.seed).start()
+
+    stubs = {'images': stub('images', images_answer(fixtures))}
+    stubs['wikipedia'] = stub('wikipedia', wikipedia_answer(fixtures, stubs['images'].url))
+    stubs['nominatim'] = stub('nominatim', nominatim_answer(fixtures))
+    stubs['elevation'] = stub('elevation', elevation_answer(fixtures))
+    stubs['meteostat'] = stub('meteostat', meteostat_answer(fixtures, sorted(city_places)))
+    stubs['flickr'] = stub('flickr', flickr_answer(fixtures, stubs['images'].url))
+
+    Base.endpoint = f"{stubs['meteostat'].url}/"
+
+    configs = [parse_workers(args.workers)]
+    for n in [int(n) for n in args.sweep.split(',') if n]:
+        configs.append({**configs[0], **{stage: n for stage in NETWORK_STAGES}})
+
+    try:
+        for n, (cities, landmarks) in lists.items():
+            files = []
+            for kind, names in (('city', cities), ('landmark', landmarks)):
+                path = ''
+                if names:
+                    path = os.path.join(work_dir, f"{kind}_names_{n}.inp")
+                    with open(path, 'w', encoding='utf-8') as f:
+                        f.write('\n'.join(names))
+                files.append(path)
+
+            for workers in configs:
+                save_dir = args.save_dir or tempfile.mkdtemp(dir=work_dir)
+                print(f"\n=== {n} entities, workers {workers or 'default'} ===")
+                pipeline, error = run_pipeline(*files, save_dir, stubs, workers, args.images_from)
+                report(pipeline, stubs, error)
+    finally:
+        for server in stubs.values():
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
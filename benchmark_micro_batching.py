@@ -0,0 +1,63 @@
+"""
+Measure the encoding throughput of concurrent users with and without micro-batching.
+
+Every simulated user sends its queries one after the other through a
+MicroBatcher running MiniLM; with a max batch size of 1 this is the same as
+encoding every request on its own. The database is not involved.
+
+Usage: python benchmark_micro_batching.py [--users 1,10,50,100] [--queries 10]
+                                          [--max-batch-size 32] [--max-wait-ms 5]
+"""
+import argparse
+import asyncio
+import time
+
+import pandas as pd
+
+from inference_service import MicroBatcher
+from model_store import ModelStore
+
+
+async def run_users(model, texts, users, queries, max_batch_size, max_wait_ms):
+    batcher = MicroBatcher(lambda batch: model.encode(batch, batch_size=len(batch), normalize_embeddings=True).tolist(),
+                           max_batch_size, max_wait_ms)
+    latencies = []
+
+    async def user(u):
+        for q in range(queries):
+            start = time.perf_counter()
+            await batcher.submit(texts[(u * queries + q) % len(texts)])
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(u) for u in range(users)))
+    seconds = time.perf_counter() - start
+    await batcher.close()
+    sizes = [stats['size'] for stats in batcher.stats]
+    return users * queries / seconds, pd.Series(latencies).quantile([0.5, 0.95]).tolist(), sum(sizes) / len(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default='1,10,50,100')
+    parser.add_argument('--queries', type=int, default=10, help="Queries per user")
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--file', default='./data/data.csv')
+    args = parser.parse_args()
+
+    model = ModelStore().sentence_transformer('all-MiniLM-L6-v2')
+    data = pd.read_csv(args.file)
+    texts = [f"{row.landmark} in {row.city}, {row.country}" for row in data.itertuples()]
+    model.encode(texts[:8])  # Warm up
+
+    print(f"{'users':>5} {'max batch':>9} {'queries/s':>10} {'p50 (ms)':>9} {'p95 (ms)':>9} {'mean batch':>10}")
+    for users in [int(n) for n in args.users.split(',') if n]:
+        for max_batch_size in (1, args.max_batch_size):
+            rate, (p50, p95), mean_batch = asyncio.run(
+                run_users(model, texts, users, args.queries, max_batch_size, args.max_wait_ms))
+            print(f"{users:>5} {max_batch_size:>9} {rate:>10.1f} {p50 * 1000:>9.1f} {p95 * 1000:>9.1f} {mean_batch:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
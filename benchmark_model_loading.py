@@ -0,0 +1,112 @@
+"""
+Compare loading the encoders from their original checkpoints with loading them
+from the memory-mapped ModelStore.
+
+For every model and mode, --workers processes are started at the same time. Each
+one loads the model and computes one embedding; the time to the first embedding
+is measured inside the worker. Once all the workers are loaded, their memory is
+read from /proc (Linux only): RSS counts the shared pages in every process, PSS
+splits them between the processes sharing them, so its total is the real cost
+of the workers on the host.
+
+The store is filled before the measures, so its first download is not counted.
+
+Usage: python benchmark_model_loading.py [--models resnet152,minilm] [--workers N]
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from model_store import ModelStore, MODELS_DIR
+
+MODELS = ['resnet152', 'minilm']
+
+
+def load(model, mode, models_dir):
+    if model == 'resnet152':
+        if mode == 'store':
+            return ModelStore(models_dir).resnet152()
+        from torchvision import models
+        return models.resnet152(pretrained=True).eval()
+    if mode == 'store':
+        return ModelStore(models_dir).sentence_transformer('all-MiniLM-L6-v2')
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer('all-MiniLM-L6-v2')
+
+
+def embed(model_name, model):
+    import torch
+    with torch.no_grad():
+        if model_name == 'resnet152':
+            return model(torch.zeros(1, 3, 224, 224))
+        return model.encode("Sagrada Familia", normalize_embeddings=True)
+
+
+def memory(pid):
+    """
+    Get the memory of a process in MB.
+    """
+    values = {}
+    for file in ('status', 'smaps_rollup'):
+        with open(f'/proc/{pid}/{file}', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    values[key] = int(value.split()[0]) / 1024
+    return {'rss': values.get('VmRSS', 0), 'pss': values.get('Pss', 0)}
+
+
+def worker(model, mode, models_dir):
+    start = time.perf_counter()
+    embed(model, load(model, mode, models_dir))
+    print(json.dumps({'seconds': time.perf_counter() - start}), flush=True)
+    # Stay alive until every worker is loaded, so the shared pages are counted once
+    sys.stdin.readline()
+
+
+def run_workers(model, mode, workers, models_dir):
+    processes = [subprocess.Popen([sys.executable, __file__, '--worker', model, mode, '--models-dir', models_dir],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                 for _ in range(workers)]
+    results = []
+    try:
+        for process in processes:
+            line = process.stdout.readline()
+            if not line:
+                raise RuntimeError(f"A {mode} worker for {model} failed.")
+            results.append({**json.loads(line), **memory(process.pid)})
+    finally:
+        for process in processes:
+            process.stdin.close()
+            process.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', default=','.join(MODELS))
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--models-dir', default=MODELS_DIR)
+    parser.add_argument('--worker', nargs=2, metavar=('MODEL', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(*args.worker, args.models_dir)
+        return
+
+    print(f"{'model':<10} {'mode':<8} {'first emb (s)':>13} {'RSS/worker (MB)':>15} {'PSS total (MB)':>14}")
+    for model in filter(None, args.models.split(',')):
+        # Fill the store
+        load(model, 'store', args.models_dir)
+        for mode in ('original', 'store'):
+            results = run_workers(model, mode, args.workers, args.models_dir)
+            seconds = sum(result['seconds'] for result in results) / len(results)
+            rss = sum(result['rss'] for result in results) / len(results)
+            pss = sum(result['pss'] for result in results)
+            print(f"{model:<10} {mode:<8} {seconds:>13.2f} {rss:>15.0f} {pss:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
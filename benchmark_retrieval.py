@@ -0,0 +1,198 @@
+"""
+Measure the quality of the search results together with their latency, so a
+faster search configuration can be checked for worse results.
+
+The labelled queries of data/eval_queries.json are run through every
+configuration: descriptions mapped to the expected landmarks (data/data.csv)
+and cities (data/city.csv), and the photos of data/test_images mapped to
+their city (data/city_images). For every dataset and configuration the report
+gives recall@k, the MRR and the per query latency, encoding included, and
+marks the configurations on the Pareto front: those no other configuration
+beats on MRR, recall and p95 latency at once.
+
+A configuration is a name with the arguments of the searcher and of
+search_similars, e.g. {"ann": {"init": {"ann_index": true}, "search": {}}},
+optionally limited to some "kinds" of dataset ("text" or "image");
+more can be added with --configs-file. --local-iris keeps the tables in
+memory like benchmark_end_to_end, where the ANN configurations are skipped.
+
+Usage: python benchmark_retrieval.py [--datasets landmarks,cities,images] [--configs exact,ann,hybrid]
+                                     [--configs-file FILE] [--k 1,5,10] [--local-iris] [--output FILE]
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+CONFIGS = {
+    'exact': {'init': {}, 'search': {'exact': True}},
+    'ann': {'init': {'ann_index': True}, 'search': {}},
+    # Only the text searches have a keyword index
+    'hybrid': {'init': {'keyword_index': True}, 'search': {'hybrid': True, 'candidates': 100}, 'kinds': ['text']},
+}
+
+# The searcher of every dataset and the column holding the labels
+DATASETS = {
+    'landmarks': {'kind': 'text', 'init': {'file': 'data/data.csv', 'name': 'monuments', 'textual_var': 'wiki_content'},
+                  'column': 'landmark'},
+    'cities': {'kind': 'text', 'init': {'file': 'data/city.csv', 'name': 'city', 'textual_var': 'wiki_content'},
+               'column': 'city'},
+    'images': {'kind': 'image', 'init': {'folder': 'data/city_images/*', 'name': 'cities'},
+               'column': 'monument_name'},
+}
+
+
+def load_queries(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def build_searcher(dataset, init, local_iris=False):
+    if local_iris:
+        from benchmark_end_to_end import local_searches
+        close_search, image_search = local_searches()
+    else:
+        from sql_class import CloseSearch as close_search
+        from images_class import ImageSearch as image_search
+    spec = DATASETS[dataset]
+    kwargs = {**spec['init'], **init}
+    for key in ('file', 'folder'):
+        if key in kwargs:
+            kwargs[key] = os.path.join(ROOT, kwargs[key])
+    return (close_search if spec['kind'] == 'text' else image_search)(**kwargs)
+
+
+def labels(searcher, results, column):
+    names = results[column].tolist()
+    if column == 'monument_name':
+        # The image tables keep the path of the image
+        names = [searcher.clean_image_name(os.path.splitext(name)[0]) for name in names]
+    return [str(name).strip().lower() for name in names]
+
+
+def query_input(entry, kind):
+    # The image queries are paths relative to the repository
+    return os.path.join(ROOT, entry['query']) if kind == 'image' else entry['query']
+
+
+def evaluate(searcher, queries, kind, column, ks, search):
+    """
+    Run the queries, keeping the rank of the expected results and the latency.
+
+    Returns
+    -------
+    dict
+        recall@k for every k, mrr and the latencies in seconds.
+    """
+    depth = max(ks)
+    recalls = {k: [] for k in ks}
+    reciprocal_ranks = []
+    latencies = []
+    for entry in queries:
+        start = time.perf_counter()
+        results = searcher.search_similars(query_input(entry, kind), number=depth, **search)
+        latencies.append(time.perf_counter() - start)
+
+        found = labels(searcher, results, column)
+        expected = {name.lower() for name in entry['expected']}
+        ranks = [rank for rank, name in enumerate(found, 1) if name in expected]
+        for k in ks:
+            recalls[k].append(len(expected & set(found[:k])) / len(expected))
+        reciprocal_ranks.append(1 / ranks[0] if ranks else 0.0)
+
+    p50, p95 = np.percentile(latencies, [50, 95])
+    return {
+        'queries': len(queries),
+        'recall': {k: float(np.mean(values)) for k, values in recalls.items()},
+        'mrr': float(np.mean(reciprocal_ranks)),
+        'p50': float(p50),
+        'p95': float(p95),
+        'mean': float(np.mean(latencies)),
+    }
+
+
+def pareto(rows, k):
+    """
+    Mark the rows no other row of the same dataset dominates.
+    """
+    for row in rows:
+        row['pareto'] = not any(
+            other is not row and other['dataset'] == row['dataset']
+            and other['mrr'] >= row['mrr'] and other['recall'][k] >= row['recall'][k] and other['p95'] <= row['p95']
+            and (other['mrr'], other['recall'][k], -other['p95']) != (row['mrr'], row['recall'][k], -row['p95'])
+            for other in rows)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', default=os.path.join(ROOT, 'data', 'eval_queries.json'))
+    parser.add_argument('--datasets', default=','.join(DATASETS))
+    parser.add_argument('--configs', default=','.join(CONFIGS), help="Comma separated names of configurations")
+    parser.add_argument('--configs-file', default='', help="JSON with more configurations, by name")
+    parser.add_argument('--k', default='1,5,10', help="Comma separated cutoffs of recall@k")
+    parser.add_argument('--warmup', type=int, default=1, help="Queries run before measuring")
+    parser.add_argument('--local-iris', action='store_true', help="Keep the vector tables in memory instead of IRIS")
+    parser.add_argument('--output', default='', help="Also save the results as JSON")
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    configs = dict(CONFIGS)
+    if args.configs_file:
+        with open(args.configs_file, 'r') as f:
+            configs.update(json.load(f))
+    names = [name for name in args.configs.split(',') if name]
+    unknown = [name for name in names if name not in configs]
+    if unknown:
+        raise ValueError(f"Unknown configurations {unknown}. Choose from {list(configs)}.")
+    ks = sorted(int(k) for k in args.k.split(',') if k)
+
+    # The searchers open their files relative to the repository
+    os.chdir(ROOT)
+    rows = []
+    for dataset in [name for name in args.datasets.split(',') if name]:
+        spec = DATASETS[dataset]
+        path = spec['init'].get('file')
+        if path and not os.path.exists(path):
+            print(f"Skipping {dataset}: {path} not found.")
+            continue
+        searchers = {}
+        for name in names:
+            init, search = configs[name].get('init', {}), configs[name].get('search', {})
+            if spec['kind'] not in configs[name].get('kinds', ['text', 'image']):
+                continue
+            if args.local_iris and init.get('ann_index'):
+                print(f"Skipping {dataset}/{name}: the in-memory tables have no ANN index.")
+                continue
+            # Configurations differing only in their search arguments share the searcher
+            key = json.dumps(init, sort_keys=True)
+            if key not in searchers:
+                searchers[key] = build_searcher(dataset, init, args.local_iris)
+            searcher = searchers[key]
+            for entry in queries[dataset][:args.warmup]:
+                searcher.search_similars(query_input(entry, spec['kind']), number=max(ks), **search)
+            result = evaluate(searcher, queries[dataset], spec['kind'], spec['column'], ks, search)
+            rows.append({'dataset': dataset, 'config': name, **result})
+
+    if not rows:
+        return
+    k = ks[-1]
+    pareto(rows, k)
+    recall_headers = ' '.join(f"{f'R@{n}':>6}" for n in ks)
+    print(f"\n{'dataset':<10} {'config':<16} {'n':>4} {recall_headers} {'MRR':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} {'pareto':>6}")
+    for row in sorted(rows, key=lambda row: (row['dataset'], row['p95'])):
+        recall_values = ' '.join(f"{row['recall'][n]:>6.3f}" for n in ks)
+        print(f"{row['dataset']:<10} {row['config']:<16} {row['queries']:>4} {recall_values} {row['mrr']:>6.3f} "
+              f"{row['p50'] * 1000:>9.1f} {row['p95'] * 1000:>9.1f} {'*' if row['pareto'] else '':>6}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'k': ks, 'configs': {name: configs[name] for name in names}, 'results': rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
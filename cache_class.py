@@ -0,0 +1,219 @@
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+
+class ResponseCache:
+    def __init__(self, file="../data/response_cache.sqlite", max_entries=10000, max_age_days=None):
+        """
+        Persistent cache of LLM answers, stored in a SQLite file.
+
+        Parameters
+        ----------
+        file : str
+            The path of the SQLite file.
+
+        max_entries : int
+            The number of answers kept. The least recently used ones are evicted first.
+
+        max_age_days : float
+            Answers older than this are treated as missing. None keeps them forever.
+        """
+        self.file = file
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        directory = os.path.dirname(file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    prompt TEXT,
+                    response TEXT,
+                    created REAL,
+                    last_access REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            # The version of every index, saved when it is built, so a lookup doesn't have to hash its texts
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS index_versions (
+                    name TEXT PRIMARY KEY,
+                    version TEXT,
+                    updated REAL
+                )
+            """)
+
+    @contextmanager
+    def connect(self):
+        # One connection per call, so the cache can be shared between threads
+        conn = sqlite3.connect(self.file, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def key(model, prompt, index_version):
+        return hashlib.sha256(f"{model}\x00{index_version}\x00{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Get a cached answer.
+
+        Returns
+        -------
+        str
+            The answer, or None if it is not cached or has expired.
+        """
+        now = time.time()
+        with self.connect() as conn:
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, created = row
+            if self.max_age_days is not None and now - created > self.max_age_days * 86400:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return response
+
+    def put(self, key, response, model='', prompt=''):
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, model, prompt, response, now, now))
+            conn.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+    def get_version(self, name):
+        """
+        Get the version saved for an index, or None.
+        """
+        with self.connect() as conn:
+            row = conn.execute("SELECT version FROM index_versions WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_version(self, name, version):
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO index_versions VALUES (?, ?, ?)", (name, version, time.time()))
+
+    def __len__(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def clear(self):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+
+class ImageResultCache:
+    def __init__(self, file="../data/image_result_cache.sqlite", max_entries=1000, max_distance=4):
+        """
+        Persistent cache of image search results, keyed on the perceptual hash of the image.
+
+        Parameters
+        ----------
+        file : str
+            The path of the SQLite file.
+
+        max_entries : int
+            The number of results kept. The least recently used ones are evicted first.
+
+        max_distance : int
+            The bits the hash of an image can differ from a cached one and still get
+            its results, e.g. for the same photo resized or recompressed. 0 for exact matches.
+        """
+        self.file = file
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        directory = os.path.dirname(file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS image_results (
+                    key TEXT PRIMARY KEY,
+                    source TEXT,
+                    params TEXT,
+                    hash TEXT,
+                    results TEXT,
+                    created REAL,
+                    last_access REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS image_results_source ON image_results (source, params)")
+            conn.execute("CREATE INDEX IF NOT EXISTS image_results_last_access ON image_results (last_access)")
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.file, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def key(table, params, image_hash):
+        # The results of an image depend on the table searched and on the arguments of the search
+        return f"{table}\x00{params}\x00{image_hash:016x}"
+
+    def get(self, table, params, image_hash):
+        """
+        Get the cached results of the closest image to image_hash.
+
+        Returns
+        -------
+        str
+            The results as saved, or None if no image is within max_distance bits.
+        """
+        from image_hash import hamming_many
+        with self.connect() as conn:
+            row = conn.execute("SELECT key FROM image_results WHERE key = ?", (self.key(table, params, image_hash),)).fetchone()
+            if row is None and self.max_distance:
+                rows = conn.execute("SELECT key, hash FROM image_results WHERE source = ? AND params = ?",
+                                    (table, params)).fetchall()
+                if rows:
+                    distances = hamming_many(image_hash, [int(value, 16) for _, value in rows])
+                    closest = int(distances.argmin())
+                    row = rows[closest] if distances[closest] <= self.max_distance else None
+            if row is None:
+                return None
+            conn.execute("UPDATE image_results SET last_access = ? WHERE key = ?", (time.time(), row[0]))
+            return conn.execute("SELECT results FROM image_results WHERE key = ?", (row[0],)).fetchone()[0]
+
+    def put(self, table, params, image_hash, results):
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO image_results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (self.key(table, params, image_hash), table, params, f"{image_hash:016x}", results, now, now))
+            conn.execute("""
+                DELETE FROM image_results WHERE key IN (
+                    SELECT key FROM image_results ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+    def __len__(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM image_results").fetchone()[0]
+
+    def clear(self, table=None):
+        """
+        Remove the results of a table, of all its versions, e.g. once its images are indexed again, or all of them.
+        """
+        with self.connect() as conn:
+            if table is None:
+                conn.execute("DELETE FROM image_results")
+            else:
+                # ImageSearch saves them as table@version
+                conn.execute("DELETE FROM image_results WHERE source = ? OR substr(source, 1, ?) = ?",
+                             (table, len(table) + 1, table + '@'))
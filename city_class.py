@@ -1,15 +1,15 @@
 import geopy
 import pandas as pd
 import time
-import os
 import numpy as np
 import requests
-from bs4 import BeautifulSoup
 from meteostat import Monthly, Point
-import re
+from html_text import html_to_text
+from parallel import parallel_map, wait_for
+from text_corpus import CorpusWriter, corpus_path
 
 class CreateDataCities:
-	def __init__(self, cities_file: str, save_dir: str, from_csv: str = ''):
+	def __init__(self, cities_file: str, save_dir: str, from_csv: str = '', html_backend: str = None, run: bool = True):
 		"""
 		Parameters
 		----------
@@ -21,25 +21,37 @@ class CreateDataCities:
 
 		from_csv : str
 			The path to the csv file containing the precalculated dataset.
+
+		html_backend : str
+			The parser used to extract text from Wikipedia pages. Defaults to the fastest installed one.
+
+		run : bool
+			Whether to run the whole pipeline right away. Use False to run the stages one by one.
 		"""
 		self.cities_file: str = cities_file
 		self.from_csv: str = from_csv
 		self.save_dir: str = save_dir.removesuffix('/')
 		self.URL: str = "https://en.wikipedia.org/w/api.php"
+		self.NOMINATIM_DOMAIN: str = "nominatim.openstreetmap.org"
+		self.NOMINATIM_SCHEME: str = "https"
+		# Requests per second to Nominatim, shared with every builder geocoding on the same domain
+		self.NOMINATIM_RATE: float = 1.0
+		self.ELEVATION_URL: str = "https://api.open-elevation.com/api/v1/lookup"
+		self.html_backend: str = html_backend
+
+		if run:
+			self.run()
 
-		if not from_csv:
+	def run(self):
+		"""
+		Run all the stages in sequence.
+		"""
+		if not self.from_csv:
 			self.cities, self.countries = self.get_data_cities()
 			self.coordinates: dict = self.get_coordinates()
 			self.wikipedia_data: dict = self.get_data_wikipedia()
 		else:
-			self.df = pd.read_csv(from_csv)
-			self.cities = self.df['city'].tolist()
-			self.countries = self.df['country'].tolist()
-			self.coordinates = {'latitude': self.df['latitude'].tolist(), 'longitude': self.df['longitude'].tolist(), 'altitude': self.df['altitude'].tolist()}
-			self.wikipedia_data = {city: {'content': self.df[self.df['city'] == city]['wiki_content'].values[0],
-										  'title': self.df[self.df['city'] == city]['wiki_title'].values[0]}
-								   for city in self.cities}
-			
+			self.load_csv()
 			
 		self.get_anual_weather_data()
 
@@ -47,6 +59,18 @@ class CreateDataCities:
 		
 		self.save_texts()
 
+	def load_csv(self):
+		"""
+		Load the cities, coordinates and Wikipedia data from the precalculated dataset.
+		"""
+		self.df = pd.read_csv(self.from_csv)
+		self.cities = self.df['city'].tolist()
+		self.countries = self.df['country'].tolist()
+		self.coordinates = {'latitude': self.df['latitude'].tolist(), 'longitude': self.df['longitude'].tolist(), 'altitude': self.df['altitude'].tolist()}
+		self.wikipedia_data = {city: {'content': self.df[self.df['city'] == city]['wiki_content'].values[0],
+									  'title': self.df[self.df['city'] == city]['wiki_title'].values[0]}
+							   for city in self.cities}
+
 	def get_data_cities(self):
 		"""
 		Get the data from the file containing the cities.
@@ -75,41 +99,55 @@ class CreateDataCities:
 
 		return cities, countries
 
-	def get_coordinates(self):
+	def get_coordinates(self, workers: int = 1):
 		"""
 		Get the coordinates of the cities.
 
+		Parameters
+		----------
+		workers : int
+			The number of cities to geocode at the same time.
+
 		Returns
 		-------
 		dict
 			The dictionary of the locations.
 		"""
-		geolocator = geopy.Nominatim(user_agent="cities", timeout=10)
-		coordinates = {'latitude': [], 'longitude': [], 'altitude': []}
-		for city, country in zip(self.cities, self.countries):
-			print(f"Getting coordinates for {city}...")
-			location = geolocator.geocode(f"{city}, {country}")
-			if location is None:
-				print(f"Location not found for {city}.")
-				coordinates['latitude'].append(None)
-				coordinates['longitude'].append(None)
-				coordinates['altitude'].append(None)
-			else:
-				longitude = location.longitude
-				latitude = location.latitude
-				coordinates['latitude'].append(latitude)
-				coordinates['longitude'].append(longitude)
-				
-				query = ('https://api.open-elevation.com/api/v1/lookup'
-						f'?locations={latitude},{longitude}')
-				r = requests.get(query).json()  # json object, various ways you can extract value
-				# one approach is to use pandas json functionality:
-				altitude = r['results'][0]['elevation']
-
-				coordinates['altitude'].append(altitude)
+		geolocator = geopy.Nominatim(user_agent="cities", timeout=10, domain=self.NOMINATIM_DOMAIN, scheme=self.NOMINATIM_SCHEME)
+		locations = parallel_map(lambda pair: self.get_location(geolocator, *pair), zip(self.cities, self.countries), workers)
+		coordinates = {'latitude': [l[0] for l in locations],
+					   'longitude': [l[1] for l in locations],
+					   'altitude': [l[2] for l in locations]}
 
 		return coordinates
 
+	def get_location(self, geolocator, city: str, country: str):
+		"""
+		Get the latitude, longitude and altitude of a city.
+
+		Returns
+		-------
+		tuple
+			The coordinates, or None values if the city is not found.
+		"""
+		print(f"Getting coordinates for {city}...")
+		wait_for(self.NOMINATIM_DOMAIN, self.NOMINATIM_RATE)
+		location = geolocator.geocode(f"{city}, {country}")
+		if location is None:
+			print(f"Location not found for {city}.")
+			return None, None, None
+
+		longitude = location.longitude
+		latitude = location.latitude
+		
+		query = (f'{self.ELEVATION_URL}'
+				f'?locations={latitude},{longitude}')
+		r = requests.get(query).json()  # json object, various ways you can extract value
+		# one approach is to use pandas json functionality:
+		altitude = r['results'][0]['elevation']
+
+		return latitude, longitude, altitude
+
 	def search_wikipedia(self, city: str):
 		"""
 		Search for a Wikipedia page by title and return the best match.
@@ -144,30 +182,20 @@ class CreateDataCities:
 			return None
 		
 	def html_to_text(self, html_content):
-		soup = BeautifulSoup(html_content, 'html.parser')
-		text = ''
-		for section in soup.find_all(['h2', 'p']):
-			if section.name == 'h2':
-				text += '\n\n' + section.get_text() + '\n\n'  # Add extra newlines for headers
-			else:
-				text += section.get_text() + ' '
-
-		# Remove references in square brackets
-		text = re.sub(r'\[.*?\]', '', text)
-
-		# Remove multiple spaces
-		text = re.sub(r'\s+', ' ', text)
-
-		# Remove triple or larger newlines and replace with double newlines
-		text = re.sub(r'\n{3,}', '\n\n', text)
-
-		# Remove leading and trailing spaces
-		text = text.strip()
+		"""
+		Convert the HTML of a Wikipedia page to plain text.
 
-		# Remove ⓘ symbol
-		text = text.replace('ⓘ', '')
+		Parameters
+		----------
+		html_content : str
+			The HTML of the page.
 
-		return text
+		Returns
+		-------
+		str
+			The text of the page.
+		"""
+		return html_to_text(html_content, backend=self.html_backend)
 		
 	def get_wikipedia_content(self, city: str):
 		"""
@@ -205,116 +233,151 @@ class CreateDataCities:
 			print(f"Error getting Wikipedia content for {city}: {e}")
 			return None
 
-	def get_data_wikipedia(self):
+	def get_data_wikipedia(self, workers: int = 1):
 		"""
 		Get all the data from Wikipedia for the cities.
 
+		Parameters
+		----------
+		workers : int
+			The number of cities to fetch at the same time.
+
 		Returns
 		-------
 		dict
 			The dictionary of the Wikipedia data.
 		"""
-		wikipedia_data = {}
-		for city in self.cities:
-			print(f"Getting Wikipedia data for {city}...")
-			searched_title = self.search_wikipedia(city)
-			if searched_title:
-				content = self.get_wikipedia_content(searched_title)
-				wikipedia_data[city] = {'content': content, 'title': searched_title}
-			
-			time.sleep(0.001) # Avoid hitting the API too hard
+		entries = parallel_map(self.get_wikipedia_entry, self.cities, workers)
+		wikipedia_data = {city: entry for city, entry in zip(self.cities, entries) if entry is not None}
 
 		return wikipedia_data
+
+	def get_wikipedia_entry(self, city: str):
+		"""
+		Get the title and content of the Wikipedia page of a city.
+
+		Returns
+		-------
+		dict
+			The title and content, or None if no page is found.
+		"""
+		print(f"Getting Wikipedia data for {city}...")
+		searched_title = self.search_wikipedia(city)
+		entry = None
+		if searched_title:
+			content = self.get_wikipedia_content(searched_title)
+			entry = {'content': content, 'title': searched_title}
+		
+		time.sleep(0.001) # Avoid hitting the API too hard
+
+		return entry
 	
-	def get_anual_weather_data(self):
-		self.weather_data = []
-
-		for i, city in enumerate(self.cities):
-			print(f"Getting weather data for {city}...")
-
-			longitude = self.coordinates['longitude'][i]
-			latitude = self.coordinates['latitude'][i]
-			altitude = self.coordinates['altitude'][i]
-
-			# Create Point
-			point = Point(latitude, longitude, altitude)
-
-			start = pd.Timestamp.now() - pd.DateOffset(years=1)
-			start = pd.to_datetime(start.date(), format='%Y-%m-%d')
-			# End today
-			end = pd.Timestamp.now()
-			end = pd.to_datetime(end.date(), format='%Y-%m-%d')
-
-			# Get monthly data
-			data = Monthly(point, start, end)
-			data = data.fetch()
-
-			# Ensure the index is a DatetimeIndex
-			if not isinstance(data.index, pd.DatetimeIndex):
-				data.index = pd.to_datetime(data.index, format='%Y-%m-%d')
-
-			months_data = {
-				'January': data[data.index.month == 1],
-				'February': data[data.index.month == 2],
-				'March': data[data.index.month == 3],
-				'April': data[data.index.month == 4],
-				'May': data[data.index.month == 5],
-				'June': data[data.index.month == 6],
-				'July': data[data.index.month == 7],
-				'August': data[data.index.month == 8],
-				'September': data[data.index.month == 9],
-				'October': data[data.index.month == 10],
-				'November': data[data.index.month == 11],
-				'December': data[data.index.month == 12],
-				'summer': data[data.index.month.isin([6, 7, 8])],
-				'winter': data[data.index.month.isin([12, 1, 2])],
-				'autumn': data[data.index.month.isin([9, 10, 11])],
-				'spring': data[data.index.month.isin([3, 4, 5])],
-				'the past year': data
-			}
-
-			keywords_mapping = {
-				'tavg': 'Average temperature (°C)',
-				'prcp': 'Total precipitation (rainfall) (mm)',
-				'wspd': 'Average wind speed (km/h)',
-			}
-
-			aggreation = {
-				'tavg': np.mean,
-				'prcp': np.sum,
-				'wspd': np.mean
-			}
-
-			keywords_texts = {keyword: '' for keyword in keywords_mapping.keys()}
-
-			for keyword in keywords_texts.keys():
-				for month in months_data.keys():
-					keywords_texts[keyword] += f'{keywords_mapping[keyword]} in {month}: {aggreation[keyword](months_data[month][keyword]):.2f}. '
-
-			total_text = '\n'.join(list(keywords_texts.values()))
-
-			self.weather_data.append(total_text)
-
-	def save_texts(self):
+	def get_anual_weather_data(self, workers: int = 1):
 		"""
-		Save the content of the Wikipedia pages to text files.
+		Get the weather summary of the past year for every city.
+
+		Parameters
+		----------
+		workers : int
+			The number of cities to fetch at the same time.
 		"""
-		dir_name = f"{self.save_dir}/city_texts"
-		if not os.path.exists(dir_name):
-			os.makedirs(dir_name)  # Create save directory if it doesn't exist
+		self.weather_data = parallel_map(self.get_weather_text, range(len(self.cities)), workers)
 
+	def get_weather_text(self, i: int):
+		"""
+		Get the weather summary of the past year for the i-th city.
+
+		Returns
+		-------
+		str
+			The text describing the temperature, precipitation and wind.
+		"""
+		city = self.cities[i]
+		print(f"Getting weather data for {city}...")
+
+		longitude = self.coordinates['longitude'][i]
+		latitude = self.coordinates['latitude'][i]
+		altitude = self.coordinates['altitude'][i]
+
+		# Create Point
+		point = Point(latitude, longitude, altitude)
+
+		start = pd.Timestamp.now() - pd.DateOffset(years=1)
+		start = pd.to_datetime(start.date(), format='%Y-%m-%d')
+		# End today
+		end = pd.Timestamp.now()
+		end = pd.to_datetime(end.date(), format='%Y-%m-%d')
+
+		# Get monthly data
+		data = Monthly(point, start, end)
+		data = data.fetch()
+
+		# Ensure the index is a DatetimeIndex
+		if not isinstance(data.index, pd.DatetimeIndex):
+			data.index = pd.to_datetime(data.index, format='%Y-%m-%d')
+
+		months_data = {
+			'January': data[data.index.month == 1],
+			'February': data[data.index.month == 2],
+			'March': data[data.index.month == 3],
+			'April': data[data.index.month == 4],
+			'May': data[data.index.month == 5],
+			'June': data[data.index.month == 6],
+			'July': data[data.index.month == 7],
+			'August': data[data.index.month == 8],
+			'September': data[data.index.month == 9],
+			'October': data[data.index.month == 10],
+			'November': data[data.index.month == 11],
+			'December': data[data.index.month == 12],
+			'summer': data[data.index.month.isin([6, 7, 8])],
+			'winter': data[data.index.month.isin([12, 1, 2])],
+			'autumn': data[data.index.month.isin([9, 10, 11])],
+			'spring': data[data.index.month.isin([3, 4, 5])],
+			'the past year': data
+		}
+
+		keywords_mapping = {
+			'tavg': 'Average temperature (°C)',
+			'prcp': 'Total precipitation (rainfall) (mm)',
+			'wspd': 'Average wind speed (km/h)',
+		}
+
+		aggreation = {
+			'tavg': np.mean,
+			'prcp': np.sum,
+			'wspd': np.mean
+		}
+
+		keywords_texts = {keyword: '' for keyword in keywords_mapping.keys()}
+
+		for keyword in keywords_texts.keys():
+			for month in months_data.keys():
+				keywords_texts[keyword] += f'{keywords_mapping[keyword]} in {month}: {aggreation[keyword](months_data[month][keyword]):.2f}. '
+
+		total_text = '\n'.join(list(keywords_texts.values()))
+
+		return total_text
+
+	def save_texts(self, compress: bool = False):
+		"""
+		Save the content of the Wikipedia pages to the packed corpus of city_texts.
+
+		Parameters
+		----------
+		compress : bool
+			Whether to compress every text with zlib.
+		"""
 		texts = [self.wikipedia_data[city]['content'] for city in self.cities]
 		texts_weather = self.weather_data
 
-		for i, text in enumerate(texts):
-			# Construct a path to save the text
-			file_path = os.path.join(dir_name, self.cities[i].replace(' ', '_').replace('.', '').replace(',', '') + '.txt')
-
-			# Write the text to a file
-			with open(file_path, 'w', encoding='utf-8') as f:
-				f.write(f'Wikipedia information about {self.cities[i]}:\n{text.strip()}')
-				f.write('\n\n')
-				f.write(f'Weather information about {self.cities[i]}: {texts_weather[i].strip()}')
+		# One file for all the cities, read with text_corpus.open_corpus
+		with CorpusWriter(corpus_path(f"{self.save_dir}/city_texts"), compress) as corpus:
+			for i, text in enumerate(texts):
+				# Named like the text files written before
+				text_id = self.cities[i].replace(' ', '_').replace('.', '').replace(',', '') + '.txt'
+				wikipedia = f'Wikipedia information about {self.cities[i]}:\n{text.strip()}'
+				weather = f'Weather information about {self.cities[i]}: {texts_weather[i].strip()}'
+				corpus.add(text_id, f'{wikipedia}\n\n{weather}')
 	
 	def save_dataset(self):
 		"""
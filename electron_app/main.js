@@ -25,14 +25,20 @@ function createWindow() {
 }
 
 app.on('ready', createWindow);
+// Every request writes its map to a file of its own, so concurrent requests don't overwrite each other
+function newMapFile() {
+    return `../data/maps/map_${Date.now()}_${Math.random().toString(36).slice(2)}.png`;
+}
+
 ipcMain.on('process-description', (event, userInput) => {
+    const mapFile = newMapFile();
     // Execute Python code
-    const pythonProcess = spawn('python', ['../python_script.py', userInput]);
+    const pythonProcess = spawn('python', ['../python_script.py', userInput, mapFile]);
 
     // Handle stdout data
     pythonProcess.stdout.on('data', (data) => {
         const result = data.toString();
-        mainWindow.webContents.send('display-conversation', result, 'system', '../data/generatedmap.png');
+        mainWindow.webContents.send('display-conversation', result, 'system', mapFile);
     });
 
     // Handle errors
@@ -52,13 +58,14 @@ ipcMain.on('process-description', (event, userInput) => {
 
 ipcMain.on('process-image', (event, imageURL) => {
     console.log(imageURL)
+    const mapFile = newMapFile();
     // Execute Python code
-    const pythonProcess = spawn('python', ['../python_image_script.py', imageURL]);
+    const pythonProcess = spawn('python', ['../python_image_script.py', imageURL, mapFile]);
 
     // Handle stdout data
     pythonProcess.stdout.on('data', (data) => {
         const result = data.toString();
-        mainWindow.webContents.send('display-conversation', result, 'system');
+        mainWindow.webContents.send('display-conversation', result, 'system', mapFile);
     });
 
     // Handle errors
@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+def iris_dsn(username='demo', password='demo', hostname='localhost', port='1972', namespace='USER'):
+    return f"iris://{username}:{password}@{hostname}:{port}/{namespace}"
+
+
+class PoolMetrics:
+    def __init__(self):
+        """
+        Counters of a connection pool, updated from the pool events.
+        """
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def add_wait(self, seconds):
+        with self.lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def checkout(self):
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def checkin(self):
+        with self.lock:
+            self.in_use -= 1
+
+    def connect(self):
+        with self.lock:
+            self.connects += 1
+
+    def invalidate(self):
+        with self.lock:
+            self.invalidations += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+                'wait_seconds': self.wait_seconds,
+                'mean_wait_seconds': self.wait_seconds / self.checkouts if self.checkouts else 0.0,
+                'max_wait_seconds': self.max_wait_seconds,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool measuring how long every checkout waits for a connection,
+    including the time to open it when the pool has none idle.
+    """
+
+    def __init__(self, *args, metrics=None, **kw):
+        super().__init__(*args, **kw)
+        self.metrics = metrics or PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.metrics.add_wait(time.perf_counter() - start)
+
+    def recreate(self):
+        # Keep the counters when the engine is disposed
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class EngineRegistry:
+    def __init__(self, pool_size=None, max_overflow=None, pool_timeout=None, pool_recycle=None, pool_pre_ping=True):
+        """
+        One SQLAlchemy engine per DSN for the whole process, so the search
+        classes of a request share a single pool of connections.
+
+        The pool settings default to the IRIS_POOL_SIZE, IRIS_MAX_OVERFLOW,
+        IRIS_POOL_TIMEOUT and IRIS_POOL_RECYCLE environment variables.
+
+        Parameters
+        ----------
+        pool_size : int
+            The connections kept open.
+
+        max_overflow : int
+            The extra connections opened when the pool is exhausted.
+
+        pool_timeout : float
+            Seconds a checkout waits for a connection before failing.
+
+        pool_recycle : float
+            Seconds after which a connection is replaced, before the server drops it.
+
+        pool_pre_ping : bool
+            Test every connection on checkout and reconnect if it is dead.
+        """
+        self.pool_size = pool_size if pool_size is not None else int(os.getenv('IRIS_POOL_SIZE', 5))
+        self.max_overflow = max_overflow if max_overflow is not None else int(os.getenv('IRIS_MAX_OVERFLOW', 10))
+        self.pool_timeout = pool_timeout if pool_timeout is not None else float(os.getenv('IRIS_POOL_TIMEOUT', 30))
+        self.pool_recycle = pool_recycle if pool_recycle is not None else float(os.getenv('IRIS_POOL_RECYCLE', 1800))
+        self.pool_pre_ping = pool_pre_ping
+        self.engines = {}
+        self.lock = threading.Lock()
+
+    def get(self, dsn):
+        """
+        Get the engine of a DSN, created on the first call.
+        """
+        with self.lock:
+            engine = self.engines.get(dsn)
+            if engine is None:
+                engine = create_engine(
+                    dsn,
+                    poolclass=TimedQueuePool,
+                    pool_size=self.pool_size,
+                    max_overflow=self.max_overflow,
+                    pool_timeout=self.pool_timeout,
+                    pool_recycle=self.pool_recycle,
+                    pool_pre_ping=self.pool_pre_ping,
+                )
+                self.listen(engine)
+                self.engines[dsn] = engine
+        return engine
+
+    @staticmethod
+    def listen(engine):
+        metrics = engine.pool.metrics
+        event.listen(engine, 'connect', lambda dbapi_conn, record: metrics.connect())
+        event.listen(engine, 'checkout', lambda dbapi_conn, record, proxy: metrics.checkout())
+        event.listen(engine, 'checkin', lambda dbapi_conn, record: metrics.checkin())
+        event.listen(engine, 'invalidate', lambda dbapi_conn, record, exception: metrics.invalidate())
+
+    def metrics(self):
+        """
+        Get the pool counters of every engine.
+
+        Returns
+        -------
+        dict
+            The counters by DSN, with the passwords hidden.
+        """
+        with self.lock:
+            engines = dict(self.engines)
+        return {make_url(dsn).render_as_string(hide_password=True): {**engine.pool.metrics.snapshot(), 'size': engine.pool.size()}
+                for dsn, engine in engines.items()}
+
+    def report(self):
+        print(f"{'dsn':<44} {'size':>4} {'in use':>6} {'peak':>5} {'checkouts':>9} {'connects':>8} {'mean wait (ms)':>14} {'max wait (ms)':>13}")
+        for dsn, m in self.metrics().items():
+            print(f"{dsn:<44} {m['size']:>4} {m['in_use']:>6} {m['peak_in_use']:>5} {m['checkouts']:>9} {m['connects']:>8} "
+                  f"{m['mean_wait_seconds'] * 1000:>14.2f} {m['max_wait_seconds'] * 1000:>13.2f}")
+
+    def dispose(self):
+        with self.lock:
+            for engine in self.engines.values():
+                engine.dispose()
+            self.engines.clear()
+
+
+registry = EngineRegistry()
+
+
+def get_engine(dsn):
+    return registry.get(dsn)
@@ -1,6 +1,8 @@
-from city_class import CreateDataCities
-
-cities_file = './data/city_names.inp'
-save_dir = './data'
-
-CreateDataCities(cities_file, save_dir)
\ No newline at end of file
+from ingestion_pipeline import IngestionPipeline, add_city_stages
+
+cities_file = './data/city_names.inp'
+save_dir = './data'
+
+pipeline = IngestionPipeline()
+add_city_stages(pipeline, cities_file, save_dir)
+pipeline.run()
@@ -1,6 +1,9 @@
-from landmark_class import CreateDataLandmarks
+from ingestion_pipeline import IngestionPipeline, add_landmark_stages
 
 landmarks_file = "./data/landmark_names.inp"
 save_dir = "./data"
 from_csv = "./data/data.csv"
-CreateDataLandmarks(landmarks_file, save_dir, from_csv, images_from='wiki')
+
+pipeline = IngestionPipeline()
+add_landmark_stages(pipeline, landmarks_file, save_dir, from_csv, images_from='wiki')
+pipeline.run()
@@ -0,0 +1,211 @@
+import operator
+import re
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+OPERATORS = {'eq': '=', 'ne': '<>', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+
+
+class Filter:
+    def __init__(self, op, column=None, value=None, parts=()):
+        """
+        A predicate on the columns of a table, compiled to SQL with bound parameters.
+
+        Filters are built with the class methods and combined with & and |. The
+        statement text only depends on the columns and operators, never on the
+        values, so the database reuses the plan of every search with the same
+        shape, and no value is ever spliced into the SQL.
+
+        Examples
+        --------
+        >>> Filter.eq('country', 'Spain') & Filter.lt('distance', 250)
+        >>> Filter.bbox(41.3, 2.0, 41.5, 2.3) | Filter.isin('city', ['Paris', 'Lyon'])
+        """
+        self.op = op
+        self.column = column
+        self.value = value
+        self.parts = tuple(parts)
+
+    @classmethod
+    def eq(cls, column, value):
+        return cls('eq', column, value)
+
+    @classmethod
+    def ne(cls, column, value):
+        return cls('ne', column, value)
+
+    @classmethod
+    def lt(cls, column, value):
+        return cls('lt', column, value)
+
+    @classmethod
+    def le(cls, column, value):
+        return cls('le', column, value)
+
+    @classmethod
+    def gt(cls, column, value):
+        return cls('gt', column, value)
+
+    @classmethod
+    def ge(cls, column, value):
+        return cls('ge', column, value)
+
+    @classmethod
+    def isin(cls, column, values):
+        # One parameter per value, so the text only changes with the number of values
+        return cls('in', column, tuple(values))
+
+    @classmethod
+    def between(cls, column, low, high):
+        return cls('between', column, (low, high))
+
+    @classmethod
+    def bbox(cls, min_lat, min_lon, max_lat, max_lon, lat='latitude', lon='longitude'):
+        """
+        Points inside a bounding box. A box with min_lon > max_lon crosses the antimeridian.
+        """
+        latitude = cls.between(lat, min_lat, max_lat)
+        if min_lon <= max_lon:
+            return latitude & cls.between(lon, min_lon, max_lon)
+        return latitude & (cls.ge(lon, min_lon) | cls.le(lon, max_lon))
+
+    @classmethod
+    def not_visited(cls, user_id, column, table='user_visits'):
+        """
+        Places not visited by a user, from the visits table of UserManager.
+        """
+        return cls('not_visited', column, (user_id, table))
+
+    def __and__(self, other):
+        return Filter('and', parts=(self, as_filter(other)))
+
+    def __or__(self, other):
+        return Filter('or', parts=(self, as_filter(other)))
+
+    def columns(self):
+        if self.parts:
+            return set().union(*(part.columns() for part in self.parts))
+        return {self.column}
+
+    def tables(self):
+        if self.parts:
+            return set().union(*(part.tables() for part in self.parts))
+        return {self.value[1]} if self.op == 'not_visited' else set()
+
+    def compile(self, allowed=None):
+        """
+        Compile the filter to SQL.
+
+        Parameters
+        ----------
+        allowed : iterable
+            The columns the filter may use. Any column by default, as long as it
+            is a plain identifier.
+
+        Returns
+        -------
+        tuple
+            The SQL predicate and the dict of its parameters.
+        """
+        for column in self.columns():
+            if not IDENTIFIER.match(str(column)) or (allowed is not None and column not in allowed):
+                raise ValueError(f"Unknown filter column {column}." + (f" Choose from {list(allowed)}." if allowed is not None else ""))
+        for table in self.tables():
+            if not IDENTIFIER.match(str(table)):
+                raise ValueError(f"Invalid table name {table}.")
+        params = {}
+        return self._compile(params), params
+
+    def _compile(self, params):
+        if self.op in ('and', 'or'):
+            return '(' + f' {self.op.upper()} '.join(part._compile(params) for part in self.parts) + ')'
+
+        def bind(value):
+            name = f'f{len(params)}'
+            params[name] = value
+            return f':{name}'
+
+        if self.op == 'in':
+            if not self.value:
+                return '1 = 0'
+            return f"{self.column} IN ({', '.join(bind(value) for value in self.value)})"
+        if self.op == 'not_visited':
+            user_id, table = self.value
+            return f"{self.column} NOT IN (SELECT place FROM {table} WHERE user_id = {bind(user_id)})"
+        if self.op == 'between':
+            return f"{self.column} BETWEEN {bind(self.value[0])} AND {bind(self.value[1])}"
+        return f"{self.column} {OPERATORS[self.op]} {bind(self.value)}"
+
+    def mask(self, frame):
+        """
+        Evaluate the filter on the rows of a DataFrame instead of the database.
+
+        Returns
+        -------
+        pandas.Series
+            True for the rows kept.
+        """
+        if self.op == 'and':
+            result = self.parts[0].mask(frame)
+            for part in self.parts[1:]:
+                result = result & part.mask(frame)
+            return result
+        if self.op == 'or':
+            result = self.parts[0].mask(frame)
+            for part in self.parts[1:]:
+                result = result | part.mask(frame)
+            return result
+        column = frame[self.column]
+        if self.op == 'in':
+            return column.isin(self.value)
+        if self.op == 'between':
+            return column.between(*self.value)
+        if self.op == 'not_visited':
+            raise ValueError("Visits are only known to the database.")
+        return getattr(operator, self.op)(column, self.value)
+
+
+def as_filter(filters):
+    """
+    Get a Filter from a Filter, None, or a dict of column values, e.g.
+    {'city': 'Paris'} or {'country': ['Spain', 'France']}.
+    """
+    if filters is None or isinstance(filters, Filter):
+        return filters
+    if isinstance(filters, dict):
+        parts = [Filter.isin(column, value) if isinstance(value, (list, tuple, set)) else Filter.eq(column, value)
+                 for column, value in filters.items()]
+        if not parts:
+            return None
+        result = parts[0]
+        for part in parts[1:]:
+            result = result & part
+        return result
+    raise TypeError(f"Filters must be a Filter or a dict, not {type(filters).__name__}.")
+
+
+def where_clause(filters, allowed=None):
+    """
+    Compile filters to a WHERE clause.
+
+    Returns
+    -------
+    tuple
+        The clause, empty without filters, and the dict of its parameters.
+    """
+    filters = as_filter(filters)
+    if filters is None:
+        return "", {}
+    sql, params = filters.compile(allowed)
+    return f"WHERE {sql}", params
+
+
+def statement_reuse(search_stats):
+    """
+    Get the share of the searches whose statement text had already been run,
+    from the search_stats of a CloseSearch or ImageSearch.
+    """
+    if not search_stats:
+        return 0.0
+    statements = [stats['statement'] for stats in search_stats]
+    return 1 - len(set(statements)) / len(statements)
@@ -1,27 +1,38 @@
-import pandas as pd
-from llama_index import (
-    SimpleDirectoryReader,
-    VectorStoreIndex,
-    OpenAIEmbedding,
-    ServiceContext,
-    StorageContext,
-)
-from llama_index.llms.ollama import Ollama
-from llama_index.llms import OpenAI
-from llama_index.text_splitter import SentenceSplitter
-from llama_iris import IRISVectorStore
 from dotenv import load_dotenv
+from cache_class import ResponseCache
+from engine_class import get_engine, iris_dsn
+from filter_class import where_clause
+from text_corpus import open_corpus
+from tracing import span, traced
+from sqlalchemy import inspect, text
 import os
 import getpass
-import textwrap
-import pickle
+import hashlib
+import json
 
-import getpass
-import os
-from dotenv import load_dotenv
+# llama_index and pandas are imported by the methods that need them, so answers
+# served from the response cache never pay for them: the index version of the
+# cache keys is read from the cache, and the texts are only hashed by build_index
 
 load_dotenv()
 
+# Templates of the questions asked by the query scripts, precomputed by precompute_responses.py
+CITY_PROMPT = "Create a brew (2-3 lines) description about the city of {city}"
+LANDMARK_PROMPT = "What do you know about the landmark {landmark}?"
+
+# Dimension of the vectors of OpenAIEmbedding's default model, text-embedding-ada-002
+OPENAI_EMBED_DIM = 1536
+
+
+def text_file_name(*parts):
+    # Same naming as CreateDataCities.save_texts and CreateDataLandmarks.save_texts
+    return ", ".join(parts).replace(' ', '_').replace('.', '').replace(',', '') + '.txt'
+
+
+# Columns of the documents table that query filters can use
+FILTER_COLUMNS = ('landmark', 'city', 'country', 'source_file')
+
+
 class MonumentsSearch:
     def __init__(
         self,
@@ -36,13 +47,24 @@ class MonumentsSearch:
         llama_model="gpt-3.5-turbo",
         openai_embedding_model="BAAI/bge-base-en-v1.5",
         vector_table_name="apunts",
-        vector_embed_dim=1536,
-        index_file = "../data/index.pkl" 
+        vector_embed_dim=None,
+        index_file = "../data/index.pkl",
+        embedding_backend="openai",
+        embed_batch_size=64,
+        cache_file=None,
+        cache_max_entries=10000,
+        chunk_size=1024,
+        chunk_overlap=200,
+        similarity_top_k=2,
     ):
+        # embedding_backend "local" embeds with openai_embedding_model through fastembed,
+        # "openai" with OpenAIEmbedding. The table dimension follows the model unless
+        # vector_embed_dim is given, so each backend needs its own vector_table_name.
         self.data_file_path = data_file_path
         self.landmark_column = landmark_column
         self.wiki_content_column = wiki_content_column
         self.landmarks_directory = landmarks_directory
+        self._corpus = None
         self.iris_hostname = iris_hostname
         self.iris_port = iris_port
         self.iris_namespace = iris_namespace
@@ -50,71 +72,351 @@ class MonumentsSearch:
         self.llama_model = llama_model
         self.openai_embedding_model = openai_embedding_model
         self.vector_table_name = vector_table_name
+        self.embedding_backend = embedding_backend
+        self.embed_batch_size = embed_batch_size
+        self.embed_model = None
         self.vector_embed_dim = vector_embed_dim
         self.query_engine = None
         self.index_file = index_file  # File to save/load the index
+        self.engine = None
+        # Answers are cached per model, prompt and version of the indexed texts
+        self.cache = ResponseCache(cache_file, max_entries=cache_max_entries) if cache_file else None
+        self._index_version = None
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.similarity_top_k = similarity_top_k
+        self.index = None
+        self._file_metadata = None
+        self.token_counter = None
+        self.query_stats = []
 
     def setup_iris_connection(self):
-        global CONNECTION_STRING
-        username = 'demo'
-        password = 'demo' 
-        hostname = os.getenv('IRIS_HOSTNAME', 'localhost')
-        port = '1972' 
-        namespace = 'USER'
-        CONNECTION_STRING = f"iris://{username}:{password}@{hostname}:{port}/{namespace}"
-        return CONNECTION_STRING
+        return iris_dsn(hostname=os.getenv('IRIS_HOSTNAME', 'localhost'))
+
+    def setup_embedding(self):
+        if self.embed_model is None:
+            from llama_index import OpenAIEmbedding
+            from llama_backends import LocalEmbedding
+            if self.embedding_backend == "local":
+                self.embed_model = LocalEmbedding(self.openai_embedding_model, embed_batch_size=self.embed_batch_size)
+                embed_dim = self.embed_model.embed_dim
+            elif self.embedding_backend == "openai":
+                self.embed_model = OpenAIEmbedding(embed_batch_size=self.embed_batch_size)
+                embed_dim = OPENAI_EMBED_DIM
+            else:
+                raise ValueError(f"Unknown embedding backend {self.embedding_backend}. Use 'local' or 'openai'.")
+            if self.vector_embed_dim is None:
+                self.vector_embed_dim = embed_dim
+        return self.embed_model
 
     def setup_openai(self):
         if not os.environ.get("OPENAI_API_KEY"):
             os.environ["OPENAI_API_KEY"] = getpass.getpass("OpenAI API Key:")
+        from llama_index import ServiceContext
+        from llama_index.callbacks import CallbackManager
+        from llama_index.llms import OpenAI
+        from llama_index.text_splitter import SentenceSplitter
         llm = OpenAI(model=self.llama_model, temperature=0.01)
-        embed_model = OpenAIEmbedding()
-        service_context = ServiceContext.from_defaults(llm=llm, embed_model=embed_model)
+        embed_model = self.setup_embedding()
+        node_parser = SentenceSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+        from llama_backends import ThreadTokenCounter
+        # Counts per thread, reset by every query
+        self.token_counter = ThreadTokenCounter(tokenizer=self.tokenizer())
+        service_context = ServiceContext.from_defaults(
+            llm=llm,
+            embed_model=embed_model,
+            node_parser=node_parser,
+            callback_manager=CallbackManager([self.token_counter]),
+        )
         return service_context
 
-    def build_index(self):
+    def tokenizer(self):
+        import tiktoken
         try:
-            connection_string = self.setup_iris_connection()
-            service_context = self.setup_openai()
-            vector_store = IRISVectorStore.from_params(
-                connection_string=CONNECTION_STRING,
-                table_name=self.vector_table_name,
-                embed_dim=self.vector_embed_dim,
-            )
-            index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-            self.query_engine = index.as_query_engine()
-        except:
+            return tiktoken.encoding_for_model(self.llama_model).encode
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base").encode
+
+    def setup_vector_store(self):
+        from llama_backends import ScopedIRISVectorStore
+        connection_string = self.setup_iris_connection()
+        vector_store = ScopedIRISVectorStore.from_params(
+            connection_string=connection_string,
+            table_name=self.vector_table_name,
+            embed_dim=self.vector_embed_dim,
+        )
+        self.engine = get_engine(connection_string)
+        # IRISVectorStore lowercases the name and prefixes it with data_
+        self.data_table = f"data_{vector_store.table_name}"
+        self.documents_table = f"{self.data_table}_documents"
+        self.chunks_table = f"{self.data_table}_chunks"
+        return vector_store
+
+    def index_exists(self):
+        # Connection errors are raised here instead of being taken as a missing index
+        inspector = inspect(self.engine)
+        if not (inspector.has_table(self.data_table, schema="SQLUser")
+                and inspector.has_table(self.documents_table, schema="SQLUser")
+                and inspector.has_table(self.chunks_table, schema="SQLUser")):
+            return False
+        # Indexes built before documents carried metadata are rebuilt
+        columns = {column['name'].lower() for column in inspector.get_columns(self.documents_table, schema="SQLUser")}
+        return set(FILTER_COLUMNS) <= columns
+
+    def create_documents_table(self):
+        with self.engine.connect() as conn:
+            with conn.begin():
+                for table in (self.documents_table, self.chunks_table):
+                    if inspect(conn).has_table(table, schema="SQLUser"):
+                        conn.execute(text(f"DROP TABLE {table}"))
+                conn.execute(text(f"""
+                    CREATE TABLE {self.documents_table} (
+                        doc_id VARCHAR(1000),
+                        file_name VARCHAR(1000),
+                        content_hash VARCHAR(64),
+                        landmark VARCHAR(1000),
+                        city VARCHAR(1000),
+                        country VARCHAR(1000),
+                        source_file VARCHAR(1000)
+                    )
+                """))
+                # One row per chunk of a document. stored is 0 when the same text was
+                # already indexed for another document, so the chunk was skipped.
+                conn.execute(text(f"""
+                    CREATE TABLE {self.chunks_table} (
+                        chunk_hash VARCHAR(64),
+                        doc_id VARCHAR(1000),
+                        stored INT
+                    )
+                """))
+                # Rows left by an index built before hashes were kept can't be matched to a file
+                if inspect(conn).has_table(self.data_table, schema="SQLUser"):
+                    conn.execute(text(f"DELETE FROM {self.data_table}"))
+
+    def indexed_hashes(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(f"SELECT doc_id, file_name, content_hash FROM {self.documents_table}")).fetchall()
+        indexed = {}
+        for doc_id, file_name, content_hash in rows:
+            indexed.setdefault(file_name, {'hash': content_hash, 'doc_ids': []})['doc_ids'].append(doc_id)
+        return indexed
+
+    def file_metadata(self):
+        # Landmark, city and country of every text file, from the rows of data_file_path
+        if self._file_metadata is None:
+            import pandas as pd
+            self._file_metadata = {}
+            if os.path.exists(self.data_file_path):
+                df = pd.read_csv(self.data_file_path)
+                for row in df.to_dict('records'):
+                    metadata = {column: row.get(column) for column in ('landmark', 'city', 'country') if column in df.columns}
+                    keys = [row[self.landmark_column]] + [row[c] for c in ('city', 'country') if c != self.landmark_column and c in df.columns]
+                    # Landmark texts are named after "landmark, city, country", city texts after the city alone
+                    for name in (text_file_name(*keys), text_file_name(row[self.landmark_column])):
+                        self._file_metadata.setdefault(name, metadata)
+        return self._file_metadata
+
+    def corpus(self):
+        # The packed corpus written by the builders, or the text files of older datasets
+        if self._corpus is None:
+            self._corpus = open_corpus(self.landmarks_directory)
+        return self._corpus
+
+    def file_hashes(self):
+        # The chunking settings and metadata are part of the hash, so changing them reindexes the files.
+        # A text hashes the same packed or in its own file, so packing a directory reindexes nothing.
+        settings = f"{self.chunk_size}:{self.chunk_overlap}".encode('utf-8')
+        file_metadata = self.file_metadata()
+        corpus = self.corpus()
+        hashes = {}
+        for file_name in corpus.ids():
+            metadata = json.dumps(file_metadata.get(file_name, {}), sort_keys=True, default=str).encode('utf-8')
+            hashes[file_name] = hashlib.sha256(settings + metadata + corpus.raw(file_name)).hexdigest()
+        return hashes
+
+    def load_documents(self, file_name):
+        from llama_index import Document
+        metadata = {**self.file_metadata().get(file_name, {}), 'file_name': file_name, 'source_file': file_name}
+        # Ids follow the file name so the rows of a file can be found again
+        return [Document(text=self.corpus()[file_name], id_=file_name, metadata=metadata)]
+
+    @staticmethod
+    def chunk_hash(node):
+        from llama_index.schema import MetadataMode
+        return hashlib.sha256(node.get_content(metadata_mode=MetadataMode.NONE).encode('utf-8')).hexdigest()
+
+    def sync_documents(self, index, vector_store):
+        indexed = self.indexed_hashes()
+        current = self.file_hashes()
+        changed = [name for name, content_hash in current.items() if indexed.get(name, {}).get('hash') != content_hash]
+        removed = [name for name in indexed if name not in current]
+
+        with self.engine.connect() as conn:
+            chunks = conn.execute(text(f"SELECT chunk_hash, doc_id, stored FROM {self.chunks_table}")).fetchall()
+        doc_files = {doc_id: name for name, entry in indexed.items() for doc_id in entry['doc_ids']}
+        dropped = set(removed + [name for name in changed if name in indexed])
+        # Files whose duplicate chunks were only stored under a dropped file must be chunked again
+        lost = {chunk_hash for chunk_hash, doc_id, stored in chunks if stored and doc_files.get(doc_id) in dropped}
+        for chunk_hash, doc_id, stored in chunks:
+            name = doc_files.get(doc_id)
+            if not stored and chunk_hash in lost and name in current and name not in dropped:
+                changed.append(name)
+                dropped.add(name)
+
+        with self.engine.connect() as conn:
+            with conn.begin():
+                for file_name in dropped:
+                    for doc_id in indexed[file_name]['doc_ids']:
+                        vector_store.delete(doc_id)
+                        conn.execute(text(f"DELETE FROM {self.chunks_table} WHERE doc_id = :doc_id"), {'doc_id': doc_id})
+                    conn.execute(text(f"DELETE FROM {self.documents_table} WHERE file_name = :file_name"), {'file_name': file_name})
+
+        seen = {chunk_hash for chunk_hash, doc_id, stored in chunks if stored and doc_files.get(doc_id) not in dropped}
+        documents = {file_name: self.load_documents(file_name) for file_name in changed}
+        nodes = []
+        chunk_rows = []
+        for file_name, file_documents in documents.items():
+            for document in file_documents:
+                # Rows of an interrupted sync, embedded but never recorded
+                vector_store.delete(document.id_)
+            for node in index.service_context.node_parser.get_nodes_from_documents(file_documents):
+                chunk_hash = self.chunk_hash(node)
+                stored = chunk_hash not in seen
+                chunk_rows.append({'chunk_hash': chunk_hash, 'doc_id': node.ref_doc_id, 'stored': int(stored)})
+                if stored:
+                    seen.add(chunk_hash)
+                    nodes.append(node)
+        if nodes:
+            index.insert_nodes(nodes, show_progress=True)
+
+        with self.engine.connect() as conn:
+            with conn.begin():
+                for file_name, file_documents in documents.items():
+                    for document in file_documents:
+                        conn.execute(text(f"""
+                            INSERT INTO {self.documents_table} (doc_id, file_name, content_hash, landmark, city, country, source_file)
+                            VALUES (:doc_id, :file_name, :content_hash, :landmark, :city, :country, :source_file)
+                        """), {'doc_id': document.id_, 'file_name': file_name, 'content_hash': current[file_name],
+                              **{column: document.metadata.get(column) for column in FILTER_COLUMNS}})
+                for row in chunk_rows:
+                    conn.execute(text(f"""
+                        INSERT INTO {self.chunks_table} (chunk_hash, doc_id, stored)
+                        VALUES (:chunk_hash, :doc_id, :stored)
+                    """), row)
+
+        print(f"{self.vector_table_name}: {len(changed)} new or changed, {len(removed)} removed, {len(current) - len(changed)} unchanged documents, "
+              f"{len(nodes)} chunks embedded, {len(chunk_rows) - len(nodes)} duplicate chunks skipped")
+
+    def index_report(self):
+        """
+        Count the chunks of the index.
+
+        Returns
+        -------
+        dict
+            The number of documents, stored chunks and skipped duplicate chunks.
+        """
+        with self.engine.connect() as conn:
+            documents = conn.execute(text(f"SELECT COUNT(*) FROM {self.documents_table}")).scalar()
+            stored = conn.execute(text(f"SELECT COUNT(*) FROM {self.chunks_table} WHERE stored = 1")).scalar()
+            duplicates = conn.execute(text(f"SELECT COUNT(*) FROM {self.chunks_table} WHERE stored = 0")).scalar()
+        return {'documents': documents, 'chunks': stored, 'duplicate_chunks': duplicates,
+                'chunk_size': self.chunk_size, 'chunk_overlap': self.chunk_overlap}
+
+    @traced('monuments.build_index')
+    def build_index(self, sync=True):
+        from llama_index import VectorStoreIndex
+        service_context = self.setup_openai()
+        vector_store = self.setup_vector_store()
+        if not self.index_exists():
             print("building index again")
-            documents = SimpleDirectoryReader(self.landmarks_directory).load_data()
-            connection_string = self.setup_iris_connection()
-            service_context = self.setup_openai()
-            vector_store = IRISVectorStore.from_params(
-                connection_string=CONNECTION_STRING,
-                table_name=self.vector_table_name,
-                embed_dim=self.vector_embed_dim,
-            )
-            storage_context = StorageContext.from_defaults(vector_store=vector_store)
-            index = VectorStoreIndex.from_documents(
-                documents,
-                storage_context=storage_context,
-                show_progress=True,
-                service_context=service_context,
-            )
-            self.query_engine = index.as_query_engine()
+            self.create_documents_table()
+            sync = True
+        index = VectorStoreIndex.from_vector_store(vector_store=vector_store, service_context=service_context)
+        # Only new or changed files are chunked and embedded, removed ones are deleted
+        if sync:
+            self.sync_documents(index, vector_store)
+            # Saved for the queries of the next processes, answered from the cache without reading the texts
+            self._index_version = self.compute_index_version()
+            if self.cache is not None:
+                self.cache.set_version(self.index_settings(), self._index_version)
+        self.index = index
+        self.query_engine = index.as_query_engine(similarity_top_k=self.similarity_top_k)
 
         return self.query_engine
 
-    def query(self, query_text):
-        if self.query_engine is None:
-            self.build_index()
-        response = self.query_engine.query(query_text)
-        return response
+    def index_settings(self):
+        return f"{self.vector_table_name}|{self.embedding_backend}|{self.openai_embedding_model}|{self.similarity_top_k}"
+
+    def compute_index_version(self):
+        # Changes whenever build_index would index different texts or vectors
+        version = hashlib.sha256(self.index_settings().encode('utf-8'))
+        for file_name, content_hash in self.file_hashes().items():
+            version.update(f"|{file_name}:{content_hash}".encode('utf-8'))
+        return version.hexdigest()
 
+    def index_version(self):
+        # The version saved by the last build_index, so a cached answer doesn't hash every text.
+        # It is only computed here for indexes built before the versions were saved.
+        if self._index_version is None:
+            self._index_version = self.cache.get_version(self.index_settings()) if self.cache is not None else None
+        if self._index_version is None:
+            self._index_version = self.compute_index_version()
+            if self.cache is not None:
+                self.cache.set_version(self.index_settings(), self._index_version)
+        return self._index_version
 
-# Example usage:
-monuments_search = MonumentsSearch(
-    data_file_path="./data/data.csv",
-    landmark_column="landmark",
-    wiki_content_column="wiki_content",
-    landmarks_directory="./data/monuments"
-)
+    def filtered_doc_ids(self, filters):
+        # Ids of the documents whose metadata match every filter, e.g. {'city': 'Paris'}
+        where, params = where_clause(filters, allowed=FILTER_COLUMNS)
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(f"SELECT doc_id FROM {self.documents_table} {where}"), params).fetchall()
+        return [row[0] for row in rows]
+
+    @traced('monuments.query')
+    def query(self, query_text, use_cache=True, filters=None):
+        """
+        Answer a question about the indexed texts, from the response cache if it was asked before.
+
+        Returns
+        -------
+        str
+            The answer, whether it was cached or not.
+        """
+        key = None
+        if self.cache is not None:
+            with span('monuments.cache', table=self.vector_table_name) as attrs:
+                scope = json.dumps(filters, sort_keys=True) if filters else ''
+                key = self.cache.key(self.llama_model, query_text + scope, self.index_version())
+                response = self.cache.get(key) if use_cache else None
+                attrs['hit'] = response is not None
+            if response is not None:
+                return response
+        if self.query_engine is None:
+            self.build_index()
+        query_engine = self.query_engine
+        if filters:
+            with span('monuments.filter_documents'):
+                doc_ids = self.filtered_doc_ids(filters)
+            if doc_ids:
+                query_engine = self.index.as_query_engine(similarity_top_k=self.similarity_top_k, doc_ids=doc_ids)
+            else:
+                print(f"No documents match {filters}, searching the whole index")
+        self.token_counter.reset_counts()
+        # Retrieval of the chunks and the LLM call
+        with span('monuments.answer', table=self.vector_table_name) as attrs:
+            response = query_engine.query(query_text)
+            attrs['prompt_tokens'] = self.token_counter.prompt_llm_token_count
+        self.query_stats.append({
+            'query': query_text,
+            'filters': filters,
+            'prompt_tokens': self.token_counter.prompt_llm_token_count,
+            'completion_tokens': self.token_counter.completion_llm_token_count,
+            'embedding_tokens': self.token_counter.total_embedding_token_count,
+            'chunks': len(response.source_nodes),
+        })
+        # The text, like the answers of the cache, so the callers get a str either way
+        answer = str(response)
+        if key is not None:
+            self.cache.put(key, answer, self.llama_model, query_text)
+        return answer
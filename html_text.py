@@ -0,0 +1,108 @@
+import re
+
+# Cleanup patterns, compiled once and shared by every backend
+REFERENCES = re.compile(r'\[.*?\]')
+WHITESPACE = re.compile(r'\s+')
+
+
+def _sections_html_parser(html_content):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_content, 'html.parser')
+    return ((section.name, section.get_text()) for section in soup.find_all(['h2', 'p']))
+
+
+def _sections_bs4_lxml(html_content):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_content, 'lxml')
+    return ((section.name, section.get_text()) for section in soup.find_all(['h2', 'p']))
+
+
+def _sections_lxml(html_content):
+    import lxml.html
+    from lxml import etree
+    if not html_content.strip():
+        return iter(())
+    root = lxml.html.fromstring(html_content)
+    # Drop comments and processing instructions so itertext matches bs4's get_text
+    etree.strip_elements(root, etree.Comment, etree.ProcessingInstruction, with_tail=False)
+    return ((section.tag, ''.join(section.itertext())) for section in root.iter('h2', 'p'))
+
+
+def _available(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+PARSER_BACKENDS = {
+    'html.parser': _sections_html_parser,
+    'bs4-lxml': _sections_bs4_lxml,
+    'lxml': _sections_lxml,
+}
+
+
+def available_backends():
+    """
+    Get the parser backends whose dependencies are installed.
+
+    Returns
+    -------
+    list
+        The names of the usable backends, fastest first.
+    """
+    backends = []
+    if _available('lxml'):
+        backends.append('lxml')
+        if _available('bs4'):
+            backends.append('bs4-lxml')
+    if _available('bs4'):
+        backends.append('html.parser')
+    return backends
+
+
+def default_backend():
+    backends = available_backends()
+    return backends[0] if backends else 'html.parser'
+
+
+def html_to_text(html_content, backend=None):
+    """
+    Convert the HTML of a Wikipedia page to plain text.
+
+    Parameters
+    ----------
+    html_content : str
+        The HTML of the page.
+
+    backend : str
+        One of PARSER_BACKENDS. Defaults to the fastest installed one.
+
+    Returns
+    -------
+    str
+        The text of the h2 and p sections, without references.
+    """
+    if backend is None:
+        backend = default_backend()
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown parser backend {backend}. Choose one of {list(PARSER_BACKENDS)}.")
+
+    parts = []
+    for name, section_text in PARSER_BACKENDS[backend](html_content):
+        if name == 'h2':
+            parts.append('\n\n' + section_text + '\n\n')  # Add extra newlines for headers
+        else:
+            parts.append(section_text + ' ')
+    text = ''.join(parts)
+
+    # Remove references in square brackets
+    text = REFERENCES.sub('', text)
+
+    # Remove multiple spaces. This also collapses every newline, so no extra
+    # pass for triple newlines is needed afterwards.
+    text = WHITESPACE.sub(' ', text)
+
+    # Remove leading and trailing spaces, then the ⓘ symbol
+    return text.strip().replace('ⓘ', '')
@@ -0,0 +1,119 @@
+"""
+Perceptual hashes of images, equal or a few bits apart for the same photo
+resized, recompressed or slightly cropped, unlike a hash of the file.
+
+Used by ImageSearch to answer repeated uploads from its result cache and to
+leave near-duplicate photos of the same landmark out of the index. Run this
+module on a folder to see the duplicates the index would drop:
+
+Usage: python image_hash.py FOLDER_PATTERN [--distance 6]
+"""
+import argparse
+import glob
+import os
+from functools import lru_cache
+
+import numpy as np
+
+HASH_SIZE = 8
+# Pixels of the reduced image the DCT is computed on
+SAMPLE_SIZE = 32
+
+
+@lru_cache(maxsize=4)
+def dct_matrix(n):
+    # Orthonormal DCT-II, so the 2D transform of x is D @ x @ D.T
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def perceptual_hash(image):
+    """
+    pHash of an image: the signs of its lowest frequencies against their median.
+
+    Parameters
+    ----------
+    image : str or PIL.Image.Image
+        The path of the image, or the image already opened.
+
+    Returns
+    -------
+    int
+        A 64 bit hash.
+    """
+    from PIL import Image
+    if isinstance(image, str):
+        with Image.open(image) as opened:
+            return perceptual_hash(opened.convert('RGB'))
+    pixels = np.asarray(image.convert('L').resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.LANCZOS), dtype=np.float32)
+    d = dct_matrix(SAMPLE_SIZE)
+    low = (d @ pixels @ d.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # The DC term is the mean brightness, left out of the median
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def hamming_many(value, hashes):
+    """
+    Distance of a hash to every hash of an array of uint64.
+    """
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(value))
+    return np.unpackbits(xor.view(np.uint8).reshape(len(xor), 8), axis=1).sum(axis=1)
+
+
+def near_duplicates(hashes, groups, max_distance=6):
+    """
+    Find the items within max_distance bits of an earlier item of the same group.
+
+    Parameters
+    ----------
+    hashes : list
+        The perceptual hash of every item.
+
+    groups : list
+        The group of every item, e.g. its landmark. Items of different groups are never duplicates.
+
+    Returns
+    -------
+    dict
+        The position of every duplicate and the position of the item it duplicates.
+    """
+    kept = {}
+    duplicates = {}
+    for i, (value, group) in enumerate(zip(hashes, groups)):
+        positions = kept.setdefault(group, [])
+        if positions:
+            distances = hamming_many(value, [hashes[j] for j in positions])
+            closest = int(np.argmin(distances))
+            if distances[closest] <= max_distance:
+                duplicates[i] = positions[closest]
+                continue
+        positions.append(i)
+    return duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pattern', help="e.g. './data/downloaded_images/*.jpg'")
+    parser.add_argument('--distance', type=int, default=6)
+    args = parser.parse_args()
+
+    from images_class import ImageSearch
+    paths = sorted(glob.glob(args.pattern))
+    hashes = [perceptual_hash(path) for path in paths]
+    groups = [ImageSearch.clean_image_name(path) for path in paths]
+    duplicates = near_duplicates(hashes, groups, args.distance)
+    for i, j in sorted(duplicates.items()):
+        print(f"{hamming(hashes[i], hashes[j]):>2} bits  {os.path.basename(paths[i])} ~ {os.path.basename(paths[j])}")
+    size = sum(os.path.getsize(paths[i]) for i in duplicates)
+    print(f"{len(duplicates)} of {len(paths)} images are near duplicates, {size / 2**20:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,29 @@
 import os
+import shutil
+import time
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from sqlalchemy import create_engine, text
-import torch
-from torchvision import models, transforms
-from torch.nn.functional import cosine_similarity
-from PIL import Image
+from sqlalchemy import text
 import glob
+import json
 import re
+import uuid
+from io import StringIO
+from sqlalchemy.exc import DBAPIError
+
+from cache_class import ImageResultCache
+from engine_class import get_engine, iris_dsn
+from filter_class import where_clause
+from image_hash import near_duplicates, perceptual_hash
+from tracing import span, traced
+from vector_index import create_hnsw_index, search_statement
+from model_store import ModelStore, MODELS_DIR
+
+# A new version per table every time its images are inserted, which the cached results are keyed on
+VERSIONS_TABLE = "image_table_versions"
 
 class ImageSearch:
-    def __init__(self, folder='../data/downloaded_images/*.jpg', name = "images", username = 'demo', password = 'demo', hostname='localhost', port='1972', namespace='USER', recalculate=False):
+    @traced('image_search.init')
+    def __init__(self, folder='../data/downloaded_images/*.jpg', name = "images", username = 'demo', password = 'demo', hostname='localhost', port='1972', namespace='USER', recalculate=False, models_dir=MODELS_DIR, ann_index=False, ann_params=None, result_cache_file=None, cache_max_entries=1000, cache_distance=4, dedup_distance=None, dedup_move_to=None):
         self.name = name
         self.username = username
         self.password = password
@@ -19,20 +32,47 @@ class ImageSearch:
         self.recalculate = recalculate
         self.namespace = namespace
         self.engine = None
-        self.model = models.resnet152(pretrained=True)
-        self.model.eval()
+        self.models_dir = models_dir
+        # Loaded by the first embedding, so the searches answered from the cache don't load it
+        self.model = None
         self.paths = glob.glob(folder)
         self.embeddings = False
+        self.search_stats = []
+        # e.g. result_cache_file='../data/image_result_cache.sqlite'
+        self.result_cache = ImageResultCache(result_cache_file, cache_max_entries, cache_distance) if result_cache_file else None
+        # Bits two photos of the same landmark can differ to be indexed once, None to index all of them
+        self.dedup_distance = dedup_distance
+        # Folder the dropped photos are moved to, e.g. to delete them after a look. None leaves them in place
+        self.dedup_move_to = dedup_move_to
+        self.dedup_stats = None
+        self.table_version = None
         self.connect_to_database()
         self.create_images_table()
         if self.embeddings == False:
             self.generate_embeddings()
             self.insert_data_into_database()
+        elif self.result_cache is not None:
+            self.table_version = self.read_table_version()
+        if ann_index:
+            # e.g. ann_params={'m': 32, 'ef_construction': 400}
+            create_hnsw_index(self.engine, self.name, **(ann_params or {}))
+
+    @traced('image_search.load_model')
+    def load_model(self):
+        # torch and torchvision are only imported once an ImageSearch is built
+        if self.models_dir:
+            # Memory-mapped weights, shared by all the processes of the host
+            self.model = ModelStore(self.models_dir).resnet152()
+        else:
+            from torchvision import models
+            self.model = models.resnet152(pretrained=True)
+            self.model.eval()
 
     def connect_to_database(self):
-        CONNECTION_STRING = f"iris://{self.username}:{self.password}@{self.hostname}:{self.port}/{self.namespace}"
-        self.engine = create_engine(CONNECTION_STRING)
+        # Shared with the other classes connecting to the same database
+        self.engine = get_engine(iris_dsn(self.username, self.password, self.hostname, self.port, self.namespace))
 
+    @traced('image_search.create_table')
     def create_images_table(self):
         s_values = {
             "float64": "DOUBLE",
@@ -57,16 +97,25 @@ class ImageSearch:
                     else:
                         self.embeddings = True
                 
+    def open_image(self, image_path):
+        from PIL import Image
+        return Image.open(image_path).convert('RGB')  # Convertir la imagen a RGB
+
     def load_image(self, image_path):
+        """
+        Get the input of the model for an image, given by its path or already opened.
+        """
+        from torchvision import transforms
         transform = transforms.Compose([
             transforms.Resize((224, 224)),
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
             ])
-        image = Image.open(image_path).convert('RGB')  # Convertir la imagen a RGB
+        image = self.open_image(image_path) if isinstance(image_path, str) else image_path
         image = transform(image).unsqueeze(0)  # Añade una dimensión al principio
         return image
-    def clean_image_name(self, file_path):
+    @staticmethod
+    def clean_image_name(file_path):
         base_name = os.path.basename(file_path).replace('.jpg', '')
         
         # Delete any numbers and underscores at the end of the file name
@@ -78,12 +127,57 @@ class ImageSearch:
         return clean_name
 
     def get_embedding(self, image_tensor):
+        import torch
+        if self.model is None:
+            self.load_model()
         with torch.no_grad():
             embedding = self.model(image_tensor)
         return embedding
+
+    @traced('image_search.dedup')
+    def prune_near_duplicates(self):
+        """
+        Leave out of the index the photos within dedup_distance bits of an earlier
+        photo of the same landmark, e.g. the same Flickr shot uploaded twice.
+
+        The files stay on disk unless dedup_move_to is set, then they are moved there.
+
+        Returns
+        -------
+        dict
+            The images kept and dropped, the bytes saved in the table, and the bytes of
+            the dropped files, moved out of the folder or that could be reclaimed.
+        """
+        hashes = [perceptual_hash(path) for path in self.paths]
+        duplicates = near_duplicates(hashes, [self.clean_image_name(path) for path in self.paths], self.dedup_distance)
+        dropped = [self.paths[i] for i in duplicates]
+        self.paths = [path for i, path in enumerate(self.paths) if i not in duplicates]
+        image_bytes = sum(os.path.getsize(path) for path in dropped)
+        if self.dedup_move_to:
+            os.makedirs(self.dedup_move_to, exist_ok=True)
+            for path in dropped:
+                shutil.move(path, os.path.join(self.dedup_move_to, os.path.basename(path)))
+        self.dedup_stats = {
+            'kept': len(self.paths),
+            'dropped': len(dropped),
+            # VECTOR(DOUBLE, 1000) plus the path
+            'table_bytes': sum(8 * 1000 + len(path.encode('utf-8')) for path in dropped),
+            'image_bytes': image_bytes,
+            'moved_to': self.dedup_move_to,
+        }
+        where = f"moved to {self.dedup_move_to}" if self.dedup_move_to else "that could be reclaimed"
+        print(f"Dropped {len(dropped)} near duplicate images of {len(hashes)}: "
+              f"{self.dedup_stats['table_bytes'] / 2**20:.1f} MB of vectors saved, "
+              f"{image_bytes / 2**20:.1f} MB of images {where}")
+        return self.dedup_stats
+
+    @traced('image_search.embed_corpus')
     def generate_embeddings(self):
+        if self.dedup_distance is not None:
+            self.prune_near_duplicates()
         self.image_embeddings = [self.get_embedding(self.load_image(img_path)) for img_path in self.paths]
 
+    @traced('image_search.insert')
     def insert_data_into_database(self):
         with self.engine.connect() as conn:
             with conn.begin():
@@ -97,20 +191,124 @@ class ImageSearch:
                     to_execute["monument_name"] = row
                     to_execute['description_vector'] = str(self.image_embeddings[index].tolist()[0])
                     conn.execute(sql, to_execute)
+        # Also when this instance has no cache: the results cached by the others are from the images indexed before
+        self.table_version = self.write_table_version()
+        if self.result_cache is not None:
+            self.result_cache.clear(self.name)
 
-    def search_similars(self, image_path, condition = "", number= 10):
-        search_vector = self.get_embedding(self.load_image(image_path)).tolist()[0]
+    def write_table_version(self):
+        version = uuid.uuid4().hex
         with self.engine.connect() as conn:
             with conn.begin():
-                sql = text(f"""
-                    SELECT TOP {number} * FROM {self.name} 
-                    {condition}
-                    ORDER BY VECTOR_COSINE(description_vector, TO_VECTOR(:search_vector)) DESC
-                """)
-                results = conn.execute(sql, {'search_vector': str(search_vector)}).fetchall()
-        results_df = pd.DataFrame(results, columns=["monument_name", "description_vector"])
-
-        results_df["monument_name"] = [self.clean_image_name(e) for e in results_df["monument_name"]]
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (
+                        name VARCHAR(200) PRIMARY KEY,
+                        version VARCHAR(32)
+                    )
+                """))
+                conn.execute(text(f"DELETE FROM {VERSIONS_TABLE} WHERE name = :name"), {'name': self.name})
+                conn.execute(text(f"INSERT INTO {VERSIONS_TABLE} (name, version) VALUES (:name, :version)"),
+                             {'name': self.name, 'version': version})
+        return version
+
+    def read_table_version(self):
+        try:
+            with self.engine.connect() as conn:
+                row = conn.execute(text(f"SELECT version FROM {VERSIONS_TABLE} WHERE name = :name"), {'name': self.name}).fetchone()
+        except DBAPIError:
+            # No table indexed since the versions were added
+            return None
+        return row[0] if row else None
+
+    def cache_source(self):
+        # The cached results of a table are only found again while its images are the same
+        return f"{self.name}@{self.table_version}" if self.table_version else self.name
+
+    def search_similars(self, image_path, use_cache=True, **kwargs):
+        """
+        Find the images closest to an image. See search_by_vector for the other arguments.
+
+        Parameters
+        ----------
+        use_cache : bool
+            Answer from the result cache when the same or a nearly identical image,
+            by perceptual hash, was searched before with the same arguments.
+        """
+        image = self.open_image(image_path)
+        params = None
+        if use_cache and self.result_cache is not None:
+            try:
+                params = json.dumps(kwargs, sort_keys=True)
+            except TypeError:
+                # e.g. a Filter, searched without the cache
+                params = None
+        if params is not None:
+            with span('image_search.cache') as attrs:
+                image_hash = perceptual_hash(image)
+                cached = self.result_cache.get(self.cache_source(), params, image_hash)
+                attrs['hit'] = cached is not None
+            if cached is not None:
+                return pd.read_json(StringIO(cached), orient='split', dtype=False)
+        with span('image_search.encode'):
+            search_vector = self.get_embedding(self.load_image(image)).tolist()[0]
+        results = self.search_by_vector(search_vector, **kwargs)
+        if params is not None:
+            self.result_cache.put(self.cache_source(), params, image_hash, results.to_json(orient='split'))
+        return results
+
+    def search_by_vector(self, search_vector, filters=None, number=10, columns=("monument_name",), include_vector=False, exact=False):
+        """
+        Find the images closest to an embedding of the model.
+
+        Parameters
+        ----------
+        search_vector : list
+            The embedding to look for.
+
+        filters : Filter or dict
+            Restrict the images by monument_name.
+
+        columns : tuple
+            The columns returned, monument_name and/or description_vector.
+
+        include_vector : bool
+            Also return description_vector, 1000 values per image.
+
+        exact : bool
+            Scan the whole table even if it has an ANN index, for exact results.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The images, most similar first, with their cosine similarity in the score column.
+        """
+        include_vector = include_vector or "description_vector" in columns
+        columns = [e for e in columns if e != "description_vector"]
+        unknown = [e for e in columns if e != "monument_name"]
+        if unknown:
+            raise ValueError(f"Unknown columns {unknown}. Choose from ['monument_name', 'description_vector'].")
+        if include_vector:
+            columns.append("description_vector")
+        # Only bound parameters, so every search of the same shape has the same statement text
+        where, params = where_clause(filters, allowed=["monument_name"])
+        start = time.perf_counter()
+        with span('image_search.vector_search', table=self.name, number=number) as attrs, self.engine.connect() as conn:
+            with conn.begin():
+                sql = text(search_statement(self.name, columns, where=where, exact=exact))
+                results = conn.execute(sql, {**params, 'number': int(number), 'search_vector': str(search_vector)}).fetchall()
+            attrs['rows'] = len(results)
+        fetched = time.perf_counter()
+        results_df = pd.DataFrame(results, columns=columns + ["score"])
+
+        if "monument_name" in results_df:
+            results_df["monument_name"] = [self.clean_image_name(e) for e in results_df["monument_name"]]
+        self.search_stats.append({
+            'statement': sql.text,
+            'rows': len(results_df),
+            'columns': len(columns) + 1,
+            'fetch_seconds': fetched - start,
+            'frame_seconds': time.perf_counter() - fetched,
+        })
         pd.set_option('display.max_colwidth', None)  # Easier to read description
         return results_df
 
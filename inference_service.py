@@ -0,0 +1,228 @@
+"""
+Asyncio query front end that encodes concurrent queries in micro-batches.
+
+Every encode request is queued; the batcher takes the first one, waits up to
+max_wait_ms for others to arrive, and encodes them all in a single call to the
+model. The database searches then run concurrently on the shared engine pool.
+
+The server speaks JSON lines over TCP. Every request is one line, e.g.
+{"text": "gothic cathedral", "number": 3, "columns": ["landmark", "city"]}
+or {"image": "../data/test_images/uni.jpg"}, and gets one line back with the
+rows found, or with an error.
+
+Usage: python inference_service.py [--port 8765] [--max-batch-size 32] [--max-wait-ms 5] [--images]
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class MicroBatcher:
+    def __init__(self, encode_batch, max_batch_size=32, max_wait_ms=5.0, executor=None):
+        """
+        Group the items submitted at the same time into batches.
+
+        Parameters
+        ----------
+        encode_batch : callable
+            Takes a list of items and returns the list of their results, in order.
+
+        max_batch_size : int
+            The largest batch run at once.
+
+        max_wait_ms : float
+            How long the first item of a batch waits for more items.
+
+        executor : concurrent.futures.Executor
+            Where the batches run, a single thread by default so the model is
+            never called twice at the same time.
+        """
+        self.encode_batch = encode_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.stats = []
+
+    async def submit(self, item):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.encode_batch, [item for item, _, _ in batch])
+            except Exception as exc:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            end = time.perf_counter()
+            self.stats.append({
+                'size': len(batch),
+                'queue_seconds': float(np.mean([start - queued for _, _, queued in batch])),
+                'seconds': end - start,
+            })
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.executor.shutdown(wait=False)
+
+    def report(self, name='batches'):
+        if not self.stats:
+            print(f"{name}: none")
+            return
+        sizes = [stats['size'] for stats in self.stats]
+        seconds = [stats['seconds'] * 1000 for stats in self.stats]
+        queue = [stats['queue_seconds'] * 1000 for stats in self.stats]
+        print(f"{name}: {len(self.stats)} batches, {sum(sizes)} items, size mean {np.mean(sizes):.1f} max {max(sizes)}, "
+              f"batch p50 {np.percentile(seconds, 50):.1f} ms p95 {np.percentile(seconds, 95):.1f} ms, "
+              f"queue mean {np.mean(queue):.1f} ms")
+
+
+class InferenceService:
+    def __init__(self, text_search=None, image_search=None, max_batch_size=32, max_wait_ms=5.0, search_workers=8):
+        """
+        Batched encoding in front of the searchers, which keep their models and tables.
+
+        Parameters
+        ----------
+        text_search : CloseSearch
+            Answers the text queries.
+
+        image_search : ImageSearch
+            Answers the image queries.
+
+        search_workers : int
+            The database searches run at the same time.
+        """
+        self.text_search = text_search
+        self.image_search = image_search
+        self.text_batcher = MicroBatcher(self.encode_texts, max_batch_size, max_wait_ms) if text_search else None
+        self.image_batcher = MicroBatcher(self.encode_images, max_batch_size, max_wait_ms) if image_search else None
+        self.search_executor = ThreadPoolExecutor(max_workers=search_workers)
+
+    def encode_texts(self, texts):
+        return self.text_search.model.encode(texts, batch_size=len(texts), normalize_embeddings=True).tolist()
+
+    def encode_images(self, paths):
+        import torch
+        images = torch.cat([self.image_search.load_image(path) for path in paths])
+        return self.image_search.get_embedding(images).tolist()
+
+    async def search(self, searcher, vector, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.search_executor, lambda: searcher.search_by_vector(vector, **kwargs))
+
+    async def search_text(self, text, **kwargs):
+        if self.text_batcher is None:
+            raise ValueError("The service has no text search.")
+        return await self.search(self.text_search, await self.text_batcher.submit(text), **kwargs)
+
+    async def search_image(self, image_path, **kwargs):
+        if self.image_batcher is None:
+            raise ValueError("The service has no image search.")
+        return await self.search(self.image_search, await self.image_batcher.submit(image_path), **kwargs)
+
+    async def handle(self, request):
+        request = dict(request)
+        kwargs = {key: request[key] for key in ('number', 'columns', 'filters') if key in request}
+        if 'text' in request:
+            results = await self.search_text(request['text'], **kwargs)
+        elif 'image' in request:
+            results = await self.search_image(request['image'], **kwargs)
+        else:
+            raise ValueError("A request needs a text or an image.")
+        return results.to_dict(orient='records')
+
+    async def handle_client(self, reader, writer):
+        while line := await reader.readline():
+            try:
+                response = {'results': await self.handle(json.loads(line))}
+            except Exception as exc:
+                response = {'error': str(exc)}
+            writer.write((json.dumps(response, default=str) + '\n').encode('utf-8'))
+            await writer.drain()
+        writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f"Serving on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        for batcher in (self.text_batcher, self.image_batcher):
+            if batcher is not None:
+                await batcher.close()
+        self.search_executor.shutdown(wait=False)
+
+    def report(self):
+        if self.text_batcher:
+            self.text_batcher.report('text batches')
+        if self.image_batcher:
+            self.image_batcher.report('image batches')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--file', default='../data/data.csv')
+    parser.add_argument('--name', default='monuments')
+    parser.add_argument('--images', default='', help="Also serve image queries on this folder, e.g. '../data/city_images/*.jpg'")
+    args = parser.parse_args()
+
+    from sql_class import CloseSearch
+    text_search = CloseSearch(file=args.file, name=args.name, textual_var="wiki_content", low_memory=True)
+    image_search = None
+    if args.images:
+        from images_class import ImageSearch
+        image_search = ImageSearch(folder=args.images, name="cities")
+    service = InferenceService(text_search, image_search, args.max_batch_size, args.max_wait_ms)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.report()
+
+
+if __name__ == "__main__":
+    main()
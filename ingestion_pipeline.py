@@ -0,0 +1,302 @@
+"""
+Run the city and landmark data builders as a graph of stages.
+
+Stages whose dependencies are done run at the same time, so the cities and the
+landmarks are built concurrently, and each stage spreads its items over its own
+pool of worker threads. A timing report is printed at the end.
+
+Usage: python ingestion_pipeline.py [--cities] [--landmarks] [--only STAGE,...]
+                                    [--workers STAGE=N,...] [--embeddings] [--maps]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from city_class import CreateDataCities
+from keyword_index import KeywordIndex, keyword_index_path
+from landmark_class import CreateDataLandmarks
+
+# Threads per stage. Nominatim allows one request per second: the coordinates stages of the
+# cities and of the landmarks run at the same time, so their requests also share a rate limiter,
+# see the NOMINATIM_RATE of the builders.
+DEFAULT_WORKERS = {
+    'wiki': 8,
+    'coordinates': 1,
+    'weather': 8,
+    'images': 8,
+    'maps': 4,
+}
+
+
+class Stage:
+    def __init__(self, name, func, deps=(), workers=1, count=None):
+        """
+        Parameters
+        ----------
+        name : str
+            The name of the stage, e.g. 'cities:wiki'.
+
+        func : callable
+            The function running the stage. It receives the number of workers.
+
+        deps : tuple
+            The names of the stages that must finish before this one.
+
+        workers : int
+            The number of worker threads of the stage.
+
+        count : callable
+            Returns the number of items processed, for the report.
+        """
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.workers = workers
+        self.count = count
+        self.start = None
+        self.seconds = None
+        self.items = None
+
+
+class IngestionPipeline:
+    def __init__(self):
+        self.stages = {}
+        self.start = None
+        self.seconds = None
+
+    def add_stage(self, name, func, deps=(), workers=1, count=None):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}.")
+        self.stages[name] = Stage(name, func, deps, workers, count)
+
+    def select(self, names):
+        """
+        Get the given stages together with everything they depend on.
+
+        Returns
+        -------
+        set
+            The names of the stages to run.
+        """
+        selected = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}. Choose from {list(self.stages)}.")
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.stages[name].deps)
+        return selected
+
+    def run(self, only=None):
+        """
+        Run the stages, each one as soon as its dependencies are done.
+
+        Parameters
+        ----------
+        only : list
+            The stages to run, with their dependencies. All of them by default.
+        """
+        selected = self.select(only) if only else set(self.stages)
+        done = set()
+        running = {}
+        for stage in self.stages.values():
+            stage.start = stage.seconds = stage.items = None
+        self.start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=max(len(selected), 1)) as executor:
+            while len(done) < len(selected):
+                for name in selected - done - set(running.values()):
+                    stage = self.stages[name]
+                    if all(dep in done for dep in stage.deps):
+                        print(f"Starting stage {name} ({stage.workers} workers)")
+                        stage.start = time.perf_counter()
+                        running[executor.submit(stage.func, stage.workers)] = name
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    stage = self.stages[name]
+                    stage.seconds = time.perf_counter() - stage.start
+                    # Let the running stages finish before raising, the builders write files
+                    if future.exception() is not None:
+                        wait(running)
+                        raise future.exception()
+                    stage.items = stage.count() if stage.count else None
+                    done.add(name)
+
+        self.seconds = time.perf_counter() - self.start
+        self.report()
+
+    def report(self):
+        print(f"\n{'stage':<24} {'workers':>7} {'start (s)':>10} {'time (s)':>9} {'items':>6} {'items/s':>8}")
+        ran = [stage for stage in self.stages.values() if stage.seconds is not None]
+        for stage in sorted(ran, key=lambda stage: stage.start):
+            items = '' if stage.items is None else stage.items
+            rate = '' if not stage.items else f"{stage.items / stage.seconds:.1f}"
+            print(f"{stage.name:<24} {stage.workers:>7} {stage.start - self.start:>10.2f} {stage.seconds:>9.2f} {items:>6} {rate:>8}")
+        print(f"{'total':<24} {'':>7} {'':>10} {self.seconds:>9.2f}")
+
+
+def add_city_stages(pipeline, cities_file, save_dir, from_csv='', workers=None, embeddings=False, maps=False):
+    """
+    Add the stages building the cities dataset and texts.
+
+    Returns
+    -------
+    CreateDataCities
+        The builder holding the data of the stages.
+    """
+    workers = {**DEFAULT_WORKERS, **(workers or {})}
+    builder = CreateDataCities(cities_file, save_dir, from_csv, run=False)
+    count = lambda: len(builder.cities)
+
+    if from_csv:
+        pipeline.add_stage('cities:names', lambda w: builder.load_csv(), count=count)
+        data_deps = ('cities:names',)
+        coordinates_dep = 'cities:names'
+    else:
+        def names(w):
+            builder.cities, builder.countries = builder.get_data_cities()
+
+        def wiki(w):
+            builder.wikipedia_data = builder.get_data_wikipedia(w)
+
+        def coordinates(w):
+            builder.coordinates = builder.get_coordinates(w)
+
+        pipeline.add_stage('cities:names', names, count=count)
+        pipeline.add_stage('cities:wiki', wiki, ('cities:names',), workers['wiki'], count)
+        pipeline.add_stage('cities:coordinates', coordinates, ('cities:names',), workers['coordinates'], count)
+        data_deps = ('cities:wiki',)
+        coordinates_dep = 'cities:coordinates'
+
+    pipeline.add_stage('cities:weather', builder.get_anual_weather_data, (coordinates_dep,), workers['weather'], count)
+    pipeline.add_stage('cities:dataset', lambda w: builder.save_dataset(), data_deps + ('cities:weather',), count=count)
+    pipeline.add_stage('cities:texts', lambda w: builder.save_texts(), ('cities:dataset',), count=count)
+
+    def city_keywords(w):
+        file = f"{builder.save_dir}/city.csv"
+        KeywordIndex.from_csv(file, 'city', 'wiki_content').save(keyword_index_path(file))
+
+    pipeline.add_stage('cities:keywords', city_keywords, ('cities:dataset',), count=count)
+
+    if maps:
+        def city_maps(w):
+            from map_class import MapRenderer
+            for error in MapRenderer().precompute_all(builder.cities, workers=w):
+                print(f"No base map for {error}")
+
+        pipeline.add_stage('cities:maps', city_maps, ('cities:dataset',), workers['maps'], count)
+
+    if embeddings:
+        def city_embeddings(w):
+            from sql_class import CloseSearch
+            CloseSearch(file=f"{builder.save_dir}/city.csv", name="city", textual_var="wiki_content", clear=True, low_memory=True)
+
+        def city_neighbors(w):
+            from neighbor_table import NeighborTable
+            # Every embedding was regenerated, so every row is recomputed
+            NeighborTable(table="city", key_column="city").build()
+
+        pipeline.add_stage('cities:embeddings', city_embeddings, ('cities:dataset',), count=count)
+        pipeline.add_stage('cities:neighbors', city_neighbors, ('cities:embeddings',), count=count)
+
+    return builder
+
+
+def add_landmark_stages(pipeline, landmarks_file, save_dir, from_csv='', images_from='flickr', workers=None, embeddings=False):
+    """
+    Add the stages building the landmarks dataset, images and texts.
+
+    Returns
+    -------
+    CreateDataLandmarks
+        The builder holding the data of the stages.
+    """
+    workers = {**DEFAULT_WORKERS, **(workers or {})}
+    builder = CreateDataLandmarks(landmarks_file, save_dir, from_csv, images_from, run=False)
+    count = lambda: len(builder.landmarks)
+
+    if from_csv:
+        pipeline.add_stage('landmarks:names', lambda w: builder.load_csv(), count=count)
+        dataset_dep = 'landmarks:names'
+    else:
+        def names(w):
+            builder.landmarks, builder.cities, builder.countries, builder.totals = builder.get_data_landmarks()
+
+        def wiki(w):
+            builder.wikipedia_data = builder.get_data_wikipedia(w)
+
+        def coordinates(w):
+            # Falls back to the Wikipedia title, so it needs the wiki stage
+            builder.coordinates = builder.get_coordinates(w)
+
+        pipeline.add_stage('landmarks:names', names, count=count)
+        pipeline.add_stage('landmarks:wiki', wiki, ('landmarks:names',), workers['wiki'], count)
+        pipeline.add_stage('landmarks:coordinates', coordinates, ('landmarks:wiki',), workers['coordinates'], count)
+        pipeline.add_stage('landmarks:dataset', lambda w: builder.save_dataset(), ('landmarks:coordinates',), count=count)
+        dataset_dep = 'landmarks:dataset'
+
+    pipeline.add_stage('landmarks:images', builder.get_images, (dataset_dep,), workers['images'], count)
+    pipeline.add_stage('landmarks:texts', lambda w: builder.save_texts(), (dataset_dep,), count=count)
+
+    def landmark_keywords(w):
+        file = builder.from_csv or f"{builder.save_dir}/data.csv"
+        KeywordIndex.from_csv(file, 'landmark', 'wiki_content').save(keyword_index_path(file))
+
+    pipeline.add_stage('landmarks:keywords', landmark_keywords, (dataset_dep,), count=count)
+
+    if embeddings:
+        def landmark_embeddings(w):
+            from sql_class import CloseSearch
+            from images_class import ImageSearch
+            CloseSearch(file=f"{builder.save_dir}/data.csv", name="monuments", textual_var="wiki_content", clear=True, low_memory=True)
+            folder = 'downloaded_images' if images_from == 'flickr' else 'downloaded_wiki_images'
+            # Near-identical Flickr shots of the same landmark are indexed once
+            ImageSearch(folder=f"{builder.save_dir}/{folder}/*.jpg", name="images", recalculate=True, dedup_distance=6)
+
+        def landmark_neighbors(w):
+            from neighbor_table import NeighborTable
+            NeighborTable(table="monuments", key_column="landmark").build()
+
+        pipeline.add_stage('landmarks:embeddings', landmark_embeddings, (dataset_dep, 'landmarks:images'), count=count)
+        pipeline.add_stage('landmarks:neighbors', landmark_neighbors, ('landmarks:embeddings',), count=count)
+
+    return builder
+
+
+def parse_workers(value):
+    workers = {}
+    for pair in filter(None, value.split(',')):
+        stage, n = pair.split('=')
+        workers[stage.strip()] = int(n)
+    return workers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cities', action='store_true', help="Build the cities (both by default)")
+    parser.add_argument('--landmarks', action='store_true', help="Build the landmarks (both by default)")
+    parser.add_argument('--cities-file', default='./data/city_names.inp')
+    parser.add_argument('--landmarks-file', default='./data/landmark_names.inp')
+    parser.add_argument('--cities-csv', default='')
+    parser.add_argument('--landmarks-csv', default='')
+    parser.add_argument('--images-from', default='flickr', choices=['flickr', 'wiki'])
+    parser.add_argument('--save-dir', default='./data')
+    parser.add_argument('--only', default='', help="Comma separated stages to run, with their dependencies")
+    parser.add_argument('--workers', default='', help="Comma separated stage=threads, e.g. wiki=16,images=4")
+    parser.add_argument('--embeddings', action='store_true', help="Also load the tables into IRIS")
+    parser.add_argument('--maps', action='store_true', help="Also draw the base maps of the cities")
+    args = parser.parse_args()
+
+    both = not args.cities and not args.landmarks
+    workers = parse_workers(args.workers)
+    pipeline = IngestionPipeline()
+    if args.cities or both:
+        add_city_stages(pipeline, args.cities_file, args.save_dir, args.cities_csv, workers, args.embeddings, args.maps)
+    if args.landmarks or both:
+        add_landmark_stages(pipeline, args.landmarks_file, args.save_dir, args.landmarks_csv, args.images_from, workers, args.embeddings)
+    pipeline.run(only=[name for name in args.only.split(',') if name])
@@ -0,0 +1,190 @@
+"""
+In-process BM25 inverted index over the Wikipedia texts, used to prefilter the
+rows of a vector search to the ones sharing words with the query.
+
+The index of a dataset is built at ingestion time next to its CSV, e.g.
+data/data.csv -> data/data.keywords.npz:
+
+Usage: python keyword_index.py CSV_FILE [--key landmark] [--text wiki_content] [--query "gothic cathedral"]
+"""
+import argparse
+import math
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+STOP_WORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the this to was were which with
+""".split())
+
+
+def tokenize(text):
+    return [token for token in TOKEN.findall(str(text).lower()) if len(token) > 1 and token not in STOP_WORDS]
+
+
+def keyword_index_path(file):
+    return os.path.splitext(file)[0] + '.keywords.npz'
+
+
+class KeywordIndex:
+    def __init__(self, keys, terms, offsets, doc_ids, frequencies, lengths, key_column='landmark', k1=1.2, b=0.75):
+        """
+        Postings of every term in compressed sparse row form: the documents of
+        terms[i] are doc_ids[offsets[i]:offsets[i + 1]], with their term
+        frequencies in the same slice of frequencies.
+
+        Parameters
+        ----------
+        keys : numpy.ndarray
+            The value of key_column of every document, e.g. the landmark name.
+
+        key_column : str
+            The column of the table the keys are matched on.
+
+        k1, b : float
+            The BM25 term frequency saturation and length normalization.
+        """
+        self.keys = keys
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.key_column = key_column
+        self.k1 = k1
+        self.b = b
+        self.term_ids = {term: i for i, term in enumerate(terms.tolist())}
+        self.average_length = float(lengths.mean()) if len(lengths) else 0.0
+
+    @classmethod
+    def build(cls, keys, texts, key_column='landmark', **kwargs):
+        postings = {}
+        lengths = []
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, count))
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        doc_ids = np.fromiter((doc_id for term in terms for doc_id, _ in postings[term]), dtype=np.int32, count=offsets[-1])
+        frequencies = np.fromiter((min(count, 65535) for term in terms for _, count in postings[term]),
+                                  dtype=np.uint16, count=offsets[-1])
+        return cls(np.array(keys, dtype=str), np.array(terms, dtype=str), offsets, doc_ids, frequencies,
+                   np.array(lengths, dtype=np.int32), key_column, **kwargs)
+
+    @classmethod
+    def from_csv(cls, file, key_column='landmark', text_column='wiki_content', chunk_size=1000):
+        """
+        Build the index of a dataset, reading its texts in chunks.
+        """
+        keys, texts = [], []
+        for chunk in pd.read_csv(file, usecols=[key_column, text_column], chunksize=chunk_size):
+            keys.extend(chunk[key_column].tolist())
+            # Only the tokens are kept, not the texts
+            texts.extend(' '.join(tokenize(text)) for text in chunk[text_column].fillna(''))
+        return cls.build(keys, texts, key_column)
+
+    def save(self, path):
+        np.savez_compressed(path, keys=self.keys, terms=self.terms, offsets=self.offsets, doc_ids=self.doc_ids,
+                            frequencies=self.frequencies, lengths=self.lengths, key_column=np.array(self.key_column),
+                            params=np.array([self.k1, self.b]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            k1, b = data['params'].tolist()
+            return cls(data['keys'], data['terms'], data['offsets'], data['doc_ids'], data['frequencies'],
+                       data['lengths'], str(data['key_column']), k1, b)
+
+    def scores(self, query):
+        """
+        BM25 score of every document for the query.
+
+        Returns
+        -------
+        numpy.ndarray
+            One score per document, 0 for the documents without any term of the query.
+        """
+        scores = np.zeros(len(self.keys), dtype=np.float32)
+        n = len(self.keys)
+        for term in set(tokenize(query)):
+            i = self.term_ids.get(term)
+            if i is None:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            ids, tf = self.doc_ids[start:end], self.frequencies[start:end].astype(np.float32)
+            idf = math.log(1 + (n - (end - start) + 0.5) / ((end - start) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[ids] / self.average_length)
+            # A term appears once in the postings of a document, so the ids are unique
+            scores[ids] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query, number=100):
+        """
+        Get the best matches of the query.
+
+        Returns
+        -------
+        list
+            (key, score) of at most number documents with a match, best first.
+        """
+        scores = self.scores(query)
+        matches = np.flatnonzero(scores)
+        if len(matches) > number:
+            matches = matches[np.argpartition(-scores[matches], number - 1)[:number]]
+        matches = matches[np.argsort(-scores[matches], kind='stable')]
+        return [(str(self.keys[i]), float(scores[i])) for i in matches]
+
+    def candidates(self, query, number=100):
+        """
+        Get the keys of the best matches, padded with the last one to exactly
+        number keys so the IN list of the search keeps the same statement text.
+        """
+        keys = [key for key, _ in self.search(query, number)]
+        return keys + keys[-1:] * (number - len(keys)) if keys else []
+
+
+def load_or_build(file, key_column, text_column='wiki_content'):
+    """
+    Load the index saved next to a CSV, building and saving it if it is missing or older.
+    """
+    path = keyword_index_path(file)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(file):
+        return KeywordIndex.load(path)
+    index = KeywordIndex.from_csv(file, key_column, text_column)
+    index.save(path)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('--key', default='landmark')
+    parser.add_argument('--text', default='wiki_content')
+    parser.add_argument('--query', default='')
+    parser.add_argument('--number', type=int, default=10)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = KeywordIndex.from_csv(args.file, args.key, args.text)
+    index.save(keyword_index_path(args.file))
+    print(f"{len(index.keys)} documents, {len(index.terms)} terms, {len(index.doc_ids)} postings "
+          f"in {time.perf_counter() - start:.2f} s, saved to {keyword_index_path(args.file)}")
+    if args.query:
+        start = time.perf_counter()
+        results = index.search(args.query, args.number)
+        print(f"{(time.perf_counter() - start) * 1000:.2f} ms")
+        for key, score in results:
+            print(f"{score:8.3f}  {key}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,11 @@ import time
 import os
 import numpy as np
 from dotenv import load_dotenv
+from parallel import parallel_map, wait_for
+from text_corpus import CorpusWriter, corpus_path
 
 class CreateDataLandmarks:
-	def __init__(self, landmarks_file: str, save_dir: str, from_csv: str = '', images_from = 'flickr'):
+	def __init__(self, landmarks_file: str, save_dir: str, from_csv: str = '', images_from = 'flickr', run: bool = True):
 		"""
 		Parameters
 		----------
@@ -22,34 +24,67 @@ class CreateDataLandmarks:
 
 		images_from : str
 			The source of the images. Either 'flickr' or 'wiki'.
+
+		run : bool
+			Whether to run the whole pipeline right away. Use False to run the stages one by one.
 		"""
 		self.landmarks_file: str = landmarks_file
 		self.from_csv: str = from_csv
 		self.save_dir: str = save_dir.removesuffix('/')
 		self.URL: str = "https://en.wikipedia.org/w/api.php"
+		self.NOMINATIM_DOMAIN: str = "nominatim.openstreetmap.org"
+		self.NOMINATIM_SCHEME: str = "https"
+		# Requests per second to Nominatim, shared with every builder geocoding on the same domain
+		self.NOMINATIM_RATE: float = 1.0
+		self.FLICKR_URL: str = "https://api.flickr.com/services/rest/"
+		self.images_from: str = images_from
+
+		if run:
+			self.run()
 
-		if not from_csv:
+	def run(self):
+		"""
+		Run all the stages in sequence.
+		"""
+		if not self.from_csv:
 			self.landmarks, self.cities, self.countries, self.totals = self.get_data_landmarks()
 			self.wikipedia_data: dict = self.get_data_wikipedia()
 			self.coordinates: dict = self.get_coordinates()
 
 			self.save_dataset()
 		else:
-			self.df = pd.read_csv(from_csv)
-			self.landmarks = self.df['landmark'].tolist()
-			self.cities = self.df['city'].tolist()
-			self.countries = self.df['country'].tolist()
-			self.totals = [f"{landmark}, {city}, {country}" for landmark, city, country in zip(self.landmarks, self.cities, self.countries)]
-			self.coordinates = {'latitude': self.df['latitude'].tolist(), 'longitude': self.df['longitude'].tolist()}
-			self.wikipedia_data = {total: {'title': title, 'content': content} for total, title, content in zip(self.totals, self.df['wiki_title'].tolist(), self.df['wiki_content'].tolist())}
+			self.load_csv()
 		
-		if images_from == 'flickr':
-			self.download_images()
-		elif images_from == 'wiki':
-			self.get_wiki_images()
+		self.get_images()
 
 		self.save_texts()
 
+	def load_csv(self):
+		"""
+		Load the landmarks, coordinates and Wikipedia data from the precalculated dataset.
+		"""
+		self.df = pd.read_csv(self.from_csv)
+		self.landmarks = self.df['landmark'].tolist()
+		self.cities = self.df['city'].tolist()
+		self.countries = self.df['country'].tolist()
+		self.totals = [f"{landmark}, {city}, {country}" for landmark, city, country in zip(self.landmarks, self.cities, self.countries)]
+		self.coordinates = {'latitude': self.df['latitude'].tolist(), 'longitude': self.df['longitude'].tolist()}
+		self.wikipedia_data = {total: {'title': title, 'content': content} for total, title, content in zip(self.totals, self.df['wiki_title'].tolist(), self.df['wiki_content'].tolist())}
+
+	def get_images(self, workers: int = 1):
+		"""
+		Download the images of the landmarks from the configured source.
+
+		Parameters
+		----------
+		workers : int
+			The number of landmarks to download at the same time.
+		"""
+		if self.images_from == 'flickr':
+			self.download_images(workers)
+		elif self.images_from == 'wiki':
+			self.get_wiki_images(workers)
+
 	def get_data_landmarks(self):
 		"""
 		Get the data from the file containing the landmarks.
@@ -71,40 +106,50 @@ class CreateDataLandmarks:
 
 		return landmarks, cities, countries, names
 	
-	def get_coordinates(self):
+	def get_coordinates(self, workers: int = 1):
 		"""
 		Get the coordinates of the landmarks.
 
+		Parameters
+		----------
+		workers : int
+			The number of landmarks to geocode at the same time.
+
 		Returns
 		-------
 		dict
 			The dictionary of the locations.
 		"""
-		geolocator = geopy.Nominatim(user_agent="landmarks", timeout=10)
-		coordinates = {'latitude': [], 'longitude': [], 'altitude': []}
-		for total in self.totals:
-			location = geolocator.geocode(total)
-			if location is None:
-				# Try getting the location from the Wikipedia data
-				new_landmark = self.wikipedia_data[total]['title']
-				if new_landmark is not None:
-					location = geolocator.geocode(new_landmark)
-				
-				if location is None:
-					print(f"Location not found for {total}.")
-					coordinates['latitude'].append(None)
-					coordinates['longitude'].append(None)
-					coordinates['altitude'].append(None)
-				else:
-					coordinates['latitude'].append(location.latitude)
-					coordinates['longitude'].append(location.longitude)
-					coordinates['altitude'].append(location.altitude)
-			else:
-				coordinates['latitude'].append(location.latitude)
-				coordinates['longitude'].append(location.longitude)
-				coordinates['altitude'].append(location.altitude)
+		geolocator = geopy.Nominatim(user_agent="landmarks", timeout=10, domain=self.NOMINATIM_DOMAIN, scheme=self.NOMINATIM_SCHEME)
+		locations = parallel_map(lambda total: self.get_location(geolocator, total), self.totals, workers)
+		coordinates = {'latitude': [l[0] for l in locations],
+					   'longitude': [l[1] for l in locations],
+					   'altitude': [l[2] for l in locations]}
 		return coordinates
 
+	def get_location(self, geolocator, total: str):
+		"""
+		Get the latitude, longitude and altitude of a landmark.
+
+		Returns
+		-------
+		tuple
+			The coordinates, or None values if the landmark is not found.
+		"""
+		wait_for(self.NOMINATIM_DOMAIN, self.NOMINATIM_RATE)
+		location = geolocator.geocode(total)
+		if location is None:
+			# Try getting the location from the Wikipedia data
+			new_landmark = self.wikipedia_data[total]['title']
+			if new_landmark is not None:
+				wait_for(self.NOMINATIM_DOMAIN, self.NOMINATIM_RATE)
+				location = geolocator.geocode(new_landmark)
+			
+			if location is None:
+				print(f"Location not found for {total}.")
+				return None, None, None
+		return location.latitude, location.longitude, location.altitude
+
 	def search_wikipedia(self, total: str):
 		"""
 		Search for a Wikipedia page by title and return the best match.
@@ -134,108 +179,82 @@ class CreateDataLandmarks:
 		else:
 			return None
 		
-	def get_wiki_images(self):
+	def get_wiki_images(self, workers: int = 1):
+		"""
+		Download the main image of the Wikipedia page of every landmark, falling back to Flickr.
+
+		Parameters
+		----------
+		workers : int
+			The number of landmarks to download at the same time.
+		"""
+		# Load the API key from .env
+		load_dotenv()
+
+		self.flickr_api_key = os.environ.get('FLICKR_API_KEY')
+
+		parallel_map(self.get_wiki_image, range(len(self.totals)), workers)
+
+	def get_wiki_image(self, i: int):
+		"""
+		Download the main image of the Wikipedia page of the i-th landmark, falling back to Flickr.
+		"""
+		total = self.totals[i]
+		title = self.search_wikipedia(total)
+		if title is None:
+			print(f"No Wikipedia page found for {total}.")
+			return
 		
-		for i, total in enumerate(self.totals):
-			title = self.search_wikipedia(total)
-			if title is None:
-				print(f"No Wikipedia page found for {total}.")
-				continue
+		PARAMS = {
+			'action': "query",
+			'format': "json",
+			'titles': title,
+			'prop': 'pageimages',
+			'pithumbsize': 500
+		}
+		response = requests.get(self.URL, params=PARAMS)
+		data = response.json()
+		pages = data['query']['pages']
+		result = None
+		for page in pages.values():
+			if 'thumbnail' in page:
+				image_url = page['thumbnail']['source']
+				result = image_url
+
+		if result is not None:
+			directory = f"{self.save_dir}/downloaded_wiki_images"
+
+			os.makedirs(directory, exist_ok=True)
+
+			filename = f'{total.replace(" ", "_").replace(".", "").replace(",", "")}.jpg'
+			try:
+				response = requests.get(result)
+				with open(os.path.join(directory, filename), 'wb') as f:
+					f.write(response.content)
+					print(f"Downloaded image for {total}.")
+			except requests.RequestException as e:
+				print(f"Error downloading image {filename}: {e}")
+		else:
+			print(f"No image found for {total} (Wiki page found: {title}). Trying with flickr.")
+
+			directory = f"{self.save_dir}/downloaded_images"
+
+			os.makedirs(directory, exist_ok=True)
+
+			landmark = self.landmarks[i]
+			images = self.fetch_images(landmark, num_images=1)
+			image = images[0] if images else None
 			
-			PARAMS = {
-				'action': "query",
-				'format': "json",
-				'titles': title,
-				'prop': 'pageimages',
-				'pithumbsize': 500
-			}
-			response = requests.get(self.URL, params=PARAMS)
-			data = response.json()
-			pages = data['query']['pages']
-			result = None
-			for page in pages.values():
-				if 'thumbnail' in page:
-					image_url = page['thumbnail']['source']
-					result = image_url
-
-			if result is not None:
-				directory = f"{self.save_dir}/downloaded_wiki_images"
-
-				if not os.path.exists(directory):
-					os.makedirs(directory)
-
-				filename = f'{total.replace(" ", "_").replace(".", "").replace(",", "")}.jpg'
+			if image is not None:
+				filename = f'{total.replace(" ", "_").replace(".", "").replace(",", "")}.jpg'  # Replace spaces with underscores and append the index
 				try:
-					response = requests.get(result)
+					response = requests.get(image)
+					response.raise_for_status()
 					with open(os.path.join(directory, filename), 'wb') as f:
 						f.write(response.content)
 						print(f"Downloaded image for {total}.")
 				except requests.RequestException as e:
 					print(f"Error downloading image {filename}: {e}")
-			else:
-				print(f"No image found for {total} (Wiki page found: {title}). Trying with flickr.")
-
-				def fetch_images(text_search, num_images=1):
-					url = 'https://api.flickr.com/services/rest/'
-					images = []
-					page = 1
-
-					while len(images) < num_images:
-						params = {
-							'method': 'flickr.photos.search',
-							'api_key': self.flickr_api_key,
-							'text': text_search,
-							'sort': 'relevance',
-							'media': 'photos',
-							'safe_search': 1,
-							'extras': 'url_l',  # 'url_l' is more likely to be available
-							'format': 'json',
-							'nojsoncallback': 1,
-							'per_page': 100,  # Fetch more photos per request
-							'page': page
-						}
-
-						try:
-							response = requests.get(url, params=params)
-							response.raise_for_status()
-							photos = response.json()['photos']['photo']
-							for photo in photos:
-								if 'url_l' in photo and len(images) < num_images:
-									images.append(photo['url_l'])
-							page += 1
-						except requests.RequestException as e:
-							print(f"Error fetching data: {e}")
-							break
-
-					return images
-				
-				# Fetch images for each landmark
-
-				# Load the API key from .env
-				load_dotenv()
-
-				self.flickr_api_key = os.environ.get('FLICKR_API_KEY')
-
-				directory = f"{self.save_dir}/downloaded_images"
-
-				if not os.path.exists(directory):
-							os.makedirs(directory)
-
-				index = self.totals.index(total)
-				landmark = self.landmarks[index]
-				images = fetch_images(landmark, num_images=1)
-				image = images[0] if images else None
-				
-				if image is not None:
-					filename = f'{self.totals[i].replace(" ", "_").replace(".", "").replace(",", "")}.jpg'  # Replace spaces with underscores and append the index
-					try:
-						response = requests.get(image)
-						response.raise_for_status()
-						with open(os.path.join(directory, filename), 'wb') as f:
-							f.write(response.content)
-							print(f"Downloaded image for {total}.")
-					except requests.RequestException as e:
-						print(f"Error downloading image {filename}: {e}")
 
 	def get_wikipedia_content(self, title: str):
 		"""
@@ -269,76 +288,94 @@ class CreateDataLandmarks:
 		else:
 			return None
 
-	def get_data_wikipedia(self):
+	def get_data_wikipedia(self, workers: int = 1):
 		"""
 		Get all the data from Wikipedia for the landmarks.
 
+		Parameters
+		----------
+		workers : int
+			The number of landmarks to fetch at the same time.
+
 		Returns
 		-------
 		dict
 			The dictionary of the Wikipedia data.
 		"""
-		wikipedia_data = {}
-		for i, total in enumerate(self.totals):
-			print(f"Getting Wikipedia data for {total} ({i}/{len(self.landmarks)})")
-			searched_title = self.search_wikipedia(total)
-			content = self.get_wikipedia_content(searched_title) if searched_title is not None else None
-			
-			wikipedia_data[total] = {'content': content, 'title': searched_title}
+		entries = parallel_map(self.get_wikipedia_entry, range(len(self.totals)), workers)
+		wikipedia_data = {total: entry for total, entry in zip(self.totals, entries)}
 			
 		return wikipedia_data
 
-	def download_images(self):
+	def get_wikipedia_entry(self, i: int):
 		"""
-		Download images from Flickr API based on the landmarks.
+		Get the title and content of the Wikipedia page of the i-th landmark.
+
+		Returns
+		-------
+		dict
+			The title and content, None when no page is found.
 		"""
+		total = self.totals[i]
+		print(f"Getting Wikipedia data for {total} ({i}/{len(self.landmarks)})")
+		searched_title = self.search_wikipedia(total)
+		content = self.get_wikipedia_content(searched_title) if searched_title is not None else None
+		
+		return {'content': content, 'title': searched_title}
 
-		def fetch_images(text_search, num_images=10):
-			"""
-			Fetches images from Flickr API based on a text search, ensuring it gathers a specified number of valid image URLs.
-
-			Args:
-				text_search (str): Text to search for
-				num_images (int): Desired number of images to fetch
-
-			Returns:
-				list: List of image URLs
-			"""
-			url = 'https://api.flickr.com/services/rest/'
-			images = []
-			page = 1
-
-			while len(images) < num_images:
-				params = {
-					'method': 'flickr.photos.search',
-					'api_key': self.flickr_api_key,
-					'text': text_search,
-					'sort': 'relevance',
-					'media': 'photos',
-					'safe_search': 1,
-					'extras': 'url_l',  # 'url_l' is more likely to be available
-					'format': 'json',
-					'nojsoncallback': 1,
-					'per_page': 100,  # Fetch more photos per request
-					'page': page
-				}
+	def fetch_images(self, text_search, num_images=10):
+		"""
+		Fetches images from Flickr API based on a text search, ensuring it gathers a specified number of valid image URLs.
 
-				try:
-					response = requests.get(url, params=params)
-					response.raise_for_status()
-					photos = response.json()['photos']['photo']
-					for photo in photos:
-						if 'url_l' in photo and len(images) < num_images:
-							images.append(photo['url_l'])
-					page += 1
-				except requests.RequestException as e:
-					print(f"Error fetching data: {e}")
-					break
+		Args:
+			text_search (str): Text to search for
+			num_images (int): Desired number of images to fetch
 
-			return images
-		
-		# Fetch images for each landmark
+		Returns:
+			list: List of image URLs
+		"""
+		url = self.FLICKR_URL
+		images = []
+		page = 1
+
+		while len(images) < num_images:
+			params = {
+				'method': 'flickr.photos.search',
+				'api_key': self.flickr_api_key,
+				'text': text_search,
+				'sort': 'relevance',
+				'media': 'photos',
+				'safe_search': 1,
+				'extras': 'url_l',  # 'url_l' is more likely to be available
+				'format': 'json',
+				'nojsoncallback': 1,
+				'per_page': 100,  # Fetch more photos per request
+				'page': page
+			}
+
+			try:
+				response = requests.get(url, params=params)
+				response.raise_for_status()
+				photos = response.json()['photos']['photo']
+				for photo in photos:
+					if 'url_l' in photo and len(images) < num_images:
+						images.append(photo['url_l'])
+				page += 1
+			except requests.RequestException as e:
+				print(f"Error fetching data: {e}")
+				break
+
+		return images
+
+	def download_images(self, workers: int = 1):
+		"""
+		Download images from Flickr API based on the landmarks.
 
+		Parameters
+		----------
+		workers : int
+			The number of landmarks to download at the same time.
+		"""
 		# Load the API key from .env
 		load_dotenv()
 
@@ -346,44 +383,49 @@ class CreateDataLandmarks:
 
 		directory = f"{self.save_dir}/downloaded_images"
 
-		if not os.path.exists(directory):
-					os.makedirs(directory)
+		os.makedirs(directory, exist_ok=True)
 
-		for i, landmark in enumerate(self.landmarks):
-			print(f"Downloading images for {landmark} ({i+1}/{len(self.landmarks)})")
-			images = fetch_images(landmark, num_images=3)
-			
-			for j, image_url in enumerate(images):
-				filename = f'{self.totals[i].replace(" ", "_").replace(".", "").replace(",", "")}_{j+1}.jpg'  # Replace spaces with underscores and append the index
-				try:
-					response = requests.get(image_url)
-					response.raise_for_status()
-					with open(os.path.join(directory, filename), 'wb') as f:
-						f.write(response.content)
-				except requests.RequestException as e:
-					print(f"Error downloading image {filename}: {e}")
+		parallel_map(self.download_landmark_images, range(len(self.landmarks)), workers)
 
-	def save_texts(self):
+	def download_landmark_images(self, i: int):
+		"""
+		Download three Flickr images of the i-th landmark.
 		"""
-		Save the content of the Wikipedia pages to text files.
+		landmark = self.landmarks[i]
+		directory = f"{self.save_dir}/downloaded_images"
+		print(f"Downloading images for {landmark} ({i+1}/{len(self.landmarks)})")
+		images = self.fetch_images(landmark, num_images=3)
+		
+		for j, image_url in enumerate(images):
+			filename = f'{self.totals[i].replace(" ", "_").replace(".", "").replace(",", "")}_{j+1}.jpg'  # Replace spaces with underscores and append the index
+			try:
+				response = requests.get(image_url)
+				response.raise_for_status()
+				with open(os.path.join(directory, filename), 'wb') as f:
+					f.write(response.content)
+			except requests.RequestException as e:
+				print(f"Error downloading image {filename}: {e}")
+
+	def save_texts(self, compress: bool = False):
 		"""
-		dir_name = f"{self.save_dir}/texts"
-		if not os.path.exists(dir_name):
-			os.makedirs(dir_name)  # Create save directory if it doesn't exist
+		Save the content of the Wikipedia pages to the packed corpus of texts.
 
+		Parameters
+		----------
+		compress : bool
+			Whether to compress every text with zlib.
+		"""
 		if self.from_csv:
 			self.df = pd.read_csv(self.from_csv)
 			texts = self.df['wiki_content'].tolist()
 		else:
 			texts = [self.wikipedia_data[total]['content'] for total in self.totals]
 
-		for i, text in enumerate(texts):
-			# Construct a path to save the text
-			file_path = os.path.join(dir_name, self.totals[i].replace(' ', '_').replace('.', '').replace(',', '') + '.txt')
-
-			# Write the text to a file
-			with open(file_path, 'w', encoding='utf-8') as f:
-				f.write(text)
+		# One file for all the landmarks, read with text_corpus.open_corpus
+		with CorpusWriter(corpus_path(f"{self.save_dir}/texts"), compress) as corpus:
+			for i, text in enumerate(texts):
+				# Named like the text files written before
+				corpus.add(self.totals[i].replace(' ', '_').replace('.', '').replace(',', '') + '.txt', text)
 	
 	def save_dataset(self):
 		"""
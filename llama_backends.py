@@ -0,0 +1,143 @@
+import json
+import threading
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.callbacks import TokenCountingHandler
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.vector_stores.types import VectorStoreQueryResult
+from llama_index.vector_stores.utils import metadata_dict_to_node
+from llama_iris import IRISVectorStore
+from sqlalchemy import select, text
+
+from engine_class import get_engine
+
+
+class LocalEmbedding(BaseEmbedding):
+    """
+    Embeds on the CPU with fastembed, a whole batch of chunks per ONNX call.
+    """
+    _model = PrivateAttr()
+
+    def __init__(self, model_name="BAAI/bge-base-en-v1.5", embed_batch_size=64, threads=None):
+        from fastembed import TextEmbedding
+        super().__init__(model_name=model_name, embed_batch_size=embed_batch_size)
+        self._model = TextEmbedding(model_name=model_name, threads=threads)
+
+    @classmethod
+    def class_name(cls):
+        return "LocalEmbedding"
+
+    @property
+    def embed_dim(self):
+        from fastembed import TextEmbedding
+        for model in TextEmbedding.list_supported_models():
+            if model["model"] == self.model_name:
+                return model["dim"]
+        return len(self._get_text_embedding("dimension"))
+
+    def _get_query_embedding(self, query):
+        return next(iter(self._model.query_embed(query))).tolist()
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return [embedding.tolist() for embedding in self._model.embed(texts, batch_size=self.embed_batch_size)]
+
+
+class ThreadTokenCounter(TokenCountingHandler):
+    """
+    TokenCountingHandler keeping the counts of every thread apart, so the queries
+    answered at the same time, e.g. by precompute_responses, each read their own.
+    The callbacks of a query run in the thread that queries.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        super().__init__(*args, **kwargs)
+
+    def _counts(self):
+        if not hasattr(self._local, 'llm'):
+            self._local.llm, self._local.embedding = [], []
+        return self._local
+
+    @property
+    def llm_token_counts(self):
+        return self._counts().llm
+
+    @llm_token_counts.setter
+    def llm_token_counts(self, value):
+        self._counts().llm = value
+
+    @property
+    def embedding_token_counts(self):
+        return self._counts().embedding
+
+    @embedding_token_counts.setter
+    def embedding_token_counts(self, value):
+        self._counts().embedding = value
+
+
+class ScopedIRISVectorStore(IRISVectorStore):
+    """
+    IRISVectorStore that honours the doc_ids of a query, restricting the vector
+    search to the rows of those documents, and runs on the shared engine of its
+    connection string instead of a pool of its own.
+    """
+
+    @classmethod
+    def class_name(cls):
+        return "ScopedIRISVectorStore"
+
+    def _connect(self):
+        from llama_iris.vectorstore import get_data_model
+        from sqlalchemy.orm import declarative_base, sessionmaker
+        self._engine = get_engine(self.connection_string)
+        self._session = sessionmaker(self._engine)
+        with self._engine.connect() as conn:
+            self._native_vector = conn.dialect.supports_vectors
+        self._base = declarative_base()
+        self._table_class = get_data_model(
+            self._base,
+            self.table_name,
+            self.schema_name,
+            embed_dim=self.embed_dim,
+            native_vector=self._native_vector,
+        )
+
+    async def close(self):
+        # The engine belongs to the registry and stays open for the other users
+        pass
+
+    def query(self, query, **kwargs):
+        if not query.doc_ids:
+            return super().query(query, **kwargs)
+
+        self._initialize()
+        query_embedding = [float(v) for v in query.query_embedding]
+        table = self._table_class
+        distance = (
+            table.embedding.cosine(query_embedding)
+            if self._native_vector
+            else table.embedding.func("llamaindex_cosine_distance", query_embedding)
+        ).label("distance")
+        stmt = (
+            select(table.node_id, table.text, table.metadata_.label("metadata"), distance)
+            .where(table.partition_id.in_(query.doc_ids))
+            .order_by(text("distance asc"))
+            .limit(query.similarity_top_k)
+        )
+        with self._session() as session, session.begin():
+            rows = session.execute(stmt).fetchall()
+
+        nodes, similarities, ids = [], [], []
+        for row in rows:
+            node = metadata_dict_to_node(json.loads(row.metadata))
+            node.set_content(str(row.text))
+            similarities.append((1 - float(row.distance)) if row.distance is not None else 0)
+            ids.append(row.node_id)
+            nodes.append(node)
+        return VectorStoreQueryResult(nodes=nodes, similarities=similarities, ids=ids)
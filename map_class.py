@@ -0,0 +1,233 @@
+"""
+Precomputed city base maps with a fast marker overlay.
+
+Drawing the osmnx polygon of a city with matplotlib takes seconds, so every
+city of city.csv is drawn once to data/base_maps/<city>.png, together with the
+transform from longitude/latitude to the pixels of the image (<city>.json).
+A request then only draws its landmark markers on a copy of the base map, in
+milliseconds, and writes it to a file of its own, or returns the PNG bytes.
+
+Usage: python map_class.py [--cities ./data/city.csv] [--only Paris,Rome] [--rebuild] [--workers 4]
+"""
+import argparse
+import glob
+import json
+import os
+import time
+import uuid
+from functools import lru_cache
+
+import pandas as pd
+
+from parallel import parallel_map
+from tracing import span
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASE_MAPS_DIR = os.path.join(ROOT, 'data', 'base_maps')
+MAPS_DIR = os.path.join(ROOT, 'data', 'maps')
+
+
+def unique_map_path(directory=MAPS_DIR):
+    """
+    Get a new file name for the map of a request.
+    """
+    return os.path.join(directory, f"map_{uuid.uuid4().hex}.png")
+
+
+def prune_maps(directory=MAPS_DIR, max_age=3600):
+    """
+    Remove the maps of the requests older than max_age seconds.
+    """
+    now = time.time()
+    for path in glob.glob(os.path.join(directory, 'map_*.png')):
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            # Removed by another request in the meantime
+            pass
+
+
+@lru_cache(maxsize=32)
+def load_base(image_path, mtime):
+    # Keyed on the modification time too, so a rebuilt base map is reloaded
+    from PIL import Image
+    with Image.open(image_path) as image:
+        return image.convert('RGB')
+
+
+class MapRenderer:
+    def __init__(self, directory=BASE_MAPS_DIR, figsize=(12, 8), dpi=100, marker_radius=5, marker_color=(255, 0, 0), max_age=3600):
+        """
+        Parameters
+        ----------
+        directory : str
+            The folder of the base maps.
+
+        figsize : tuple
+            The size of the base maps in inches, as the figures drawn before.
+
+        marker_radius : int
+            The radius of the landmark markers in pixels.
+
+        max_age : float
+            The seconds the maps of the requests are kept, in the folder they are written to.
+        """
+        self.directory = directory
+        self.figsize = figsize
+        self.dpi = dpi
+        self.marker_radius = marker_radius
+        self.marker_color = marker_color
+        self.max_age = max_age
+
+    def paths(self, city):
+        base = os.path.join(self.directory, city.replace('/', '_'))
+        return base + '.png', base + '.json'
+
+    def has(self, city):
+        return all(os.path.exists(path) for path in self.paths(city))
+
+    def geocode(self, city):
+        import osmnx
+        with span('map.geocode', place=city):
+            return osmnx.geocode_to_gdf(city)
+
+    def precompute(self, city, rebuild=False, area=None):
+        """
+        Draw the base map of a city and save it with its transform.
+
+        Parameters
+        ----------
+        area : geopandas.GeoDataFrame
+            The polygon of the city, geocoded with osmnx if not given.
+        """
+        if self.has(city) and not rebuild:
+            return
+        # A figure of its own instead of pyplot, which keeps global state
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        area = self.geocode(city) if area is None else area
+        figure = Figure(figsize=self.figsize, dpi=self.dpi)
+        FigureCanvasAgg(figure)
+        ax = figure.subplots()
+        area.plot(ax=ax, facecolor="black")
+        xlim = ax.get_xlim()
+        ylim = ax.get_ylim()
+        ax.axis('off')
+        figure.canvas.draw()
+        # Display coordinates start at the bottom left, the pixels of the image at the top left
+        height = figure.get_size_inches()[1] * self.dpi
+        corners = [ax.transData.transform(point) for point in ((xlim[0], ylim[0]), (xlim[1], ylim[1]))]
+        transform = {
+            'xlim': list(xlim),
+            'ylim': list(ylim),
+            'pixels': [[float(x), float(height - y)] for x, y in corners],
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        image_path, transform_path = self.paths(city)
+        # Written to temporary files first, so a request never reads half a map
+        figure.savefig(image_path + '.tmp', format='png', dpi=self.dpi)
+        with open(transform_path + '.tmp', 'w') as f:
+            json.dump(transform, f)
+        os.replace(image_path + '.tmp', image_path)
+        os.replace(transform_path + '.tmp', transform_path)
+
+    def precompute_all(self, cities, rebuild=False, workers=1):
+        """
+        Draw the base maps of the cities, geocoding workers cities at the same time.
+
+        Returns
+        -------
+        list
+            The errors, one line per city that failed.
+        """
+        cities = [city for city in cities if rebuild or not self.has(city)]
+
+        def geocode(city):
+            try:
+                return self.geocode(city), None
+            except Exception as exc:
+                return None, f"{city}: {exc}"
+
+        errors = []
+        for city, (area, error) in zip(cities, parallel_map(geocode, cities, workers)):
+            if error is None:
+                self.precompute(city, True, area)
+            else:
+                errors.append(error)
+        return errors
+
+    def to_pixels(self, transform, lons, lats):
+        (x0, y0), (x1, y1) = transform['pixels']
+        (lon0, lon1), (lat0, lat1) = transform['xlim'], transform['ylim']
+        return [(x0 + (lon - lon0) * (x1 - x0) / (lon1 - lon0), y0 + (lat - lat0) * (y1 - y0) / (lat1 - lat0))
+                for lon, lat in zip(lons, lats)]
+
+    def render(self, city, lons=None, lats=None, output=None):
+        """
+        Draw the landmarks on the base map of a city, drawing the base map first if it is missing.
+
+        Parameters
+        ----------
+        lons, lats : list
+            The coordinates of the markers.
+
+        output : str
+            The file to write the map to. Without it the PNG is returned as bytes.
+
+        Returns
+        -------
+        str or bytes
+            The output path, or the PNG.
+        """
+        import io
+        from PIL import ImageDraw
+
+        if not self.has(city):
+            with span('map.precompute', place=city):
+                self.precompute(city)
+        image_path, transform_path = self.paths(city)
+        with open(transform_path, 'r') as f:
+            transform = json.load(f)
+        image = load_base(image_path, os.path.getmtime(image_path)).copy()
+
+        if lons is not None:
+            draw = ImageDraw.Draw(image)
+            r = self.marker_radius
+            for x, y in self.to_pixels(transform, lons, lats):
+                draw.ellipse((x - r, y - r, x + r, y + r), fill=self.marker_color)
+
+        # Fast compression, the maps are read once
+        if output is None:
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG', compress_level=1)
+            return buffer.getvalue()
+        directory = os.path.dirname(os.path.abspath(output))
+        os.makedirs(directory, exist_ok=True)
+        # Whoever chose the path, e.g. Electron, the maps of the old requests are removed here
+        prune_maps(directory, self.max_age)
+        image.save(output, format='PNG', compress_level=1)
+        return output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cities', default='./data/city.csv')
+    parser.add_argument('--only', default='', help="Comma separated cities, all of the file by default")
+    parser.add_argument('--directory', default=BASE_MAPS_DIR)
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    cities = [city for city in args.only.split(',') if city] or pd.read_csv(args.cities, usecols=['city'])['city'].tolist()
+    start = time.perf_counter()
+    errors = MapRenderer(args.directory).precompute_all(cities, args.rebuild, args.workers)
+    for error in errors:
+        print(f"Failed {error}")
+    print(f"{len(cities) - len(errors)} base maps in {time.perf_counter() - start:.1f} s, saved to {args.directory}")
+
+
+if __name__ == "__main__":
+    main()
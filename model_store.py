@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'models')
+
+# Tensors start at multiples of this, so every slice of the mapped file is aligned
+ALIGNMENT = 64
+
+
+class ModelStore:
+    def __init__(self, directory=MODELS_DIR):
+        """
+        Local store of encoder weights in a memory-mappable format.
+
+        Every model is a flat file of raw tensors (<name>.bin) and an index with
+        their dtype, shape and offset (<name>.json). Loading maps the file
+        copy-on-write and builds the tensors on top of the mapping, so nothing
+        is deserialized and the worker processes of one host share the same
+        physical pages. Needs torch 2.1 or later, for the meta device and
+        load_state_dict(assign=True).
+
+        Parameters
+        ----------
+        directory : str
+            The folder where the models are kept.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def paths(self, name):
+        base = os.path.join(self.directory, name)
+        return base + '.bin', base + '.json'
+
+    def has(self, name):
+        return all(os.path.exists(path) for path in self.paths(name))
+
+    def save_state(self, name, state_dict):
+        """
+        Write a state dict of tensors to the store.
+        """
+        bin_path, index_path = self.paths(name)
+        index = {}
+        offset = 0
+        # Written to temporary files first, so a reader never maps half a model. Their names are
+        # unique, for the processes filling the store at the same time, e.g. the first requests
+        bin_file = self.temporary_file(bin_path, 'wb')
+        index_file = self.temporary_file(index_path, 'w')
+        try:
+            with bin_file as f:
+                for key, tensor in state_dict.items():
+                    array = tensor.detach().cpu().numpy()
+                    padding = -offset % ALIGNMENT
+                    f.write(b'\0' * padding)
+                    offset += padding
+                    index[key] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+                    f.write(array.tobytes())
+                    offset += array.nbytes
+            with index_file as f:
+                json.dump(index, f)
+            # has() checks the index too, which is replaced last
+            os.replace(bin_file.name, bin_path)
+            os.replace(index_file.name, index_path)
+        except BaseException:
+            for path in (bin_file.name, index_file.name):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+    @staticmethod
+    def temporary_file(path, mode):
+        directory, base = os.path.split(path)
+        return tempfile.NamedTemporaryFile(mode, dir=directory, prefix=base + '.', suffix='.tmp', delete=False)
+
+    def load_arrays(self, name):
+        """
+        Map the weights of a model.
+
+        Returns
+        -------
+        dict
+            The numpy arrays of the state dict, views of the mapped file.
+        """
+        bin_path, index_path = self.paths(name)
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        # Copy-on-write: the pages stay shared unless a process writes to them
+        mapped = np.memmap(bin_path, dtype=np.uint8, mode='c')
+        arrays = {}
+        for key, entry in index.items():
+            dtype = np.dtype(entry['dtype'])
+            count = int(np.prod(entry['shape'], dtype=np.int64))
+            arrays[key] = mapped[entry['offset']:entry['offset'] + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+        return arrays
+
+    def load_state(self, name):
+        import torch
+        return {key: torch.from_numpy(array) for key, array in self.load_arrays(name).items()}
+
+    def load_module(self, name, build):
+        """
+        Build a torch module and give it the stored weights without copying them.
+
+        Parameters
+        ----------
+        build : callable
+            Builds the module without weights. It is called on the meta device,
+            so the parameters are not allocated nor initialized.
+        """
+        import torch
+        with torch.device('meta'):
+            module = build()
+        module.load_state_dict(self.load_state(name), assign=True)
+        return module.eval()
+
+    def resnet152(self):
+        """
+        Get the pretrained ResNet152 used by ImageSearch.
+
+        The first call downloads it from torchvision and stores it.
+        """
+        from torchvision import models
+        if not self.has('resnet152'):
+            model = models.resnet152(pretrained=True)
+            self.save_state('resnet152', model.state_dict())
+            return model.eval()
+        return self.load_module('resnet152', lambda: models.resnet152(weights=None))
+
+    def sentence_transformer(self, name='all-MiniLM-L6-v2'):
+        """
+        Get a sentence transformer, saved in the store on the first call.
+
+        The model folder, config and tokenizer, is loaded without going to the
+        hub. Its parameters are then swapped for the mapped weights of the store,
+        so like resnet152 they are shared by the worker processes. Unlike
+        resnet152 the weights are still read once from the folder by
+        transformers, and that copy is freed once swapped.
+        """
+        from sentence_transformers import SentenceTransformer
+        path = os.path.join(self.directory, name)
+        if not (os.path.exists(os.path.join(path, 'modules.json')) and self.has(name)):
+            model = SentenceTransformer(name)
+            # Saved to a folder of its own and renamed, unless another process saved it first
+            folder = tempfile.mkdtemp(dir=self.directory, prefix=name + '.', suffix='.tmp')
+            model.save(folder, safe_serialization=True)
+            if os.path.isdir(path) and not os.path.exists(os.path.join(path, 'modules.json')):
+                # Left half written by a process that stopped
+                shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rename(folder, path)
+            except OSError:
+                shutil.rmtree(folder, ignore_errors=True)
+            self.save_state(name, model.state_dict())
+            return model
+        model = SentenceTransformer(path)
+        model.load_state_dict(self.load_state(name), assign=True)
+        return model.eval()
@@ -0,0 +1,249 @@
+"""
+Precomputed nearest neighbors of every row of a vector table, so the places
+related to a city or a landmark are a single key read instead of a vector search.
+
+The neighbors of a table, e.g. city, are kept in city_neighbors, one row per
+item with its top k neighbors and their cosine similarity. They are computed
+from the stored description_vector in one vectorized pass, a block of rows at
+a time. update() only rewrites the rows affected by the items added or removed
+since: the new items, the items whose neighbors were removed, and the items a
+new item is closer to than their current k-th neighbor.
+
+Usage: python neighbor_table.py [--table city] [--key city] [--k 10] [--rebuild] [--similar Paris]
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from engine_class import get_engine, iris_dsn
+from tracing import span, traced
+from user_class import parse_vector
+
+
+def neighbors_table_name(table):
+    return f"{table}_neighbors"
+
+
+def top_k(queries, corpus, k, exclude=None, block_size=512):
+    """
+    Get the k rows of corpus most similar to every query, blocks of queries at a time.
+
+    Parameters
+    ----------
+    queries, corpus : numpy.ndarray
+        Normalized vectors, one per row.
+
+    exclude : numpy.ndarray
+        The row of corpus left out of the neighbors of every query, usually itself.
+
+    Returns
+    -------
+    tuple
+        The indices in corpus and the similarities, (len(queries), k) each, most similar first.
+    """
+    k = max(min(k, len(corpus) - (exclude is not None)), 0)
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    scores = np.empty((len(queries), k), dtype=np.float32)
+    if k == 0:
+        return indices, scores
+    for start in range(0, len(queries), block_size):
+        similarities = queries[start:start + block_size] @ corpus.T
+        rows = np.arange(len(similarities))
+        if exclude is not None:
+            similarities[rows, exclude[start:start + block_size]] = -np.inf
+        best = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = np.argsort(-similarities[rows[:, None], best], axis=1, kind='stable')
+        best = best[rows[:, None], order]
+        indices[start:start + block_size] = best
+        scores[start:start + block_size] = similarities[rows[:, None], best]
+    return indices, scores
+
+
+class NeighborTable:
+    def __init__(self, table='city', key_column='city', k=10, username='demo', password='demo', hostname='localhost', port='1972', namespace='USER'):
+        """
+        Parameters
+        ----------
+        table : str
+            The vector table, with a description_vector column.
+
+        key_column : str
+            The column naming the items, e.g. city or landmark.
+
+        k : int
+            The neighbors kept per item.
+        """
+        self.table = table
+        self.key_column = key_column
+        self.k = k
+        self.name = neighbors_table_name(table)
+        self.username = username
+        self.password = password
+        self.hostname = hostname
+        self.port = port
+        self.namespace = namespace
+        self.engine = None
+        self.connect_to_database()
+
+    def connect_to_database(self):
+        # Shared with the other classes connecting to the same database
+        self.engine = get_engine(iris_dsn(self.username, self.password, self.hostname, self.port, self.namespace))
+
+    def create_neighbors_table(self):
+        with self.engine.connect() as conn:
+            with conn.begin():
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {self.name} (
+                        item VARCHAR(2000) PRIMARY KEY,
+                        neighbors VARCHAR(20000)
+                    )
+                """))
+
+    @traced('neighbors.read_vectors')
+    def read_vectors(self):
+        """
+        Read the vectors of the table, normalized, the first row of every key only.
+
+        Returns
+        -------
+        tuple
+            The keys and a float32 matrix with one row per key.
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(f"SELECT {self.key_column}, description_vector FROM {self.table}")).fetchall()
+        vectors = {}
+        for key, vector in rows:
+            if key not in vectors:
+                vectors[key] = parse_vector(vector)
+        keys = list(vectors)
+        matrix = np.array(list(vectors.values()), dtype=np.float32).reshape(len(keys), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return keys, matrix / np.where(norms == 0, 1, norms)
+
+    def read_neighbors(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(f"SELECT item, neighbors FROM {self.name}")).fetchall()
+        return {item: json.loads(neighbors) for item, neighbors in rows}
+
+    def write(self, keys, items, indices, scores, replace=()):
+        """
+        Save the neighbors of items, given as positions in keys, replacing the rows of the items in replace.
+        """
+        rows = [{'item': item, 'neighbors': json.dumps([[keys[j], round(float(s), 4)] for j, s in zip(row, row_scores)])}
+                for item, row, row_scores in zip(items, indices, scores)]
+        with self.engine.connect() as conn:
+            with conn.begin():
+                if replace:
+                    conn.execute(text(f"DELETE FROM {self.name} WHERE item = :item"), [{'item': item} for item in replace])
+                if rows:
+                    conn.execute(text(f"INSERT INTO {self.name} (item, neighbors) VALUES (:item, :neighbors)"), rows)
+
+    @traced('neighbors.build')
+    def build(self):
+        """
+        Compute the neighbors of every item from scratch.
+
+        Returns
+        -------
+        int
+            The items written.
+        """
+        self.create_neighbors_table()
+        keys, matrix = self.read_vectors()
+        with span('neighbors.top_k', items=len(keys), k=self.k):
+            indices, scores = top_k(matrix, matrix, self.k, exclude=np.arange(len(keys)))
+        with self.engine.connect() as conn:
+            with conn.begin():
+                conn.execute(text(f"DELETE FROM {self.name}"))
+        self.write(keys, keys, indices, scores)
+        return len(keys)
+
+    @traced('neighbors.update')
+    def update(self):
+        """
+        Bring the neighbors up to date with the items added to or removed from the table,
+        rewriting only the rows of the items affected.
+
+        Returns
+        -------
+        dict
+            The number of items added, removed and rewritten.
+        """
+        self.create_neighbors_table()
+        keys, matrix = self.read_vectors()
+        stored = self.read_neighbors()
+        positions = {key: i for i, key in enumerate(keys)}
+        added = [i for i, key in enumerate(keys) if key not in stored]
+        removed = [item for item in stored if item not in positions]
+        affected = set(added)
+        gone = set(removed)
+        for item, neighbors in stored.items():
+            if item in positions and (len(neighbors) < min(self.k, len(keys) - 1) or any(key in gone for key, _ in neighbors)):
+                affected.add(positions[item])
+        if added:
+            # The k-th similarity of every item kept, which a new item has to beat
+            kept = [positions[item] for item in stored if item in positions]
+            thresholds = np.array([stored[keys[i]][-1][1] if stored[keys[i]] else -np.inf for i in kept], dtype=np.float32)
+            # The stored similarities are rounded
+            closer = (matrix[kept] @ matrix[added].T).max(axis=1) > thresholds - 1e-4
+            affected.update(np.array(kept, dtype=np.int64)[closer].tolist())
+
+        affected = sorted(affected)
+        if affected:
+            with span('neighbors.top_k', items=len(affected), k=self.k):
+                indices, scores = top_k(matrix[affected], matrix, self.k, exclude=np.array(affected))
+            items = [keys[i] for i in affected]
+            self.write(keys, items, indices, scores, replace=[item for item in items if item in stored] + removed)
+        elif removed:
+            self.write(keys, [], [], [], replace=removed)
+        return {'added': len(added), 'removed': len(removed), 'rewritten': len(affected)}
+
+    def similar(self, item, number=None):
+        """
+        Get the precomputed neighbors of an item.
+
+        Returns
+        -------
+        list
+            (key, similarity) of the number most similar items, most similar first,
+            empty if the item or the table has no neighbors yet.
+        """
+        try:
+            with span('neighbors.lookup', table=self.name), self.engine.connect() as conn:
+                row = conn.execute(text(f"SELECT neighbors FROM {self.name} WHERE item = :item"), {'item': item}).fetchone()
+        except DBAPIError:
+            # Not built yet
+            return []
+        if row is None:
+            return []
+        return [(key, score) for key, score in json.loads(row[0])][:number]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--table', default='city')
+    parser.add_argument('--key', default='city')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--rebuild', action='store_true', help="Recompute every item instead of the ones affected")
+    parser.add_argument('--similar', default='', help="Print the neighbors of this item")
+    args = parser.parse_args()
+
+    neighbors = NeighborTable(args.table, args.key, args.k)
+    start = time.perf_counter()
+    if args.rebuild:
+        print(f"{neighbors.build()} items", end='')
+    else:
+        counts = neighbors.update()
+        print(f"{counts['added']} added, {counts['removed']} removed, {counts['rewritten']} items rewritten", end='')
+    print(f" in {time.perf_counter() - start:.2f} s, saved to {neighbors.name}")
+    if args.similar:
+        for key, score in neighbors.similar(args.similar):
+            print(f"{score:8.4f}  {key}")
+
+
+if __name__ == "__main__":
+    main()
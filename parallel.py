@@ -0,0 +1,75 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parallel_map(func, items, workers=1):
+    """
+    Apply a function to every item, keeping the order of the results.
+
+    Parameters
+    ----------
+    func : callable
+        The function to apply.
+
+    items : iterable
+        The items to process.
+
+    workers : int
+        The number of threads to use. With 1 the items are processed in sequence.
+
+    Returns
+    -------
+    list
+        The results, in the same order as the items.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+class RateLimiter:
+    def __init__(self, per_second):
+        """
+        Space out calls made from any thread to at most per_second a second.
+        """
+        self.interval = 1 / per_second
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        # Every caller books the next free slot, then sleeps until it outside the lock
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def rate_limiter(key, per_second):
+    """
+    Get the limiter shared by everything calling the same API, e.g. its domain.
+
+    Returns
+    -------
+    RateLimiter
+        The limiter of key, or None if per_second is None, to not limit the calls.
+    """
+    if per_second is None:
+        return None
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(per_second)
+        return _limiters[key]
+
+
+def wait_for(key, per_second):
+    limiter = rate_limiter(key, per_second)
+    if limiter is not None:
+        limiter.wait()
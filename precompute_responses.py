@@ -0,0 +1,83 @@
+"""
+Ask the LLM every templated question of the query scripts ahead of time, so
+the interactive requests are answered from the response cache.
+
+Usage: python precompute_responses.py [--data-dir DIR] [--workers N] [--refresh]
+"""
+import argparse
+import json
+import os
+import time
+
+import pandas as pd
+
+from gpt_class import MonumentsSearch, CITY_PROMPT, LANDMARK_PROMPT
+from parallel import parallel_map
+
+
+def precompute(search, prompts, workers=1, refresh=False):
+    """
+    Answer the prompts through the search, storing the answers in its cache.
+
+    Parameters
+    ----------
+    prompts : list
+        (prompt, filters) pairs, asked the same way as the query scripts do.
+
+    Returns
+    -------
+    int
+        The number of prompts that were not cached yet.
+    """
+    search.build_index()
+    def cached(prompt, filters):
+        scope = json.dumps(filters, sort_keys=True) if filters else ''
+        return search.cache.get(search.cache.key(search.llama_model, prompt + scope, search.index_version())) is not None
+
+    missing = [(prompt, filters) for prompt, filters in prompts if refresh or not cached(prompt, filters)]
+
+    def answer(item):
+        prompt, filters = item
+        print(f"{search.vector_table_name}: {prompt}")
+        return search.query(prompt, use_cache=False, filters=filters)
+
+    parallel_map(answer, missing, workers)
+    return len(missing)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--refresh', action='store_true', help="Ask again the questions already cached")
+    args = parser.parse_args()
+
+    cache_file = os.path.join(args.data_dir, "response_cache.sqlite")
+    cities_search = MonumentsSearch(
+        data_file_path=os.path.join(args.data_dir, "city.csv"),
+        landmark_column="city",
+        wiki_content_column="wiki_content",
+        landmarks_directory=os.path.join(args.data_dir, "city_texts"),
+        vector_table_name="cities",
+        cache_file=cache_file
+    )
+    monuments_search = MonumentsSearch(
+        data_file_path=os.path.join(args.data_dir, "data.csv"),
+        landmark_column="landmark",
+        wiki_content_column="wiki_content",
+        landmarks_directory=os.path.join(args.data_dir, "texts"),
+        vector_table_name="monuments",
+        cache_file=cache_file
+    )
+
+    cities = pd.read_csv(cities_search.data_file_path, usecols=["city"])["city"].tolist()
+    landmarks = pd.read_csv(monuments_search.data_file_path, usecols=["landmark", "city"]).to_dict('records')
+
+    start = time.time()
+    city_prompts = [(CITY_PROMPT.format(city=city), {"city": city}) for city in cities]
+    landmark_prompts = [(LANDMARK_PROMPT.format(landmark=row["landmark"]), {"landmark": row["landmark"], "city": row["city"]})
+                        for row in landmarks]
+    new_cities = precompute(cities_search, city_prompts, args.workers, args.refresh)
+    new_landmarks = precompute(monuments_search, landmark_prompts, args.workers, args.refresh)
+    print(f"Answered {new_cities}/{len(cities)} cities and {new_landmarks}/{len(landmarks)} landmarks in {time.time() - start:.1f} s, "
+          f"{len(cities_search.cache)} answers cached")
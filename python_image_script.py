@@ -1,19 +1,17 @@
 # python_script.py
-import pandas as pd
-import geopandas as gpd
-from geopandas import GeoDataFrame
-from shapely.geometry import Point
-from sql_class import CloseSearch
-from gpt_class import MonumentsSearch
-import matplotlib.pyplot as plt
+from gpt_class import MonumentsSearch, CITY_PROMPT
 from threading import Thread
 import time
 import base64
+from tracing import traced
 from images_class import ImageSearch
+from map_class import MapRenderer, unique_map_path
+from neighbor_table import NeighborTable
+
+# matplotlib and osmnx are only imported if a base map is missing, see map_class
 
 import sys
 sys.stdout.reconfigure(encoding='utf-8')
-import osmnx
 
 # Assume other necessary imports and class definitions (like MonumentsSearch and CloseSearch) are done here
 
@@ -22,47 +20,60 @@ cities_search = MonumentsSearch(
     data_file_path="../data/city.csv",
     landmark_column="city",
     wiki_content_column="wiki_content",
-    landmarks_directory="../data/city_texts"
+    landmarks_directory="../data/city_texts",
+    vector_table_name="cities",
+    cache_file="../data/response_cache.sqlite"
 )
-import sys
+map_renderer = MapRenderer()
+# Precomputed from the embeddings of the cities, see neighbor_table
+city_neighbors = NeighborTable(table="city", key_column="city")
 
-def process_user_input(user_input):
+def process_user_input(user_input, map_file=None):
     if not user_input:
         return "Please, enter a description."
 
     #print(f"You: {user_input}") 
     # Search for similar landmarks in a separate thread
-    thread = Thread(target=search_image, args=(user_input,))
+    thread = Thread(target=search_image, args=(user_input, map_file))
     thread.start()
 
-def search_image(user_input):
-    image_search = ImageSearch(folder='../data/city_images/*.jpg', name="cities")
+@traced('search_image', root=True)
+def search_image(user_input, map_file=None):
+    # The same or a nearly identical photo is answered from the cache, without loading ResNet
+    image_search = ImageSearch(folder='../data/city_images/*.jpg', name="cities", result_cache_file="../data/image_result_cache.sqlite")
     result = image_search.search_similars(str(user_input))
     ciutat = result["monument_name"][0]
     text = f"# {ciutat} \n\n "
     result_text = text
 
-    result_text += str(cities_search.query(f"Create a brew (2-3 lines) description about the city of {ciutat}")) + "\n"
-
-    result_text += f"\n**Other similar cities are {result['monument_name'][1]} and {result['monument_name'][2]}**"
+    result_text += str(cities_search.query(CITY_PROMPT.format(city=ciutat), filters={"city": ciutat})) + "\n"
 
-    figure, ax = plt.subplots(figsize=(12, 8))
-    # Retrieve the area as a GeoDataFrame
-    area = osmnx.geocode_to_gdf(ciutat)
+    similar = other_cities(ciutat, result['monument_name'].tolist())
+    if len(similar) == 2:
+        result_text += f"\n**Other similar cities are {similar[0]} and {similar[1]}**"
+    elif similar:
+        result_text += f"\n**Another similar city is {similar[0]}**"
 
-    # Plot the area on the specified axis
-    area.plot(ax=ax, facecolor="black")
-    xlim = ax.get_xlim()
-    ylim = ax.get_ylim()
-    # Turn off the axis
-    ax.axis('off')
-
-    # Save the plot as an image file
-    plt.savefig("../data/generatedmap.png")
+    draw_map(ciutat, map_file)
     
     print(result_text)
 
+def other_cities(ciutat, image_results, number=2):
+    # The precomputed neighbors, topped up with the cities of the other images found
+    similar = []
+    for city in [city for city, _ in city_neighbors.similar(ciutat, number)] + image_results:
+        if city != ciutat and city not in similar:
+            similar.append(city)
+    return similar[:number]
+
+@traced('map')
+def draw_map(ciutat, map_file=None):
+    # The precomputed base map of the city, see map_class
+    return map_renderer.render(ciutat, output=map_file or unique_map_path())
+
 
 if __name__ == "__main__":
     user_input = sys.argv[1]
-    result = process_user_input(user_input)
\ No newline at end of file
+    # Electron gives every request its own map file
+    map_file = sys.argv[2] if len(sys.argv) > 2 else None
+    result = process_user_input(user_input, map_file)
\ No newline at end of file
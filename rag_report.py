@@ -0,0 +1,60 @@
+"""
+Report how many chunks the RAG indexes hold and how many prompt tokens the
+templated queries use with the given chunking and retrieval settings.
+
+Usage: python rag_report.py [--chunk-size N] [--chunk-overlap N] [--top-k N]
+                            [--embedding-backend openai|local] [--queries N]
+"""
+import argparse
+import os
+
+import pandas as pd
+
+from gpt_class import MonumentsSearch, CITY_PROMPT, LANDMARK_PROMPT
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--chunk-overlap', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=2)
+    parser.add_argument('--embedding-backend', default='openai', choices=['openai', 'local'])
+    parser.add_argument('--queries', type=int, default=5, help="Sample queries per index")
+    args = parser.parse_args()
+
+    settings = dict(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+                    similarity_top_k=args.top_k, embedding_backend=args.embedding_backend)
+    suffix = '' if args.embedding_backend == 'openai' else '_local'
+    searches = {
+        'cities': (MonumentsSearch(
+            data_file_path=os.path.join(args.data_dir, "city.csv"),
+            landmark_column="city",
+            wiki_content_column="wiki_content",
+            landmarks_directory=os.path.join(args.data_dir, "city_texts"),
+            vector_table_name="cities" + suffix,
+            **settings
+        ), CITY_PROMPT, 'city'),
+        'monuments': (MonumentsSearch(
+            data_file_path=os.path.join(args.data_dir, "data.csv"),
+            landmark_column="landmark",
+            wiki_content_column="wiki_content",
+            landmarks_directory=os.path.join(args.data_dir, "texts"),
+            vector_table_name="monuments" + suffix,
+            **settings
+        ), LANDMARK_PROMPT, 'landmark'),
+    }
+
+    for name, (search, prompt, column) in searches.items():
+        search.build_index()
+        report = search.index_report()
+        print(f"\n{name}: {report['documents']} documents, {report['chunks']} chunks indexed, "
+              f"{report['duplicate_chunks']} duplicate chunks skipped "
+              f"(chunk size {report['chunk_size']}, overlap {report['chunk_overlap']}, top-k {args.top_k})")
+
+        entities = pd.read_csv(search.data_file_path, usecols=[column])[column].tolist()[:args.queries]
+        for entity in entities:
+            search.query(prompt.format(**{column: entity}), use_cache=False)
+        stats = pd.DataFrame(search.query_stats)
+        print(stats[['query', 'chunks', 'prompt_tokens', 'completion_tokens']].to_string(index=False))
+        print(f"mean prompt tokens per query: {stats['prompt_tokens'].mean():.0f}")
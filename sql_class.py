@@ -1,11 +1,19 @@
 import os
+import time
+import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from sqlalchemy import create_engine, text
-import pandas as pd
+from sqlalchemy import text
 from math import radians, sin, cos, sqrt, atan2
 from sqlalchemy import MetaData, Table, Column
 
+from engine_class import get_engine, iris_dsn
+from filter_class import Filter, where_clause
+from keyword_index import load_or_build
+from tracing import span, traced
+from user_class import PREFERENCES_TABLE, VISITS_TABLE
+from vector_index import COSINE_SCORE, create_hnsw_index, search_statement
+from model_store import ModelStore, MODELS_DIR
+
 
 # Function to calculate distance between two points using haversine formula
 def calculate_distance(lat1, lon1, lat2, lon2):
@@ -30,7 +38,8 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     return distance
 
 class CloseSearch:
-    def __init__(self, file='./data/data.csv', name="monuments", textual_var="wiki_content", username='demo', password='demo', hostname='localhost', port='1972', namespace='USER', add_distances=False, lat1=None, long1=None, recalculate=False, clear = False):
+    @traced('close_search.init')
+    def __init__(self, file='./data/data.csv', name="monuments", textual_var="wiki_content", username='demo', password='demo', hostname='localhost', port='1972', namespace='USER', add_distances=False, lat1=None, long1=None, recalculate=False, clear = False, models_dir=MODELS_DIR, ann_index=False, ann_params=None, low_memory=False, chunk_size=256, keyword_index=False):
         self.name = name
         self.username = username
         self.password = password
@@ -41,13 +50,23 @@ class CloseSearch:
         self.engine = None
         self.clear = clear
         self.model = None
-        self.data = pd.read_csv(file)
-        if "weather_data" in self.data.columns:
-            self.data = self.data.drop("weather_data", axis=1)
+        self.models_dir = models_dir
+        self.search_stats = []
+        self.file = file
+        self.low_memory = low_memory
+        self.chunk_size = chunk_size
+        self.vectors = None
+        if low_memory:
+            # The texts are only read, in chunks, if the embeddings have to be generated
+            self.data = self.read_metadata(file, textual_var)
+        else:
+            self.data = pd.read_csv(file)
+            if "weather_data" in self.data.columns:
+                self.data = self.data.drop("weather_data", axis=1)
 
-        if textual_var in self.data.columns:
-            self.textual_data = self.data[textual_var]
-            self.data = self.data.drop(textual_var, axis=1)
+            if textual_var in self.data.columns:
+                self.textual_data = self.data[textual_var]
+                self.data = self.data.drop(textual_var, axis=1)
         self.lat1 = lat1
         self.long1 = long1
         if add_distances:
@@ -64,16 +83,47 @@ class CloseSearch:
         if self.embeddings == False:
             self.generate_embeddings()
             self.insert_data_into_database()
+        if ann_index:
+            # e.g. ann_params={'m': 32, 'ef_construction': 400}
+            create_hnsw_index(self.engine, self.name, **(ann_params or {}))
+        # BM25 index of the texts for hybrid searches, keyed on the first column
+        self.keyword_index = load_or_build(file, self.columns[0], textual_var) if keyword_index else None
+
+    @staticmethod
+    def read_metadata(file, textual_var):
+        """
+        Read every column but the texts, with the repeated strings as categories.
+        """
+        header = pd.read_csv(file, nrows=0).columns
+        data = pd.read_csv(file, usecols=[e for e in header if e not in (textual_var, "weather_data")])
+        for column in data.select_dtypes(include="object").columns:
+            if data[column].nunique() < len(data) / 2:
+                data[column] = data[column].astype("category")
+        return data
+
+    def read_texts(self):
+        """
+        Stream the texts of the file.
+
+        Returns
+        -------
+        generator
+            Lists of at most chunk_size texts, in the order of the rows.
+        """
+        for chunk in pd.read_csv(self.file, usecols=[self.textual_var], chunksize=self.chunk_size):
+            yield chunk[self.textual_var].tolist()
 
     def connect_to_database(self):
-        CONNECTION_STRING = f"iris://{self.username}:{self.password}@{self.hostname}:{self.port}/{self.namespace}"
-        self.engine = create_engine(CONNECTION_STRING)
+        # Shared with the other classes connecting to the same database
+        self.engine = get_engine(iris_dsn(self.username, self.password, self.hostname, self.port, self.namespace))
 
+    @traced('close_search.create_table')
     def create_monuments_table(self):
         s_values = {
             "float64": "DOUBLE",
             "object": "VARCHAR(20000)",
             "O": "VARCHAR(20000)",
+            "category": "VARCHAR(20000)",
             "int32": "INT",
             "int64": "INT"
         }
@@ -97,10 +147,11 @@ class CloseSearch:
                             sql = f"ALTER TABLE {self.name} ADD COLUMN distance DOUBLE;"
                             conn.execute(text(sql))
                         self.data['distance'] = self.data.apply(lambda row: calculate_distance(self.lat1, self.long1, row['latitude'], row['longitude']), axis=1)
-                        for index, row in self.data.iterrows():
-                            distance = row['distance']
-                            sql = f"UPDATE {self.name} SET distance = :distance WHERE landmark = :landmark"
-                            conn.execute(text(sql), {"distance": distance, "landmark": row['landmark']})
+                        with span('close_search.recalculate_distances', table=self.name, rows=len(self.data)):
+                            for index, row in self.data.iterrows():
+                                distance = row['distance']
+                                sql = f"UPDATE {self.name} SET distance = :distance WHERE landmark = :landmark"
+                                conn.execute(text(sql), {"distance": distance, "landmark": row['landmark']})
                         self.embeddings = True
                     if self.clear:
                         sql = f"DROP TABLE {self.name}"
@@ -113,36 +164,144 @@ class CloseSearch:
                     else:
                         self.embeddings = True
 
+    @traced('close_search.load_model')
     def load_sentence_transformer_model(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+        if self.models_dir:
+            self.model = ModelStore(self.models_dir).sentence_transformer('all-MiniLM-L6-v2')
+        else:
+            # Imported here because sentence_transformers loads torch
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer('all-MiniLM-L6-v2')
 
+    @traced('close_search.embed_corpus')
     def generate_embeddings(self):
+        if self.low_memory:
+            # float32 rows instead of lists of Python floats, freed once inserted
+            self.vectors = np.vstack([self.model.encode(texts, batch_size=len(texts), normalize_embeddings=True).astype(np.float32)
+                                      for texts in self.read_texts()])
+            return
         self.data["description_vector"] = self.model.encode(self.textual_data.tolist(), normalize_embeddings=True).tolist()
 
+    @traced('close_search.insert')
     def insert_data_into_database(self):
         print("inserting data? només hauria de fer això el primer cop")
         with self.engine.connect() as conn:
             with conn.begin():
-                for index, row in self.data.iterrows():
+                for position, (index, row) in enumerate(self.data.iterrows()):
                     sql = text(f"""
                         INSERT INTO {self.name} 
                         ({",".join(e for e in self.columns)}, description_vector) 
                         VALUES ({",".join(':'+e for e in self.columns)}, TO_VECTOR(:description_vector))
                     """)
                     to_execute = {k: row[k] for k in self.columns if k != self.textual_var}
-                    to_execute['description_vector'] = str(row['description_vector'])
+                    vector = self.vectors[position].tolist() if self.vectors is not None else row['description_vector']
+                    to_execute['description_vector'] = str(vector)
                     conn.execute(sql, to_execute)
+        self.vectors = None
 
-    def search_similars(self, description_search, condition="", number=10):
-        search_vector = self.model.encode(description_search, normalize_embeddings=True).tolist()
-        with self.engine.connect() as conn:
+    def search_similars(self, description_search, hybrid=False, candidates=100, **kwargs):
+        """
+        Find the rows closest to a description. See search_by_vector for the other arguments.
+
+        Parameters
+        ----------
+        hybrid : bool
+            Only score the rows whose text best matches the words of the description,
+            with the keyword index. Falls back to all the rows when no word matches.
+
+        candidates : int
+            The rows kept by the keyword index in a hybrid search.
+        """
+        if hybrid:
+            if self.keyword_index is None:
+                raise ValueError("Hybrid searches need a CloseSearch built with keyword_index=True.")
+            with span('close_search.keywords', candidates=candidates) as attrs:
+                keys = self.keyword_index.candidates(description_search, candidates)
+                attrs['matches'] = len(set(keys))
+            if keys:
+                keywords = Filter.isin(self.keyword_index.key_column, keys)
+                filters = kwargs.get('filters')
+                kwargs['filters'] = keywords if filters is None else keywords & filters
+        with span('close_search.encode'):
+            search_vector = self.model.encode(description_search, normalize_embeddings=True).tolist()
+        return self.search_by_vector(search_vector, **kwargs)
+
+    def search_by_vector(self, search_vector, filters=None, number=10, columns=None, include_vector=False, exact=False, user_id=None, preference_weight=0.3, exclude_visited=True):
+        """
+        Find the rows closest to an embedding of the model.
+
+        Parameters
+        ----------
+        search_vector : list
+            The normalized embedding to look for.
+
+        filters : Filter or dict
+            Restrict the rows, e.g. Filter.lt('distance', 250) or {'country': 'Spain'}.
+
+        number : int
+            The number of rows returned.
+
+        columns : list
+            The columns returned, all but description_vector by default.
+
+        include_vector : bool
+            Also return description_vector, which is the largest column by far.
+
+        exact : bool
+            Scan the whole table even if it has an ANN index, for exact results.
+
+        user_id : int
+            Personalize the search for a user of UserManager.
+
+        preference_weight : float
+            How much the similarity to the preference vector of the user adds to the score.
+
+        exclude_visited : bool
+            Leave out the places the user has visited, matched on the first column.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The rows, most similar first, with their cosine similarity in the score
+            column, plus the weighted similarity to the preferences of the user.
+        """
+        columns = list(self.columns) if columns is None else list(columns)
+        if "description_vector" in columns:
+            columns.remove("description_vector")
+            include_vector = True
+        unknown = [e for e in columns if e not in self.columns]
+        if unknown:
+            raise ValueError(f"Unknown columns {unknown}. Choose from {list(self.columns)}.")
+        if include_vector:
+            columns.append("description_vector")
+        score = COSINE_SCORE
+        join = ""
+        if user_id is not None:
+            if exclude_visited:
+                visited = Filter.not_visited(user_id, self.columns[0], VISITS_TABLE)
+                filters = visited if filters is None else visited & filters
+            if preference_weight:
+                # Re-ranked in the same query, users without visits yet get the plain similarity
+                join = f"LEFT JOIN {PREFERENCES_TABLE} p ON p.user_id = :user_id"
+                score += " + :preference_weight * COALESCE(VECTOR_COSINE(description_vector, p.preference_vector), 0)"
+        # Only bound parameters, so every search of the same shape has the same statement text
+        where, params = where_clause(filters, allowed=self.columns)
+        if join:
+            params.update({'user_id': user_id, 'preference_weight': preference_weight})
+        start = time.perf_counter()
+        with span('close_search.vector_search', table=self.name, number=number) as attrs, self.engine.connect() as conn:
             with conn.begin():
-                sql = text(f"""
-                    SELECT TOP {number} * FROM {self.name} 
-                    {condition}
-                    ORDER BY VECTOR_COSINE(description_vector, TO_VECTOR(:search_vector)) DESC
-                """)
-                results = conn.execute(sql, {'search_vector': str(search_vector)}).fetchall()
-        results_df = pd.DataFrame(results, columns=list(self.columns) + ["description_vector"])
+                sql = text(search_statement(self.name, columns, score, join, where, exact))
+                results = conn.execute(sql, {**params, 'number': int(number), 'search_vector': str(search_vector)}).fetchall()
+            attrs['rows'] = len(results)
+        fetched = time.perf_counter()
+        results_df = pd.DataFrame(results, columns=columns + ["score"])
+        self.search_stats.append({
+            'statement': sql.text,
+            'rows': len(results_df),
+            'columns': len(columns) + 1,
+            'fetch_seconds': fetched - start,
+            'frame_seconds': time.perf_counter() - fetched,
+        })
         pd.set_option('display.max_colwidth', None)  # Easier to read description
         return results_df
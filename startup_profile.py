@@ -0,0 +1,76 @@
+"""
+Measure the import time of the query entry points, module by module, and check
+it against a cold start budget.
+
+Every module is imported in a fresh interpreter with python -X importtime, from
+electron_app like the Electron app does.
+
+Usage: python startup_profile.py [MODULE ...] [--top N] [--budget SECONDS]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ENTRY_POINTS = ['python_script', 'python_image_script', 'gpt_class', 'sql_class', 'images_class', 'user_class']
+
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def profile_module(module, cwd):
+    """
+    Import a module in a new interpreter and read its import times.
+
+    Returns
+    -------
+    list
+        (name, depth, self seconds, cumulative seconds) of every imported module.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')]))}
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             cwd=cwd, env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{process.stderr[-2000:]}")
+    imports = []
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            imports.append((name, len(indent) // 2, int(own) / 1e6, int(cumulative) / 1e6))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS)
+    parser.add_argument('--top', type=int, default=10, help="Slowest imports shown per module")
+    parser.add_argument('--budget', type=float, default=None, help="Maximum import time in seconds per module")
+    parser.add_argument('--cwd', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'electron_app'))
+    args = parser.parse_args()
+
+    over_budget = []
+    totals = {}
+    for module in args.modules:
+        imports = profile_module(module, args.cwd)
+        total = next(cumulative for name, depth, own, cumulative in imports if name == module)
+        totals[module] = total
+        print(f"\n{module}: {total:.3f} s")
+        # Direct dependencies of the module, which are the ones the code controls
+        direct = [entry for entry in imports if entry[1] == 1]
+        for name, depth, own, cumulative in sorted(direct, key=lambda entry: -entry[3])[:args.top]:
+            print(f"  {name:<40} {cumulative:>8.3f} s")
+        if args.budget is not None and total > args.budget:
+            over_budget.append(module)
+
+    print(f"\n{'module':<24} {'import (s)':>10}")
+    for module, total in totals.items():
+        flag = '  OVER BUDGET' if module in over_budget else ''
+        print(f"{module:<24} {total:>10.3f}{flag}")
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
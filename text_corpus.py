@@ -0,0 +1,254 @@
+"""
+Packed text corpus: all the texts of a dataset in one data file plus an offset
+index, instead of one small file per city or landmark.
+
+data/city_texts.corpus.data-<version> holds the UTF-8 texts back to back, each
+compressed with zlib if the corpus was written with compress=True, and
+data/city_texts.corpus.index names that file and maps the id of every text, the
+name its .txt file had, to its offset and length. The data file is
+memory-mapped, so reading a text is a dictionary lookup and a slice, without
+opening or stat-ing a file.
+
+Every write goes to a data file of its own, and replacing the index is the only
+step the readers see, so they never pair an index with the data of another write.
+
+open_corpus gives the packed corpus of a texts directory if it was written,
+and the directory itself otherwise, with the same interface.
+
+Usage: python text_corpus.py TEXTS_DIR [--compress] [--get ID]
+"""
+import argparse
+import glob
+import json
+import mmap
+import os
+import random
+import time
+import uuid
+import zlib
+
+CORPUS_EXTENSION = '.corpus'
+INDEX_EXTENSION = '.index'
+DATA_EXTENSION = '.data-'
+
+
+def corpus_path(directory):
+    # data/city_texts -> data/city_texts.corpus
+    return os.path.normpath(directory) + CORPUS_EXTENSION
+
+
+class CorpusWriter:
+    def __init__(self, path, compress=False, level=6):
+        """
+        Write a packed corpus, replacing the previous one once closed. Used as a
+        context manager, the previous one is kept if the block raises.
+
+        Parameters
+        ----------
+        compress : bool
+            Compress every text on its own, so each one can still be read alone.
+
+        level : int
+            The zlib compression level.
+        """
+        self.path = path
+        self.compress = compress
+        self.level = level
+        self.entries = {}
+        self.offset = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Names of their own, so two writers of the same corpus don't write to the same files
+        version = uuid.uuid4().hex
+        self.data_path = path + DATA_EXTENSION + version
+        self.index_tmp = path + INDEX_EXTENSION + '.' + version + '.tmp'
+        self.file = open(self.data_path, 'wb')
+
+    def add(self, text_id, text):
+        raw = text.encode('utf-8')
+        data = zlib.compress(raw, self.level) if self.compress else raw
+        self.file.write(data)
+        self.entries[text_id] = [self.offset, len(data), len(raw)]
+        self.offset += len(data)
+
+    def close(self):
+        self.file.close()
+        with open(self.index_tmp, 'w', encoding='utf-8') as f:
+            json.dump({'compression': 'zlib' if self.compress else None,
+                       'data': os.path.basename(self.data_path),
+                       'entries': self.entries}, f)
+        # The only step the readers see: the new index names the new data, the old one the old data
+        os.replace(self.index_tmp, self.path + INDEX_EXTENSION)
+        self.remove_old_data()
+
+    def remove_old_data(self):
+        # Corpora written before the data files were versioned kept their data in the corpus path itself
+        for path in glob.glob(glob.escape(self.path) + DATA_EXTENSION + '*') + [self.path]:
+            if path != self.data_path and os.path.isfile(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Still mapped by a reader on Windows, removed by the next write
+                    pass
+
+    def abort(self):
+        """
+        Drop what was written, keeping the previous corpus.
+        """
+        self.file.close()
+        for path in (self.data_path, self.index_tmp):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # A failed build must not replace the full corpus with the texts written until then
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class PackedCorpus:
+    def __init__(self, path):
+        """
+        Read a corpus written by CorpusWriter, memory-mapped.
+        """
+        self.path = path
+        for attempt in range(3):
+            with open(path + INDEX_EXTENSION, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            try:
+                f = open(os.path.join(os.path.dirname(path), index['data']) if 'data' in index else path, 'rb')
+                break
+            except FileNotFoundError:
+                # Replaced by a new write between the two opens, whose index is read again
+                if attempt == 2:
+                    raise
+        with f:
+            # An empty file can't be mapped
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        self.compressed = index['compression'] == 'zlib'
+        self.entries = index['entries']
+
+    def ids(self):
+        return sorted(self.entries)
+
+    def raw(self, text_id):
+        """
+        Get the bytes of a text, as its .txt file had them.
+        """
+        offset, length, _ = self.entries[text_id]
+        data = self.data[offset:offset + length]
+        return zlib.decompress(data) if self.compressed else data
+
+    def __getitem__(self, text_id):
+        return self.raw(text_id).decode('utf-8')
+
+    def __contains__(self, text_id):
+        return text_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def items(self):
+        for text_id in self.ids():
+            yield text_id, self[text_id]
+
+    def sizes(self):
+        """
+        Get the bytes of the texts, stored and decompressed.
+        """
+        return sum(entry[1] for entry in self.entries.values()), sum(entry[2] for entry in self.entries.values())
+
+
+class DirectoryCorpus:
+    def __init__(self, directory):
+        """
+        The .txt files of a directory, read like a PackedCorpus.
+        """
+        self.directory = directory
+        self.names = [name for name in os.listdir(directory)
+                      if not name.startswith('.') and os.path.isfile(os.path.join(directory, name))]
+
+    def ids(self):
+        return sorted(self.names)
+
+    def raw(self, text_id):
+        with open(os.path.join(self.directory, text_id), 'rb') as f:
+            return f.read()
+
+    def __getitem__(self, text_id):
+        return self.raw(text_id).decode('utf-8')
+
+    def __contains__(self, text_id):
+        return text_id in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def items(self):
+        for text_id in self.ids():
+            yield text_id, self[text_id]
+
+
+def open_corpus(directory):
+    """
+    Open the texts of a directory, from its packed corpus if it was written.
+
+    Returns
+    -------
+    PackedCorpus or DirectoryCorpus
+    """
+    path = corpus_path(directory)
+    if os.path.exists(path + INDEX_EXTENSION):
+        return PackedCorpus(path)
+    return DirectoryCorpus(directory)
+
+
+def pack_directory(directory, compress=False):
+    """
+    Pack the .txt files of a directory written before the builders wrote corpora.
+
+    Returns
+    -------
+    str
+        The path of the corpus.
+    """
+    texts = DirectoryCorpus(directory)
+    with CorpusWriter(corpus_path(directory), compress) as writer:
+        for text_id, text in texts.items():
+            writer.add(text_id, text)
+    return writer.path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory')
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--get', default='', help="Print the text with this id")
+    parser.add_argument('--reads', type=int, default=1000, help="Random reads timed from the files and the corpus")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    path = pack_directory(args.directory, args.compress)
+    packed = PackedCorpus(path)
+    stored, raw = packed.sizes()
+    print(f"{len(packed)} texts packed in {time.perf_counter() - start:.2f} s, "
+          f"{raw / 2**20:.1f} MB of text in {stored / 2**20:.1f} MB, saved to {path}")
+
+    ids = random.Random(0).choices(packed.ids(), k=args.reads)
+    for name, texts in (('files', DirectoryCorpus(args.directory)), ('corpus', packed)):
+        start = time.perf_counter()
+        for text_id in ids:
+            texts[text_id]
+        print(f"{name:<7} {(time.perf_counter() - start) / len(ids) * 1e6:8.1f} us per read")
+    if args.get:
+        print(packed[args.get])
+
+
+if __name__ == "__main__":
+    main()
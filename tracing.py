@@ -0,0 +1,219 @@
+"""
+Lightweight spans written as JSON lines, and an optional sampling profiler.
+
+Tracing is off unless TRACE_FILE is set; every finished span is then appended
+to that file as one JSON object with its request id, parent span and duration:
+
+    TRACE_FILE=../data/trace.jsonl python python_script.py "gothic cathedral"
+
+With TRACE_PROFILE=<interval in ms> a background thread also samples the stacks
+of the other threads and writes them in folded format (one "a;b;c count" line
+per stack, for flamegraph.pl or speedscope) to TRACE_PROFILE_FILE at exit.
+
+Run this module on a trace file to get the latency histogram of every stage:
+
+Usage: python tracing.py TRACE_FILE [--stage PREFIX] [--buckets N]
+"""
+import argparse
+import atexit
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+TRACE_FILE = os.getenv('TRACE_FILE', '')
+TRACE_PROFILE = os.getenv('TRACE_PROFILE', '')
+TRACE_PROFILE_FILE = os.getenv('TRACE_PROFILE_FILE', 'profile.folded')
+
+current_request = contextvars.ContextVar('current_request', default=None)
+current_span = contextvars.ContextVar('current_span', default=None)
+
+_lock = threading.Lock()
+_file = None
+
+
+def emit(record):
+    global _file
+    with _lock:
+        if _file is None:
+            directory = os.path.dirname(TRACE_FILE)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            _file = open(TRACE_FILE, 'a', encoding='utf-8', buffering=1)
+        _file.write(json.dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Time a stage. Spans opened inside it are its children.
+
+    The attributes are saved with the span; more can be added to the yielded
+    dict while it runs, e.g. the number of rows found.
+    """
+    if not TRACE_FILE:
+        yield attrs
+        return
+    span_id = uuid.uuid4().hex[:16]
+    parent = current_span.get()
+    token = current_span.set(span_id)
+    ts = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as exc:
+        error = f"{type(exc).__name__}: {exc}"
+        raise
+    finally:
+        current_span.reset(token)
+        emit({
+            'ts': ts,
+            'request_id': current_request.get(),
+            'span_id': span_id,
+            'parent_id': parent,
+            'name': name,
+            'duration_ms': (time.perf_counter() - start) * 1000,
+            'attrs': attrs,
+            'error': error,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+        })
+
+
+@contextmanager
+def request(name, request_id=None, **attrs):
+    """
+    Root span of a request. Every span inside it carries its request id.
+
+    Context variables are not inherited by new threads, so a request has to be
+    opened in the thread doing the work.
+    """
+    token = current_request.set(request_id or uuid.uuid4().hex)
+    try:
+        with span(name, **attrs) as values:
+            yield values
+    finally:
+        current_request.reset(token)
+
+
+def traced(name, root=False):
+    """
+    Decorator running the whole function in a span, or in a new request if root.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with (request(name) if root else span(name)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    def __init__(self, interval_ms=10.0, file=TRACE_PROFILE_FILE):
+        """
+        Count the stacks of all the other threads every interval.
+        """
+        self.interval = interval_ms / 1000
+        self.file = file
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        with open(self.file, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+if TRACE_PROFILE:
+    SamplingProfiler(float(TRACE_PROFILE)).start()
+
+
+def read_spans(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def histogram(values, buckets=8):
+    """
+    Count the values in logarithmic buckets.
+
+    Returns
+    -------
+    list
+        (upper bound, count) of every bucket, the last bound being the maximum.
+    """
+    low, high = max(min(values), 1e-3), max(values)
+    if high <= low:
+        return [(high, len(values))]
+    ratio = (high / low) ** (1 / buckets)
+    bounds = [low * ratio ** (i + 1) for i in range(buckets)]
+    bounds[-1] = high
+    counts = [0] * buckets
+    for value in values:
+        counts[next(i for i, bound in enumerate(bounds) if value <= bound)] += 1
+    return list(zip(bounds, counts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('--stage', default='', help="Only the stages whose name starts with this")
+    parser.add_argument('--buckets', type=int, default=8)
+    args = parser.parse_args()
+
+    durations = defaultdict(list)
+    requests = set()
+    errors = Counter()
+    for record in read_spans(args.file):
+        if record['name'].startswith(args.stage):
+            durations[record['name']].append(record['duration_ms'])
+            requests.add(record['request_id'])
+            if record['error']:
+                errors[record['name']] += 1
+
+    print(f"{len(requests)} requests\n")
+    print(f"{'stage':<36} {'n':>5} {'errors':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for name, values in sorted(durations.items()):
+        values.sort()
+        p50, p95, p99 = (values[min(int(q * len(values)), len(values) - 1)] for q in (0.5, 0.95, 0.99))
+        print(f"{name:<36} {len(values):>5} {errors[name]:>6} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {values[-1]:>9.1f}")
+    for name, values in sorted(durations.items()):
+        print(f"\n{name}")
+        buckets = histogram(values, args.buckets)
+        largest = max(count for _, count in buckets)
+        for bound, count in buckets:
+            print(f"  <= {bound:>10.1f} ms {count:>5} {'#' * round(40 * count / largest)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,256 @@
 import pandas as pd
-from sqlalchemy import create_engine, text
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+from engine_class import get_engine, iris_dsn
+
+VISITS_TABLE = 'user_visits'
+PREFERENCES_TABLE = 'user_preferences'
+
+
+def parse_vector(value):
+    # IRIS returns vectors as comma separated strings
+    if isinstance(value, str):
+        return np.array([float(x) for x in value.strip('[]').split(',')])
+    return np.array(value, dtype=float)
+
+def split_places(places):
+    # A list of places, or a comma separated string as the visited_places column had them
+    if isinstance(places, str):
+        places = places.split(',')
+    return [place.strip() for place in places or () if place and place.strip()]
 
 class UserManager:
-    def __init__(self, username='demo', password='demo', hostname='localhost', port='1972', namespace='USER'):
+    def __init__(self, username='demo', password='demo', hostname='localhost', port='1972', namespace='USER', places_table='monuments', place_column='landmark', embed_dim=384):
         """
         Initialize the UserManager class with database connection details.
+
+        The preference vector of a user is the mean of the description_vector
+        of the places visited, read from places_table by place_column.
         """
         self.username = username
         self.password = password
         self.hostname = hostname
         self.port = port
         self.namespace = namespace
+        self.places_table = places_table
+        self.place_column = place_column
+        self.embed_dim = embed_dim
         self.engine = None
         self.connect_to_database()
         self.create_user_table()
+        self.create_visits_tables()
+        self.migrate_visited_places()
 
     def connect_to_database(self):
         """
         Establish a connection to the SQL database.
         """
-        CONNECTION_STRING = f"iris://{self.username}:{self.password}@{self.hostname}:{self.port}/{self.namespace}"
-        self.engine = create_engine(CONNECTION_STRING)
+        # Shared with the other classes connecting to the same database
+        self.engine = get_engine(iris_dsn(self.username, self.password, self.hostname, self.port, self.namespace))
 
     def create_user_table(self):
         """
         Create a SQL table to store user information if it doesn't exist.
+
+        The visited places are in the visits table, see add_visits.
         """
         with self.engine.connect() as conn:
             with conn.begin():
                 conn.execute(text("""
                     CREATE TABLE IF NOT EXISTS users (
                         user_id INT PRIMARY KEY,
-                        preferences VARCHAR(200),
-                        visited_places VARCHAR(20000)
+                        preferences VARCHAR(200)
                     )
                 """))
 
-    def update_user_info(self, user_id, new_preferences=None, new_places=None):
+    def create_visits_tables(self):
+        """
+        Create the tables of the visits, one row per visit, and of the preference vectors.
+        """
+        with self.engine.connect() as conn:
+            with conn.begin():
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {VISITS_TABLE} (
+                        user_id INT NOT NULL,
+                        place VARCHAR(2000) NOT NULL,
+                        visited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """))
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {PREFERENCES_TABLE} (
+                        user_id INT PRIMARY KEY,
+                        preference_vector VECTOR(DOUBLE, {self.embed_dim}),
+                        visit_count INT
+                    )
+                """))
+                try:
+                    conn.execute(text(f"CREATE INDEX {VISITS_TABLE}_user ON {VISITS_TABLE} (user_id, place)"))
+                except Exception:
+                    pass  # Already exists
+
+    def migrate_visited_places(self):
+        """
+        Move the visited_places column of a users table created before the visits table
+        into it, and drop the column.
+
+        Returns
+        -------
+        int
+            The users whose places were moved, 0 once the column is gone.
+        """
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(text("SELECT user_id, visited_places FROM users WHERE visited_places IS NOT NULL")).fetchall()
+        except DBAPIError:
+            # Already migrated, or created without the column
+            return 0
+        moved = 0
+        for user_id, visited_places in rows:
+            places = split_places(visited_places)
+            with self.engine.connect() as conn:
+                with conn.begin():
+                    # Only the process that empties the column records the visits, if several migrate at once
+                    claimed = conn.execute(text("""
+                        UPDATE users SET visited_places = NULL
+                        WHERE user_id = :user_id AND visited_places = :visited_places
+                    """), {'user_id': user_id, 'visited_places': visited_places}).rowcount
+                    if claimed and places:
+                        conn.execute(text(f"INSERT INTO {VISITS_TABLE} (user_id, place) VALUES (:user_id, :place)"),
+                                     [{'user_id': user_id, 'place': place} for place in places])
+            if claimed and places:
+                self.update_preference_vector(user_id, places)
+                moved += 1
+        try:
+            with self.engine.connect() as conn:
+                with conn.begin():
+                    conn.execute(text("ALTER TABLE users DROP COLUMN visited_places"))
+        except DBAPIError:
+            # Dropped by another process in the meantime
+            pass
+        return moved
+
+    def add_visits(self, user_id, places):
         """
-        Update user preferences and visited places in the database.
+        Record visits of a user, in a single batch, and update the preference vector.
+
+        Parameters
+        ----------
+        places : list or str
+            The places visited, or a comma separated string of them.
         """
+        places = split_places(places)
+        if not places:
+            return
         with self.engine.connect() as conn:
             with conn.begin():
-                if new_preferences:
+                conn.execute(text(f"INSERT INTO {VISITS_TABLE} (user_id, place) VALUES (:user_id, :place)"),
+                             [{'user_id': user_id, 'place': place} for place in places])
+        self.update_preference_vector(user_id, places)
+
+    def get_visits(self, user_id):
+        """
+        Retrieve the places visited by a user, oldest first.
+        """
+        with self.engine.connect() as conn:
+            result = conn.execute(text(f"SELECT place FROM {VISITS_TABLE} WHERE user_id = :user_id ORDER BY visited_at"),
+                                  {'user_id': user_id})
+            return [row[0] for row in result]
+
+    def place_vectors(self, places):
+        """
+        Retrieve the description vectors of places, one per place found.
+        """
+        params = {f'p{i}': place for i, place in enumerate(set(places))}
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(f"""
+                SELECT {self.place_column}, description_vector FROM {self.places_table}
+                WHERE {self.place_column} IN ({", ".join(':' + name for name in params)})
+            """), params).fetchall()
+        vectors = {row[0]: parse_vector(row[1]) for row in rows}
+        return [vectors[place] for place in places if place in vectors]
+
+    def update_preference_vector(self, user_id, places, max_attempts=10):
+        """
+        Update the preference vector of a user with the places of new visits.
+
+        The vector is the running mean of the vectors of all the places visited,
+        so only the new places are read. Visits recorded at the same time don't
+        overwrite each other: the update is a compare-and-set on visit_count,
+        read again and retried up to max_attempts times when another one won.
+        """
+        vectors = self.place_vectors(places)
+        if not vectors:
+            return
+        for _ in range(max_attempts):
+            with self.engine.connect() as conn:
+                with conn.begin():
+                    row = conn.execute(text(f"SELECT preference_vector, visit_count FROM {PREFERENCES_TABLE} WHERE user_id = :user_id"),
+                                       {'user_id': user_id}).fetchone()
+                    count = row[1] if row else 0
+                    total = np.sum(vectors, axis=0) + (parse_vector(row[0]) * count if row else 0)
+                    mean = total / (count + len(vectors))
+                    params = {'user_id': user_id, 'preference_vector': str(mean.tolist()),
+                              'visit_count': count + len(vectors), 'read_count': count}
+                    if row:
+                        # Only applied if no other visit changed the vector since it was read:
+                        # visit_count grows with every update, so it versions the row
+                        updated = conn.execute(text(f"""
+                            UPDATE {PREFERENCES_TABLE}
+                            SET preference_vector = TO_VECTOR(:preference_vector), visit_count = :visit_count
+                            WHERE user_id = :user_id AND visit_count = :read_count
+                        """), params).rowcount
+                        if updated:
+                            return
+                        continue
+                try:
+                    with conn.begin():
+                        conn.execute(text(f"""
+                            INSERT INTO {PREFERENCES_TABLE} (user_id, preference_vector, visit_count)
+                            VALUES (:user_id, TO_VECTOR(:preference_vector), :visit_count)
+                        """), params)
+                    return
+                except IntegrityError:
+                    # The first visits of the user were recorded at the same time, user_id is the primary key
+                    continue
+        raise RuntimeError(f"The preference vector of user {user_id} kept changing, {max_attempts} attempts.")
+
+    def get_preference_vector(self, user_id):
+        """
+        Retrieve the preference vector of a user, or None before any visit.
+        """
+        with self.engine.connect() as conn:
+            row = conn.execute(text(f"SELECT preference_vector FROM {PREFERENCES_TABLE} WHERE user_id = :user_id"),
+                               {'user_id': user_id}).fetchone()
+        return parse_vector(row[0]) if row else None
+
+    def update_user_info(self, user_id, new_preferences=None, new_places=None):
+        """
+        Update user preferences in the database and record the places of new visits.
+
+        new_places are appended to the visits of the user, see add_visits, not a
+        replacement of the places visited before.
+        """
+        if new_preferences:
+            with self.engine.connect() as conn:
+                with conn.begin():
                     conn.execute(text(f"UPDATE users SET preferences = :preferences WHERE user_id = :user_id"),
                                  {'preferences': new_preferences, 'user_id': user_id})
-                if new_places:
-                    conn.execute(text(f"UPDATE users SET visited_places = :visited_places WHERE user_id = :user_id"),
-                                 {'visited_places': new_places, 'user_id': user_id})
+        if new_places:
+            self.add_visits(user_id, new_places)
 
-    def add_user(self, user_id, preferences, visited_places):
+    def add_user(self, user_id, preferences, visited_places=None):
         """
-        Add a new user to the database.
+        Add a new user to the database, with the places visited so far.
         """
         with self.engine.connect() as conn:
             with conn.begin():
                 conn.execute(text("""
-                    INSERT INTO users (user_id, preferences, visited_places)
-                    VALUES (:user_id, :preferences, :visited_places)
-                """), {'user_id': user_id, 'preferences': preferences, 'visited_places': visited_places})
+                    INSERT INTO users (user_id, preferences)
+                    VALUES (:user_id, :preferences)
+                """), {'user_id': user_id, 'preferences': preferences})
+        self.add_visits(user_id, visited_places)
 
     def get_user_info(self, user_id):
         """
@@ -83,6 +275,8 @@ class UserManager:
         with self.engine.connect() as conn:
             with conn.begin():
                 conn.execute(text(f"DELETE FROM users WHERE user_id = :user_id"), {'user_id': user_id})
+                conn.execute(text(f"DELETE FROM {VISITS_TABLE} WHERE user_id = :user_id"), {'user_id': user_id})
+                conn.execute(text(f"DELETE FROM {PREFERENCES_TABLE} WHERE user_id = :user_id"), {'user_id': user_id})
 
     def delete_all_users(self):
         """
@@ -90,4 +284,6 @@ class UserManager:
         """
         with self.engine.connect() as conn:
             with conn.begin():
-                conn.execute(text("DELETE FROM users"))
\ No newline at end of file
+                conn.execute(text("DELETE FROM users"))
+                conn.execute(text(f"DELETE FROM {VISITS_TABLE}"))
+                conn.execute(text(f"DELETE FROM {PREFERENCES_TABLE}"))
\ No newline at end of file
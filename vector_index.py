@@ -0,0 +1,88 @@
+from sqlalchemy import inspect, text
+
+DISTANCES = ('Cosine', 'DotProduct')
+
+
+def hnsw_index_name(table, column='description_vector'):
+    return f"{table}_{column}_hnsw"
+
+
+def has_index(engine, table, name):
+    return any(index['name'].lower() == name.lower() for index in inspect(engine).get_indexes(table))
+
+
+def create_hnsw_index(engine, table, column='description_vector', m=16, ef_construction=200, distance='Cosine', rebuild=False):
+    """
+    Create an approximate nearest neighbor (HNSW) index on a vector column.
+
+    Searches ordering by VECTOR_COSINE(column, ...) DESC with a TOP then walk
+    the graph instead of scanning the table. Needs IRIS 2024.1 or later.
+
+    Parameters
+    ----------
+    m : int
+        The neighbors of every node in the graph. More is better recall, more memory and a slower build.
+
+    ef_construction : int
+        The candidates considered when inserting a node. More is better recall and a slower build.
+
+    distance : str
+        'Cosine' or 'DotProduct', the function the searches order by.
+
+    rebuild : bool
+        Drop the index first if it exists, e.g. to change its parameters.
+
+    Returns
+    -------
+    str
+        The name of the index.
+    """
+    if distance not in DISTANCES:
+        raise ValueError(f"Unknown distance {distance}. Choose from {DISTANCES}.")
+    # DDL can't take bound parameters, so they are checked before being spliced in
+    m, ef_construction = int(m), int(ef_construction)
+    name = hnsw_index_name(table, column)
+    exists = has_index(engine, table, name)
+    with engine.connect() as conn:
+        with conn.begin():
+            if exists and rebuild:
+                conn.execute(text(f"DROP INDEX {name} ON TABLE {table}"))
+            if not exists or rebuild:
+                conn.execute(text(f"""
+                    CREATE INDEX {name} ON TABLE {table} ({column})
+                    AS %SQL.Index.HNSW(M={m}, efConstruction={ef_construction}, Distance='{distance}')
+                """))
+    return name
+
+
+def from_clause(table, exact=False):
+    # %IGNOREINDEX * makes the optimizer scan the table, for exact results
+    return f"%IGNOREINDEX * {table}" if exact else table
+
+
+COSINE_SCORE = "VECTOR_COSINE(description_vector, TO_VECTOR(:search_vector))"
+
+
+def search_statement(table, columns, score=COSINE_SCORE, join="", where="", exact=False):
+    """
+    Get the SQL of a vector search: the TOP :number rows of a table by score, returned in the score column.
+
+    IRIS only walks the HNSW index when the statement orders by the VECTOR_COSINE
+    expression itself, so ORDER BY repeats score instead of using its alias.
+    """
+    return f"""
+        SELECT TOP :number {", ".join(list(columns) + [score + " AS score"])}
+        FROM {from_clause(table, exact)}
+        {join}
+        {where}
+        ORDER BY {score} DESC
+    """
+
+
+def query_plan(engine, sql, params):
+    """
+    Get the plan IRIS chose for a statement, as the text returned by EXPLAIN.
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"EXPLAIN {sql}"), params).fetchall()
+    return "\n".join(str(value) for row in rows for value in row)